@@ -1,9 +1,8 @@
 import asyncio
 import can
-import crccheck
-import isotp
+import can_checksum
+import iso_session
 import time
-import threading
 import logging
 
 # Copyright 2022 Angus Gratton
@@ -122,27 +121,17 @@ def find_checksum(bus, message):
     raise RuntimeError("No valid checksum found...")
 
 
-class BMW3FDCRC(crccheck.crc.Crc8Base):
-    """Thanks to colin o'flynns CRCBeagle for calculating this https://github.com/colinoflynn/crcbeagle
+# Thanks to colin o'flynns CRCBeagle for calculating these https://github.com/colinoflynn/crcbeagle
+# Same polynomial as many CRC8 variants. (Table driven versions are in scripts/can_checksum.py)
+BMW3FDCRC = can_checksum.BMW_3FD
+BMW197CRC = can_checksum.BMW_197
 
-    Same polynomial as many CRC8 variants.
-    """
-
-    _poly = 0x1D
-    _initvalue = 0x0
-    _xor_output = 0x70
 
 def bmw_3fd_crc(message):
-    return BMW3FDCRC.calc(message) & 0xFF
-
-class BMW197CRC(crccheck.crc.Crc8Base):
-    """ As above, thanks Colin! """
-    _poly = 0x1D
-    _initvalue = 0x0
-    _xor_output = 0x53
+    return BMW3FDCRC.calc(message)
 
 def bmw_197_crc(message):
-    return BMW197CRC.calc(message) & 0xFF
+    return BMW197CRC.calc(message)
 
 def confirm_working_checksum(bus, message):
     """Simple function to use the DTCs to check if bmw_3fd_crc() returns correct values"""
@@ -211,80 +200,19 @@ def simple_query(bus, send_data):
     return None
 
 
-class ThreadedBmwIsoTp:
+class ThreadedBmwIsoTp(iso_session.Session):
     def __init__(self, bus, target_address, source_address):
         assert target_address < 0x100
         assert source_address < 0x100
-        self.exit_requested = False
-        self.bus = bus
-        self.rxid = 0x600 | target_address
-        addr = isotp.Address(
-            isotp.AddressingMode.Extended_11bits,
-            rxid=0x600 | target_address,
-            txid=0x600 | source_address,
-            target_address=target_address,
-            source_address=source_address,
-        )
-        self.stack = isotp.CanStack(
-            self.bus,
-            address=addr,
-            error_handler=self.my_error_handler,
+        super().__init__(
+            bus,
+            0x600 | source_address,
+            0x600 | target_address,
+            default_timeout=1.0,
+            address=iso_session.extended_address(target_address, source_address),
             params=isotp_params,
         )
 
-    def __enter__(self):
-        self.old_filters = self.bus.filters
-        self.bus.filters = [{"can_id": self.rxid, "can_mask": 0xFFFFFFF}]
-        self.start()
-        return self
-
-    def __exit__(self, type, value, tb):
-        self.stop()
-        self.bus.filters = self.old_filters
-
-    def start(self):
-        self.exit_requested = False
-        self.thread = threading.Thread(target=self.thread_task)
-        self.thread.start()
-
-    def stop(self):
-        self.exit_requested = True
-        if self.thread.is_alive():
-            self.thread.join()
-
-    def my_error_handler(self, error):
-        logging.warning(
-            "IsoTp error happened : %s - %s" % (error.__class__.__name__, str(error))
-        )
-
-    def thread_task_disabled(self):
-        import cProfile
-
-        cProfile.runctx(
-            "self.thread_task_()", globals=globals(), locals=locals(), sort="cumtime"
-        )
-
-    def thread_task(self):
-        while self.exit_requested == False:
-            self.stack.process()  # Non-blocking
-            # (sleeping here seems to cause the diagnostic session to time out
-            # time.sleep(0.001)
-            # time.sleep(self.stack.sleep_time()) # Variable sleep time based on state machine state
-
-    def shutdown(self):
-        self.stop()
-        self.bus.shutdown()
-
-    def request(self, send_bytes, timeout=1.0):
-        self.stack.send(send_bytes)
-        t0 = time.time()
-        while time.time() - t0 < timeout:
-            if self.stack.available():
-                return self.stack.recv()
-            time.sleep(0.05)
-        # print(f"Timeout after {time.time() - t0:.1f}s")
-        return None
-
 
 isotp_params = {
     # Will request the sender to wait 32ms between consecutive frame. 0-127ms or 100-900ns with values from 0xF1-0xF9
@@ -294,13 +222,13 @@ isotp_params = {
     # Number of wait frame allowed before triggering an error
     "wftmax": 0,
     # Link layer (CAN layer) works with 8 byte payload (CAN 2.0)
-    "ll_data_length": 8,
+    "tx_data_length": 8,
     # Will pad all transmitted CAN messages with byte 0x00. None means no padding
     "tx_padding": 0,
     # Triggers a timeout if a flow control is awaited for more than 1000 milliseconds
     "rx_flowcontrol_timeout": 500,
     # Triggers a timeout if a consecutive frame is awaited for more than 1000 millisecondsa
     "rx_consecutive_frame_timeout": 1000,
-    # When sending, respect the stmin requirement of the receiver. If set to True, go as fast as possible.
-    "squash_stmin_requirement": False,
+    # When sending, respect the stmin requirement of the receiver. If set to 0, go as fast as possible.
+    "override_receiver_stmin": None,
 }
@@ -1,4 +1,5 @@
-from message import CounterField, PeriodicMessage
+import can_checksum
+from message import ChecksumField, CounterField, PeriodicMessage
 
 # IEB = integrated electronic brake(?) module. Electric brake booster, ABS and Traction Control in a single box.
 
@@ -12,12 +13,12 @@ class IEB_153_TCS(PeriodicMessage):
         )
         # Alive counter counts 0xE0..0x00 in upper nibble of byte 6
         self.alive = CounterField(self.data, 6, 0xF0, skip=0xF)
+        # checksum byte
+        self.checksum = ChecksumField(self.data, 7, can_checksum.SUM8, end=7)
 
     def update(self):
         self.alive.update()
-
-        # checksum byte
-        self.data[7] = sum(self.data[:7]) & 0xFF
+        self.checksum.update()
 
 
 class IEB_2A2(PeriodicMessage):
@@ -79,13 +80,12 @@ class IEB_387_Wheel(PeriodicMessage):
         super().__init__(car, 0x387, bytes.fromhex("0A0D000000210A00"), 50)
         # 4 bit alive counter in the lower nibble of byte 6
         self.alive = CounterField(self.data, 6, 0x0F, skip=0xE)
+        # byte 5 is a checksum that weirdly includes byte 6 after it, and maybe 7
+        self.checksum = ChecksumField(self.data, 5, can_checksum.SUM8)
 
     def update(self):
         self.alive.update()
-
-        # byte 5 is a checksum that weirdly includes byte 6 after it, and maybe 7
-        self.data[5] = 0
-        self.data[5] = sum(self.data) & 0xFF
+        self.checksum.update()
 
 
 class IEB_507_TCS(PeriodicMessage):
@@ -110,3 +110,31 @@ class CounterField:
             # repeat the counter step if we hit the 'skip' value
             c = (c + self.delta) & (self.bitmask >> self.shift)
         self.set(c)
+
+
+class ChecksumField:
+    """Checksum field in a bytearray, calculated with one of the can_checksum
+    algorithms over target[start:end]. If the field is inside that range then it's
+    zeroed before calculating."""
+
+    def __init__(
+        self,
+        target: bytearray,
+        byte_idx: int,
+        algorithm,
+        start: int = 0,
+        end: Optional[int] = None,
+        bitmask: int = 0xFF,
+    ):
+        self.target = target
+        self.idx = byte_idx
+        self.algorithm = algorithm
+        self.start = start
+        self.end = end
+        self.bitmask = bitmask
+        self.shift = ffs(bitmask)
+
+    def update(self):
+        self.target[self.idx] &= ~self.bitmask
+        c = self.algorithm.calc(self.target[self.start : self.end])
+        self.target[self.idx] |= (c << self.shift) & self.bitmask
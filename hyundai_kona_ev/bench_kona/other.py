@@ -1,4 +1,5 @@
-from message import PeriodicMessage, CounterField
+import can_checksum
+from message import PeriodicMessage, ChecksumField, CounterField
 import time
 
 # Mystery PCAN messages. Trying to find the ones which are sent by the gateway about the charge port lock.
@@ -148,11 +149,12 @@ class UNK_164(PeriodicMessage):
         super().__init__(car, 0x164, bytes.fromhex("00080000"), 10)  # actually 100!
         # looks like a counter field in byte 3
         self.counter = CounterField(self.data, 2, 0x1F, delta=0x02)
+        # byte 4 is a sum of the previous bytes
+        self.checksum = ChecksumField(self.data, 3, can_checksum.SUM8, end=3)
 
     def update(self):
         self.counter.update()
-        # byte 4 is a sum of the previous bytes
-        self.data[3] = sum(self.data[:3]) & 0xFF
+        self.checksum.update()
 
 
 class UNK_471(PeriodicMessage):
@@ -178,11 +180,12 @@ class UNK_5F5(PeriodicMessage):
         super().__init__(car, 0x5f5, bytes.fromhex("041E002900C1FF1F"), 10)
         # 4-bit counter in byte 4
         self.counter = CounterField(self.data, 4, 0x0F)
+        # byte 4 is a sum of the previous bytes
+        self.checksum = ChecksumField(self.data, 3, can_checksum.SUM8, end=3)
 
     def update(self):
         self.counter.update()
-        # byte 4 is a sum of the previous bytes
-        self.data[3] = sum(self.data[:3]) & 0xFF
+        self.checksum.update()
         # the last byte looks like a 5-bit CRC or something. currently not implemented :|
 
 
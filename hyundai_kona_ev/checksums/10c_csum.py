@@ -2,6 +2,7 @@
 
 # all the discrete values of this message in logs, extracted with
 # grep 000010C,false,0 *.csv | sed s/:/,/ | cut -d, -f7-| sort | uniq
+# (or now: scripts/canlog_query.py --id 10c --bus 0 --output unique *.csv)
 MESSAGES = [
     bytes.fromhex(n)
     for n in (
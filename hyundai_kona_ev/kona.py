@@ -1,6 +1,7 @@
+import diag_scan
 import kwp2000
 import struct
-import time
+from concurrent.futures import ThreadPoolExecutor
 
 KNOWN_TXIDS = [
     # Tuples of (TXID, "Name if known")
@@ -41,7 +42,7 @@ KNOWN_TXIDS = [
 ]
 
 
-def enumerate_services(bus, txid, debug=False):
+def enumerate_services(bus, txid, debug=False, pool=None, cache=None, vin=None):
     """Enumerate the possible ISO-15765 based services (UDS or KWP2000 or
     vendor) on a particular diagnostic CAN ID, by sending single byte
     service requests and recording all of the responses that aren't timeouts
@@ -55,12 +56,51 @@ def enumerate_services(bus, txid, debug=False):
 
     It's also not clear if some ECUs will mask available services if they're not
     in the correct security access mode.
+
+    If 'pool' (a kwp2000.SessionPool) is given then the session comes from it.
+
+    If 'cache' (a scan_cache.ScanCache) is given then services it knows are
+    unsupported on this ECU of vehicle 'vin' (required with 'cache') are skipped,
+    and the results are stored in it.
     """
     rxid = txid + 8
-    tp = kwp2000.Session(bus, txid, rxid)
-    kwp = kwp2000.KWP2000Client(tp, debug=debug)
+    if pool is None:
+        tp = kwp2000.Session(bus, txid, rxid)
+    else:
+        tp = pool.session(txid, rxid)
+    skip = set()
+    if cache is not None:
+        skip = {s for s, supported in cache.services(vin, txid).items() if not supported}
+    with kwp2000.KWP2000Client(tp, debug=debug) as kwp:
+        result, unsupported = _enumerate_services(kwp, txid, skip)
+    if cache is not None:
+        cache.set_services(vin, txid, {**dict.fromkeys(unsupported, False),
+                                       **dict.fromkeys(result, True)})
+    return result
+
+
+# Services to not request on particular ECUs, (TXID, service ID) -> reason. These
+# are still counted as supported.
+SKIP_SERVICES = {
+    # In response to this request, this ECU sends an error response
+    # [0x3, 0x7f, 0x23, 0x78] (reqCorrectlyRcvd-RspPending) every 5 seconds
+    # and then seems to keep doing it forever. As if it gets stuck!
+    (0x796, 0x23): "known-weird service_id",
+}
 
+
+def _enumerate_services(kwp, txid, skip=()):
+    """Return (supported, unsupported) lists of service IDs, not trying those in
+    'skip'.
+
+    A service is supported if the ECU gives any response other than
+    serviceNotSupported. The client waits through RspPending responses, so a
+    service is classified by the final response: one which answers RspPending
+    and then serviceNotSupported, or never answers, is unsupported. (Before,
+    any service which answered RspPending was counted as supported.)"""
     result = []
+    unsupported = []
+    backoff = kwp2000.Backoff()
 
     for service_id in range(0x100):
         if service_id & 0x40:
@@ -71,106 +111,115 @@ def enumerate_services(bus, txid, debug=False):
         except BaseException:
             service_desc = "NON_STANDARD_SERVICE"
 
-        if txid == 0x796 and service_id == 0x23:
-            # In response to this request, this ECU sends an error response
-            # [0x3, 0x7f, 0x23, 0x78] (reqCorrectlyRcvd-RspPending) every 5 seconds
-            # and then seems to keep doing it forever. As if it gets stuck!
-            print('0x23: Skipping known-weird service_id')
-            result += [0x23]
+        if service_id in skip:
+            continue
+
+        if (txid, service_id) in SKIP_SERVICES:
+            print(f'{txid:#x} {service_id:#x}: Skipping {SKIP_SERVICES[txid, service_id]}')
+            result.append(service_id)
             continue
 
-        retries = 4
-        while retries > 0:
+        busy = 0  # busy-RepeatRequest responses so far
+        while busy < 4:
             try:
                 kwp._kwp(service_id)
-                print(f"{service_id:#x}: {service_desc}: Success")
+                print(f"{txid:#x} {service_id:#x}: {service_desc}: Success")
                 result.append(service_id)
-                retries = 0
             except kwp2000.NegativeResponseError as e:
                 if "busy-RepeatRequest" in e.message:
                     # retry as requested
-                    print(f'{service_id:#x} repeating as requested (retries={retries})...')
-                    retries -= 1
-                    time.sleep(0.25)
+                    print(f'{txid:#x} {service_id:#x} repeating as requested (retries={4 - busy})...')
+                    busy += 1
+                    if busy < 4:
+                        backoff.wait(busy)
+                    continue
+                if "serviceNotSupported" not in str(e):
+                    # response that isn't an outright "nope!"
+                    print(f"{txid:#x} {service_id:#x}: error {e}")
+                    result.append(service_id)
                 else:
-                    retries = 0
-                    if "RspPending" in str(e):
-                        # need to do this to avoid the response showing up
-                        # in the next request
-                        print(f'{service_id:#x} sent RspPending...')
-                        try:
-                            r2 = kwp.transport.recv(1)
-                            print(f'Delayed Response: {r2}')
-                        except Exception as e2:
-                            print(f'Delayed Error: {e2}')
-                            e = e2
-                    if "serviceNotSupported" not in str(e):
-                        # response that isn't an outright "nope!"
-                        print(f"{service_id:#x}: error {e}")
-                        result.append(service_id)
+                    unsupported.append(service_id)
             except kwp2000.InvalidServiceIdError as e:
-                print(f"{service_id:#x}: error {e}")
+                print(f"{txid:#x} {service_id:#x}: error {e}")
                 result.append(service_id)  # I guess this counts as a reply?
-                retries = 0
             except kwp2000.TimeoutError:
-                retries = 0  # No reply
+                unsupported.append(service_id)  # No reply
+            break
+        backoff.done(busy)
 
-    print(f'{len(result)} services: {", ".join(hex(s) for s in result)}')
-    return result
+    print(f'{txid:#x} {len(result)} services: {", ".join(hex(s) for s in result)}')
+    return result, unsupported
 
 
-def enumerate_services_for_ids(bus, ids=KNOWN_TXIDS, debug=False):
+def enumerate_services_for_ids(bus, ids=KNOWN_TXIDS, debug=False, jobs=None, cache=None,
+                               vin=None):
     """ Go through a list of diagnostic IDs (by default, the known Kona diagnostic IDs)
     and enumerate the diagnostic services on each.
+
+    The IDs are scanned at the same time, up to 'jobs' at once (default all of them),
+    each with its own session from a shared kwp2000.SessionPool.
+
+    See enumerate_services() for 'cache' and 'vin'.
     """
-    result = {}
+    if not ids:
+        return {}
+    results = {}
+    with kwp2000.SessionPool(bus) as pool:
+        with ThreadPoolExecutor(jobs or len(ids)) as executor:
+            futures = {}
+            for txid, name in ids:
+                futures[txid] = executor.submit(enumerate_services, bus, txid, debug, pool,
+                                                cache, vin)
+            # the scans' own output is interleaved, so summarise each ID at the end
+            for txid, f in futures.items():
+                results[txid] = f.result()
     for txid, name in ids:
-        print(f"**********\nScanning {txid:#x} ({name})... ")
-        result[txid] = enumerate_services(bus, txid, debug)
-    return result
+        print(f"**********\n{txid:#x} ({name}): {len(results[txid])} services: "
+              f"{', '.join(hex(s) for s in results[txid])}")
+    return results
 
 
-def scan_tester_present(bus):
+def scan_tester_present(bus, cache=None, vin=None):
     """ Go through all possible Diagnostic IDs and return a list of which ones
-    give any response to Tester Present service request (including an error response).
+    give any response to Tester Present service request (including an error response,
+    or any other ISO-TP frame from TXID + 8).
+
+    Requests are sent to many IDs at once, see diag_scan.py.
+
+    If 'cache' (a scan_cache.ScanCache) is given then IDs which it knows didn't
+    respond on vehicle 'vin' (required with 'cache') are skipped, and the results
+    are stored in it.
     """
-    found = []
-    for txid in range(0x700, 0x7f7):
-        if txid == 0x7bf:
-            continue  # broadcast address
-        print(f'txid: {txid:#x}: ', end='')
-
-        tp = kwp2000.Session(bus, txid, txid + 8, default_timeout=0.2)
-        kwp = kwp2000.KWP2000Client(tp)
-        try:
-            # UDS style Tester Present data byte
-            kwp._kwp(kwp2000.SERVICE_TYPE.TESTER_PRESENT, data=b'\x00')
-            print('OK')
-            found.append(txid)
-        except Exception as e:
-            if "No response to request" in str(e):
-                print('No response')
-            else:
-                print(e)
-                found.append(txid)
-    return found
+    txids = [txid for txid in range(0x700, 0x7f7) if txid != 0x7bf]  # 0x7bf is broadcast
+    if cache is not None:
+        dead = cache.dead_ids(vin, 'tester_present')
+        txids = [txid for txid in txids if txid not in dead]
+    found = {}
+    if txids:  # else the cache says none of them respond
+        found = diag_scan.scan_tester_present(bus, txids, any_response=True)
+    if cache is not None:
+        results = {txid: None for txid in txids}
+        results.update({txid: (txid + 8, data) for txid, (data, _) in found.items()})
+        cache.set_ids(vin, 'tester_present', results)
+    for txid, (data, response_time) in sorted(found.items()):
+        print(f'txid: {txid:#x}: {data.hex()} ({response_time * 1000:.0f}ms)')
+    return sorted(found)
 
 
 def read_data_by_common_identifier(bus, txid, identifier, debug=False):
     """ This doesn't currently work, returns "subFunctionNotsupported-invalidFormat"
     """
     tp = kwp2000.Session(bus, txid, txid + 8)
-    kwp = kwp2000.KWP2000Client(tp, debug=debug)
-
-    kwp.diagnostic_session_control(0x90)
+    with kwp2000.KWP2000Client(tp, debug=debug) as kwp:
+        kwp.diagnostic_session_control(0x90)
 
-    data = struct.pack('>HBB',
-                     identifier,
-                     1,  # transmission mode: single
-                     1)  # number of responses to send
+        data = struct.pack('>HBB',
+                         identifier,
+                         1,  # transmission mode: single
+                         1)  # number of responses to send
 
-    data = b'\x00\x01'
+        data = b'\x00\x01'
 
-    resp = kwp._kwp(kwp2000.SERVICE_TYPE.READ_DATA_BY_COMMON_IDENTIFIER,
-                    data=data)
-    return resp
+        resp = kwp._kwp(kwp2000.SERVICE_TYPE.READ_DATA_BY_COMMON_IDENTIFIER,
+                        data=data)
+        return resp
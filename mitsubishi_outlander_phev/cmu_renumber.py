@@ -5,6 +5,7 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 import argparse
+import can_checksum
 import serial
 import struct
 import time
@@ -72,7 +73,7 @@ def renumber_packet_with(ids_in_use=()):
         as_num |= ID_KEPT << ((i - 1) * 2)
     assert as_num < 1 << 24  # 3 bytes max
     as_bytes = struct.pack("I", as_num)[:3]
-    csum = sum(b for b in as_bytes) & 0xFF
+    csum = can_checksum.SUM8.calc(as_bytes)
     return b"\x00" + as_bytes + bytes([csum])
 
 
@@ -86,7 +87,7 @@ def decode_result_packet(pkt):
         )
     as_bytes = pkt[1:4]
 
-    calc_csum = sum(b for b in as_bytes) & 0xFF
+    calc_csum = can_checksum.SUM8.calc(as_bytes)
     if pkt[4] != calc_csum:
         raise ValueError(
             f"Calculated checksum {calc_csum} doesn't match packet {pkt.hex()}"
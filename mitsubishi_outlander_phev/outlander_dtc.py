@@ -4,7 +4,8 @@
 # SPDX-License-Identifier: MIT OR Apache-2.0
 # SPDX-FileCopyrightText: 2021 Angus Gratton
 #
-# Uses https://github.com/pylessard/python-can-isotp and Python 3.6+
+# Uses https://github.com/pylessard/python-can-isotp (v2 or newer) via
+# scripts/iso_session.py, or the Linux kernel CAN_ISOTP socket, and Python 3.6+
 #
 # This isn't an executable script, it's designed for interactive use. i.e:
 #
@@ -19,42 +20,57 @@
 #
 import asyncio
 import can
-import isotp
+import diag_scan
+import iso_session
 import time
-import threading
 import logging
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)-15s %(levelname)-8s:%(name)-12s:%(message)s',
                     filename='outlander_dtc.debug.log')
 
+# the 'switch back to normal' msg
+SCAN_DATA = bytearray([0x02, 0x10, 0x81] + [0]*5)
+SCAN_RESPONSE = bytearray([0x02, 0x50, 0x81])
+
 def find_ecu(bus, txid, timeout=0.1):
     """ Send a diagnostic command to 'txid', look for a matching response on any CAN ID """
-    # the 'switch back to normal' msg
-    scan_msg = can.Message(arbitration_id=txid, data=bytearray([0x02, 0x10, 0x81] + [0]*5),
-                           is_extended_id=False)
+    scan_msg = can.Message(arbitration_id=txid, data=SCAN_DATA, is_extended_id=False)
     #print(scan_msg)
-    expect_response = bytearray([0x02, 0x50, 0x81])
     t0 = time.time()
     remaining = timeout
     bus.send(scan_msg)
     while remaining > 0 or r:
         r = bus.recv(max(0,remaining))
-        if r and r.data.startswith(expect_response):
+        if r and r.data.startswith(SCAN_RESPONSE):
             return r.arbitration_id
         remaining = (t0 + timeout) - time.time()
     return None
 
-def scan_ecus(bus):
-    """ Search the full 11-bit CAN range for things that respond like diagnostic interfaces """
-    ecus = []
-    for txid in range(0x00, 0x7FF):
-        if (txid % 0x100 == 0):
-            print(f"Progress {txid:#x}")
-        rxid = find_ecu(bus, txid)
-        if rxid:
-            print(f'Found ECU TXID {txid:#x} RXID {rxid:#x}')
-            ecus.append((txid, rxid))
+def scan_ecus(bus, interval=0.002, cache=None, vin=None):
+    """ Search the full 11-bit CAN range for things that respond like diagnostic interfaces
+
+    Probes go out 'interval' seconds apart without waiting for responses, and then
+    each response is checked with find_ecu() on the likely TXIDs (see diag_scan.py).
+
+    If 'cache' (a scan_cache.ScanCache) is given then IDs which it knows didn't
+    respond on vehicle 'vin' (required with 'cache') are skipped, and the results
+    are stored in it.
+    """
+    txids = range(0x00, 0x7FF)
+    if cache is not None:
+        dead = cache.dead_ids(vin, 'diagnostic_session')
+        txids = [txid for txid in txids if txid not in dead]
+    ecus = diag_scan.scan_responders(bus, txids, SCAN_DATA,
+                                     lambda data: data.startswith(SCAN_RESPONSE),
+                                     lambda txid: find_ecu(bus, txid),
+                                     interval=interval)
+    for txid, rxid in ecus:
+        print(f'Found ECU TXID {txid:#x} RXID {rxid:#x}')
+    if cache is not None:
+        results = {txid: None for txid in txids}
+        results.update(dict(ecus))
+        cache.set_ids(vin, 'diagnostic_session', results)
     return ecus
 
 def read_dtcs(bus, txid, rxid):
@@ -115,62 +131,15 @@ def erase_dtcs(bus, txid, rxid):
     print("After:")
     read_dtcs(bus,txid,rxid)
 
-class ThreadedIsoTp:
+class ThreadedIsoTp(iso_session.Session):
    def __init__(self, bus, txid, rxid):
-      self.exit_requested = False
-      self.bus = bus
-      self.rxid = rxid
-      addr = isotp.Address(isotp.AddressingMode.Normal_11bits, rxid=rxid, txid=txid)
-      self.stack = isotp.CanStack(self.bus, address=addr, error_handler=self.my_error_handler,
-                                  params=isotp_params)
-
-   def __enter__(self):
-       self.old_filters = self.bus.filters
-       self.bus.filters = [{"can_id":self.rxid, "can_mask":0xfffffff}]
-       self.start()
-       return self
-
-   def __exit__(self, type, value, tb):
-       self.stop()
-       self.bus.filters = self.old_filters
-
-   def start(self):
-      self.exit_requested = False
-      self.thread = threading.Thread(target = self.thread_task)
-      self.thread.start()
-
-   def stop(self):
-      self.exit_requested = True
-      if self.thread.is_alive():
-         self.thread.join()
-
-   def my_error_handler(self, error):
-      logging.warning('IsoTp error happened : %s - %s' % (error.__class__.__name__, str(error)))
-
-   def thread_task_disabled(self):
-       import cProfile
-       cProfile.runctx("self.thread_task_()", globals=globals(), locals=locals(), sort='cumtime')
-
-   def thread_task(self):
-      while self.exit_requested == False:
-         self.stack.process()                # Non-blocking
-         # (sleeping here seems to cause the diagnostic session to time out
-         #time.sleep(0.001)
-         #time.sleep(self.stack.sleep_time()) # Variable sleep time based on state machine state
-
-   def shutdown(self):
-      self.stop()
-      self.bus.shutdown()
-
-   def request(self, send_bytes, timeout=1.0):
-      self.stack.send(send_bytes)
-      t0 = time.time()
-      while time.time() - t0 < timeout:
-            if self.stack.available():
-                return self.stack.recv()
-            time.sleep(0.1)
-      print(f'Timeout after {time.time() - t0:.1f}s')
-      return None
+      super().__init__(bus, txid, rxid, default_timeout=1.0, params=isotp_params)
+
+   def request(self, send_bytes, timeout=None):
+      r = super().request(send_bytes, timeout)
+      if r is None:
+         print(f'Timeout after {timeout or self.default_timeout:.1f}s')
+      return r
 
 
 isotp_params = {
@@ -181,13 +150,13 @@ isotp_params = {
     # Number of wait frame allowed before triggering an error
     'wftmax' : 0,
     # Link layer (CAN layer) works with 8 byte payload (CAN 2.0)
-    'll_data_length' : 8,
+    'tx_data_length' : 8,
     # Will pad all transmitted CAN messages with byte 0x00. None means no padding
     'tx_padding' : 0,
     # Triggers a timeout if a flow control is awaited for more than 1000 milliseconds
     'rx_flowcontrol_timeout' : 500,
     # Triggers a timeout if a consecutive frame is awaited for more than 1000 millisecondsa
     'rx_consecutive_frame_timeout' : 1000,
-    # When sending, respect the stmin requirement of the receiver. If set to True, go as fast as possible.
-    'squash_stmin_requirement' : False
+    # When sending, respect the stmin requirement of the receiver. If set to 0, go as fast as possible.
+    'override_receiver_stmin' : None
 }
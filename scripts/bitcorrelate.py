@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+#
+# Search a CAN log for the payload bits and bytes that best match an event, to
+# find which frame carries a particular signal (for example the charge port
+# lock state that the messages in hyundai_kona_ev/bench_kona/other.py were
+# being searched for).
+#
+# The event is given as either:
+#
+# - Labelled time intervals. Frames inside an --on interval are labelled 1,
+#   frames inside an --off interval are labelled 0. If no --off intervals are
+#   given then all frames outside the --on intervals are labelled 0. Otherwise
+#   frames outside all intervals are ignored.
+#
+# - A reference signal, either a CSV file of 'time,value' samples (--reference)
+#   or a field of another CAN ID (--reference-id/--reference-byte/
+#   --reference-mask). The most recent reference value is used for each frame.
+#
+# Times are seconds from the first frame in the log (as printed by
+# bitstats.py), intervals are given as START-END.
+#
+# Every bit and byte of every ID is scored by correlation with the label and
+# (for intervals) by mutual information, then the top candidates are printed.
+# Only running sums and value/label counts are kept per ID, so the log is
+# processed in one streaming pass with numpy over each batch.
+#
+# Usage:
+#
+#   bitcorrelate.py --on 120-300 --on 900-1000 [--top N] LOG
+#   bitcorrelate.py --reference-id 5ec --reference-byte 0 LOG
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import argparse
+import csv
+
+import numpy as np
+
+import canlog
+
+N_FEATURES = 64 + 8  # bits then bytes
+
+
+def features(data):
+    """Return an (n, 72) array of each frame's bits (byte 0 bit 0 first) then bytes."""
+    data = data[:, :8]
+    return np.concatenate(
+        (np.unpackbits(data, axis=1, bitorder="little"), data), axis=1
+    ).astype(np.float64)
+
+
+def feature_name(i):
+    if i < 64:
+        return f"byte {i // 8} bit {i % 8}"
+    return f"byte {i - 64}"
+
+
+class IntervalLabels:
+    """Labels frames as 1 (inside an 'on' interval), 0 or NaN (ignored)."""
+
+    binary = True
+
+    def __init__(self, on, off):
+        self.on = on
+        self.off = off
+        self.t0 = None
+
+    def __call__(self, batch):
+        if self.t0 is None:
+            self.t0 = int(batch["timestamp"][0])
+        t = (batch["timestamp"] - self.t0) / 1e6
+        y = np.full(len(t), np.nan if self.off else 0.0)
+        for start, end in self.off:
+            y[(t >= start) & (t < end)] = 0
+        for start, end in self.on:
+            y[(t >= start) & (t < end)] = 1
+        return y
+
+
+class ReferenceLabels:
+    """Labels frames with the most recent value of a reference signal."""
+
+    binary = False
+
+    def __init__(self, times=None, values=None, can_id=None, byte=0, mask=0xFF):
+        self.times = None if times is None else np.asarray(times, np.float64)
+        self.values = None if values is None else np.asarray(values, np.float64)
+        self.can_id = can_id
+        self.byte = byte
+        self.mask = mask
+        self.shift = (mask & -mask).bit_length() - 1
+        self.last = np.nan  # last reference value from a CAN ID
+        self.t0 = None
+
+    def __call__(self, batch):
+        if self.t0 is None:
+            self.t0 = int(batch["timestamp"][0])
+        if self.can_id is None:
+            t = (batch["timestamp"] - self.t0) / 1e6
+            ref_t, ref_v, before = self.times, self.values, np.nan
+        else:
+            t = batch["timestamp"]
+            ref = batch[batch["can_id"] == self.can_id]
+            ref_t = ref["timestamp"]
+            ref_v = (ref["data"][:, self.byte] & self.mask) >> self.shift
+            ref_v = ref_v.astype(np.float64)
+            before = self.last
+            if len(ref_v):
+                self.last = ref_v[-1]
+        if not len(ref_v):
+            return np.full(len(t), before)
+        idx = np.searchsorted(ref_t, t, "right") - 1
+        return np.where(idx >= 0, ref_v[np.maximum(idx, 0)], before)
+
+
+class Scores:
+    """Running sums and label counts for the features of one CAN ID."""
+
+    def __init__(self, binary):
+        self.n = 0
+        self.max_len = 0
+        self.sx = np.zeros(N_FEATURES)
+        self.sxx = np.zeros(N_FEATURES)
+        self.sxy = np.zeros(N_FEATURES)
+        self.sy = 0.0
+        self.syy = 0.0
+        # for mutual information: count of each (feature value, label)
+        self.counts = np.zeros((N_FEATURES, 256, 2), np.int64) if binary else None
+
+    def update(self, x, y, lengths):
+        self.n += len(y)
+        self.max_len = max(self.max_len, int(lengths.max()))
+        self.sx += x.sum(axis=0)
+        self.sxx += (x * x).sum(axis=0)
+        self.sxy += y @ x
+        self.sy += y.sum()
+        self.syy += (y * y).sum()
+        if self.counts is not None:
+            # flat index of (feature, value, label) for every element of x
+            idx = np.arange(N_FEATURES) * 512 + x.astype(np.int64) * 2
+            idx += y.astype(np.int64)[:, None]
+            counts = np.bincount(idx.ravel(), minlength=N_FEATURES * 512)
+            self.counts += counts.reshape(N_FEATURES, 256, 2)
+
+    def correlation(self):
+        n = self.n
+        cov = self.sxy / n - (self.sx / n) * (self.sy / n)
+        var_x = self.sxx / n - (self.sx / n) ** 2
+        var_y = self.syy / n - (self.sy / n) ** 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = cov / np.sqrt(var_x * var_y)
+        r[var_x < 1e-12] = np.nan  # constant features
+        return r
+
+    def mutual_information(self):
+        """Mutual information (in bits) between each feature and the binary label."""
+        p = self.counts / self.n
+        px = p.sum(axis=2, keepdims=True)
+        py = p.sum(axis=1, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            terms = p * np.log2(p / (px * py))
+        return np.nansum(terms, axis=(1, 2))
+
+    def valid_features(self):
+        """Boolean array of features that are within the payload."""
+        f = np.arange(N_FEATURES)
+        return np.where(f < 64, f // 8, f - 64) < self.max_len
+
+
+def search(batches, labels):
+    """Return a dict of can_id -> Scores for the batches of a log."""
+    scores = {}
+    for batch in batches:
+        y = labels(batch)
+        keep = ~np.isnan(y)
+        batch, y = batch[keep], y[keep]
+        if not len(batch):
+            continue
+        order = np.argsort(batch["can_id"], kind="stable")
+        batch, y = batch[order], y[order]
+        lengths = canlog.payload_lengths(batch)
+        x = features(batch["data"])
+        ids, starts = np.unique(batch["can_id"], return_index=True)
+        ends = np.append(starts[1:], len(batch))
+        for can_id, s, e in zip(ids.tolist(), starts.tolist(), ends.tolist()):
+            if can_id not in scores:
+                scores[can_id] = Scores(labels.binary)
+            scores[can_id].update(x[s:e], y[s:e], lengths[s:e])
+    return scores
+
+
+def candidates(scores, exclude=()):
+    """Return a list of (score, can_id, feature, correlation, mutual information),
+    best first. Score is mutual information if available, otherwise |correlation|."""
+    result = []
+    for can_id, s in scores.items():
+        if can_id in exclude:
+            continue
+        r = s.correlation()
+        mi = s.mutual_information() if s.counts is not None else np.full(N_FEATURES, np.nan)
+        score = mi if s.counts is not None else np.abs(r)
+        for f in np.nonzero(s.valid_features() & ~np.isnan(r))[0].tolist():
+            result.append((float(score[f]), can_id, f, float(r[f]), float(mi[f])))
+    result.sort(key=lambda c: (-c[0], c[1], c[2]))
+    return result
+
+
+def parse_interval(arg):
+    start, _, end = arg.partition("-")
+    return float(start), float(end)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find payload fields that match an event")
+    parser.add_argument("--on", type=parse_interval, action="append", default=[])
+    parser.add_argument("--off", type=parse_interval, action="append", default=[])
+    parser.add_argument("--reference", help="CSV file of time,value reference samples")
+    parser.add_argument("--reference-id", type=lambda x: int(x, 16))
+    parser.add_argument("--reference-byte", type=int, default=0)
+    parser.add_argument("--reference-mask", type=lambda x: int(x, 16), default=0xFF)
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("log")
+    args = parser.parse_args()
+
+    if args.on:
+        labels = IntervalLabels(args.on, args.off)
+    elif args.reference:
+        with open(args.reference) as f:
+            rows = sorted((float(t), float(v)) for t, v in csv.reader(f))
+        labels = ReferenceLabels([r[0] for r in rows], [r[1] for r in rows])
+    elif args.reference_id is not None:
+        labels = ReferenceLabels(
+            can_id=args.reference_id, byte=args.reference_byte, mask=args.reference_mask
+        )
+    else:
+        parser.error("Need --on intervals or a reference signal")
+
+    scores = search(canlog.read_log(args.log), labels)
+    exclude = () if args.reference_id is None else (args.reference_id,)
+    print(f"{'ID':>8} {'Field':<14} {'Corr':>7} {'MI (bits)':>9} {'Frames':>8}")
+    for score, can_id, f, r, mi in candidates(scores, exclude)[: args.top]:
+        mi = "-" if np.isnan(mi) else f"{mi:.4f}"
+        print(f"{can_id:>8x} {feature_name(f):<14} {r:>7.3f} {mi:>9} {scores[can_id].n:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#
+# Per-bit change statistics for a CAN log, to help find signals when reverse
+# engineering. Automates observations like "bit 3 goes 30->00 when charging"
+# or "one bit sets a few times briefly during charging" (see the comments in
+# hyundai_kona_ev/bench_kona/other.py).
+#
+# For every bit of every ID this computes the number of toggles, duty cycle
+# (fraction of frames with the bit set), times of the first and last change and
+# the shortest/longest/mean time between changes ("run length"). Then prints a
+# report of all bits that changed, ranked by number of toggles. By default the
+# bits which change least are listed first, as these are usually the state
+# signals of interest. Counters and checksums end up at the bottom.
+#
+# The log is processed a batch at a time, with each ID's bits unpacked into a
+# numpy bit array per batch, so memory use is bounded and a 10M frame log takes
+# seconds.
+#
+# Usage:
+#
+#   bitstats.py [--id ID[,ID...]] [--min-toggles N] [--max-toggles N] [--most] LOG
+#
+# Times in the report are seconds from the first frame in the log. Bits are
+# numbered within each byte from 0 (LSB) to 7 (MSB).
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import argparse
+
+import numpy as np
+
+import canlog
+
+NO_TIME = np.iinfo(np.int64).max
+
+
+class BitStats:
+    """Accumulated statistics for the 64 bits of one CAN ID."""
+
+    def __init__(self, can_id):
+        self.can_id = can_id
+        self.frames = 0
+        self.max_len = 0
+        self.prev = None  # bits of the last frame seen
+        self.ones = np.zeros(64, np.int64)
+        self.toggles = np.zeros(64, np.int64)
+        self.first_change = np.full(64, NO_TIME)
+        self.last_change = np.full(64, NO_TIME)
+        self.run_min = np.full(64, NO_TIME)
+        self.run_max = np.zeros(64, np.int64)
+        self.run_total = np.zeros(64, np.int64)
+        self.run_count = np.zeros(64, np.int64)
+
+    def update(self, timestamp, data, lengths):
+        """Add frames for this ID, with timestamp (n,), data (n, 8) and payload lengths (n,)"""
+        bits = np.unpackbits(data[:, :8], axis=1, bitorder="little")
+        self.frames += len(bits)
+        self.max_len = max(self.max_len, int(lengths.max()))
+        self.ones += bits.sum(axis=0, dtype=np.int64)
+
+        prev = bits[:1] if self.prev is None else self.prev[None]
+        change = np.concatenate((prev, bits[:-1])) != bits
+        self.prev = bits[-1]
+        self.toggles += change.sum(axis=0, dtype=np.int64)
+
+        rows, cols = np.nonzero(change.T)  # rows here are bit numbers, sorted
+        if not len(rows):
+            return
+        t = timestamp[cols]
+        # the time between each change and the previous change of the same bit,
+        # for the first change of each bit in this batch use the previous batch
+        prev_t = np.empty_like(t)
+        prev_t[1:] = t[:-1]
+        first = np.ones(len(rows), bool)
+        first[1:] = rows[1:] != rows[:-1]
+        prev_t[first] = self.last_change[rows[first]]
+        valid = prev_t != NO_TIME
+        runs, run_bits = t[valid] - prev_t[valid], rows[valid]
+        np.minimum.at(self.run_min, run_bits, runs)
+        np.maximum.at(self.run_max, run_bits, runs)
+        np.add.at(self.run_total, run_bits, runs)
+        np.add.at(self.run_count, run_bits, 1)
+
+        np.minimum.at(self.first_change, rows, t)
+        last = np.ones(len(rows), bool)
+        last[:-1] = rows[1:] != rows[:-1]
+        self.last_change[rows[last]] = t[last]
+
+    def report_rows(self):
+        """Yield a tuple for each bit that changed: (byte, bit, toggles, duty, first, last,
+        run min, run max, run mean), with times in microseconds."""
+        for b in np.nonzero(self.toggles[: self.max_len * 8])[0].tolist():
+            count = self.run_count[b]
+            yield (
+                b // 8,
+                b % 8,
+                int(self.toggles[b]),
+                self.ones[b] / self.frames,
+                int(self.first_change[b]),
+                int(self.last_change[b]),
+                int(self.run_min[b]) if count else None,
+                int(self.run_max[b]) if count else None,
+                int(self.run_total[b] / count) if count else None,
+            )
+
+
+def analyse(batches, ids=None):
+    """Return a dict of can_id -> BitStats, and the first timestamp seen."""
+    stats = {}
+    t0 = None
+    for batch in batches:
+        if ids is not None:
+            batch = batch[np.isin(batch["can_id"], ids)]
+        if not len(batch):
+            continue
+        if t0 is None:
+            t0 = int(batch["timestamp"][0])
+        # group the batch by ID, keeping log order within each ID
+        order = np.argsort(batch["can_id"], kind="stable")
+        batch = batch[order]
+        lengths = canlog.payload_lengths(batch)
+        batch_ids, starts = np.unique(batch["can_id"], return_index=True)
+        ends = np.append(starts[1:], len(batch))
+        for can_id, s, e in zip(batch_ids.tolist(), starts.tolist(), ends.tolist()):
+            if can_id not in stats:
+                stats[can_id] = BitStats(can_id)
+            stats[can_id].update(batch["timestamp"][s:e], batch["data"][s:e], lengths[s:e])
+    return stats, t0
+
+
+def report(stats, t0, min_toggles=1, max_toggles=None, most_first=False):
+    rows = []
+    for s in stats.values():
+        for r in s.report_rows():
+            if r[2] >= min_toggles and (max_toggles is None or r[2] <= max_toggles):
+                rows.append((s.can_id, s.frames) + r)
+    rows.sort(key=lambda r: (-r[4] if most_first else r[4], r[0], r[2], r[3]))
+
+    def secs(t, rel=True):
+        if t is None:
+            return "-"
+        return f"{(t - t0 if rel else t) / 1e6:.3f}"
+
+    print(
+        f"{'ID':>8} {'Frames':>8} {'Byte':>4} {'Bit':>3} {'Toggles':>8} {'Duty':>6} "
+        f"{'First':>10} {'Last':>10} {'Run min':>9} {'Run max':>9} {'Run mean':>9}"
+    )
+    for can_id, frames, byte, bit, toggles, duty, first, last, rmin, rmax, rmean in rows:
+        print(
+            f"{can_id:>8x} {frames:>8} {byte:>4} {bit:>3} {toggles:>8} {duty:>6.1%} "
+            f"{secs(first):>10} {secs(last):>10} {secs(rmin, False):>9} "
+            f"{secs(rmax, False):>9} {secs(rmean, False):>9}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-bit change statistics for a CAN log")
+    parser.add_argument("--id", action="append", help="Only these arbitration ID(s), hex")
+    parser.add_argument("--min-toggles", type=int, default=1)
+    parser.add_argument("--max-toggles", type=int)
+    parser.add_argument(
+        "--most", action="store_true", help="List the bits that change most first"
+    )
+    parser.add_argument("log")
+    args = parser.parse_args()
+
+    ids = None
+    if args.id:
+        ids = [int(i, 16) for arg in args.id for i in arg.split(",")]
+
+    stats, t0 = analyse(canlog.read_log(args.log), ids)
+    report(stats, t0, args.min_toggles, args.max_toggles, args.most)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Table-driven checksum and CRC algorithms for CAN message payloads, shared by
+# the transmit code (bench_kona, bmw_gws), receive validation and log tools.
+#
+# Each algorithm has a precomputed 256-entry table, and two ways to calculate:
+#
+# - calc(data) for a single payload (bytes, bytearray or list of ints),
+#   returns an int.
+# - calc_batch(data) for a (n, length) uint8 numpy array of payloads, returns
+#   a uint8 array of n checksums. (numpy is only needed for this.)
+#
+# Both calculate over all of 'data', the caller passes the covered bytes and
+# zeroes the checksum field first if it's covered.
+#
+# Known algorithms (see ALGORITHMS):
+#
+# BMW_3FD          BMW GWS 0x3FD message CRC-8 (see bmw_gear_selector)
+# BMW_197          BMW GWS 0x197 message CRC-8
+# SUM8             Sum of bytes, e.g. Kona IEB 0x153 and 0x387, Outlander CMU
+#                  renumber packets
+# NIBBLE_SUM4      Sum of all nibbles, low 4 bits. Kona 0x10C and 0x109.
+# NEG_NIBBLE_SUM4  Two's complement of the above (so all nibbles including the
+#                  checksum sum to zero). Kona 0x394 (bytes 0-6).
+# SUM4_XOR9        Sum of bytes XOR 9, low 4 bits. Kona 0x220 (best guess so far).
+#
+# Usage for a checksum in the last byte:
+#
+#   data[7] = can_checksum.SUM8.calc(data[:7])
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+try:
+    import numpy as np
+except ImportError:
+    np = None  # only needed for calc_batch()
+
+
+class Crc8:
+    """Table-driven CRC-8."""
+
+    def __init__(self, poly, init=0, xorout=0, reflect=False, name=None):
+        self.poly = poly
+        self.init = init
+        self.xorout = xorout
+        self.reflect = reflect
+        self.name = name
+        self.table = bytes(self._table_entry(i) for i in range(256))
+        self._np_table = None
+
+    def _table_entry(self, value):
+        if self.reflect:
+            poly = int(f"{self.poly:08b}"[::-1], 2)
+            for _ in range(8):
+                value = (value >> 1) ^ poly if value & 1 else value >> 1
+        else:
+            for _ in range(8):
+                value = ((value << 1) ^ self.poly) & 0xFF if value & 0x80 else value << 1
+        return value
+
+    def _start(self):
+        if self.reflect:
+            return int(f"{self.init:08b}"[::-1], 2)
+        return self.init
+
+    def calc(self, data):
+        table = self.table
+        reg = self._start()
+        for b in data:
+            reg = table[reg ^ b]
+        return reg ^ self.xorout
+
+    def calc_batch(self, data):
+        if self._np_table is None:
+            self._np_table = np.frombuffer(self.table, np.uint8)
+        reg = np.full(len(data), self._start(), np.uint8)
+        for col in range(data.shape[1]):
+            reg = self._np_table[reg ^ data[:, col]]
+        return reg ^ np.uint8(self.xorout)
+
+    def __repr__(self):
+        return (
+            f"Crc8(poly={self.poly:#04x}, init={self.init:#04x}, "
+            f"xorout={self.xorout:#04x}, reflect={self.reflect})"
+        )
+
+
+def _nibble_sum(b):
+    return (b & 0x0F) + (b >> 4)
+
+
+class Sum:
+    """Sum of (table values of) each byte, optionally negated, plus an offset,
+    XORed with a constant and masked to 'bits' wide."""
+
+    def __init__(self, bits=8, nibbles=False, negate=False, offset=0, xor=0, name=None):
+        self.bits = bits
+        self.nibbles = nibbles
+        self.negate = negate
+        self.offset = offset
+        self.xor = xor
+        self.name = name
+        self.mask = (1 << bits) - 1
+        # value added to the sum for each byte (None for the byte itself)
+        self.table = bytes(_nibble_sum(i) for i in range(256)) if nibbles else None
+        self._np_table = None
+
+    def _finish(self, total):
+        if self.negate:
+            total = -total
+        return ((total + self.offset) ^ self.xor) & self.mask
+
+    def calc(self, data):
+        if self.table is None:
+            return self._finish(sum(data))
+        return self._finish(sum(bytes(data).translate(self.table)))
+
+    def calc_batch(self, data):
+        if self.table is None:
+            total = data.sum(axis=1, dtype=np.int64)
+        else:
+            if self._np_table is None:
+                self._np_table = np.frombuffer(self.table, np.uint8)
+            total = self._np_table[data].sum(axis=1, dtype=np.int64)
+        return self._finish(total).astype(np.uint8)
+
+    def __repr__(self):
+        return (
+            f"Sum(bits={self.bits}, nibbles={self.nibbles}, negate={self.negate}, "
+            f"offset={self.offset:#x}, xor={self.xor:#x})"
+        )
+
+
+BMW_3FD = Crc8(0x1D, init=0x00, xorout=0x70, name="BMW_3FD")
+BMW_197 = Crc8(0x1D, init=0x00, xorout=0x53, name="BMW_197")
+SUM8 = Sum(name="SUM8")
+NIBBLE_SUM4 = Sum(bits=4, nibbles=True, name="NIBBLE_SUM4")
+NEG_NIBBLE_SUM4 = Sum(bits=4, nibbles=True, negate=True, name="NEG_NIBBLE_SUM4")
+SUM4_XOR9 = Sum(bits=4, xor=0x9, name="SUM4_XOR9")
+
+ALGORITHMS = {
+    a.name: a for a in (BMW_3FD, BMW_197, SUM8, NIBBLE_SUM4, NEG_NIBBLE_SUM4, SUM4_XOR9)
+}
@@ -0,0 +1,1170 @@
+#!/usr/bin/env python
+#
+# Streaming conversion between the various CAN log formats used in this repo.
+#
+# Frames are passed from readers to writers as numpy structured arrays (see
+# frame_dtype()), one batch of up to BATCH_SIZE frames at a time. Any reader
+# can feed any writer, and a conversion is a single pass over the input with
+# memory use bounded by the batch size regardless of how long the capture is.
+#
+# Supported formats:
+#
+# pycan      Standard output of python-can's can.logger (i.e. print(msg)), and
+#            the bench_kona log files.
+# pycan_csv  The can.io.CSVWriter() log format of python-can.
+# gvret      GVRET CSV format as used by SavvyCAN (with or without header row).
+# candump    Linux can-utils 'candump -l' format.
+# asc        Vector ASC (via python-can).
+# blf        Vector BLF (via python-can).
+# canbin     Compact binary format: a short header then fixed-size records, which
+#            can be memory mapped as a numpy array. See BinLog.
+#
+# Format is guessed from file extension (and first line, for .log and .csv
+# files) unless specified.
+#
+# Usage:
+#
+#   canlog.py convert [--from FMT] [--to FMT] [--fd] [--jobs N] INPUT OUTPUT
+#   canlog.py merge [--to FMT] [--offset SECS ...] [--keep-bus] -o OUTPUT INPUT [...]
+#   canlog.py index CANBIN_FILE [...]
+#
+# --jobs splits text format inputs into chunks which are converted in parallel
+# (useful for multi-gigabyte captures). Output is identical either way.
+#
+# merge combines logs captured separately on each bus into one log in
+# timestamp order, with the Bus column set to the index of each input.
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import argparse
+import base64
+import itertools
+import os
+import os.path
+import re
+import struct
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+BATCH_SIZE = 65536
+CHUNK_SIZE = 8 * 1024 * 1024  # for parallel conversion
+
+# Bits in the 'flags' field of each frame
+FLAG_EXTENDED = 0x01
+FLAG_REMOTE = 0x02
+FLAG_ERROR = 0x04
+FLAG_FD = 0x08
+FLAG_BRS = 0x10
+FLAG_TX = 0x20
+
+GVRET_HEADER = "Time Stamp,ID,Extended,Bus,LEN,D1,D2,D3,D4,D5,D6,D7,D8"
+PYCAN_CSV_HEADER = "timestamp,arbitration_id,extended,remote,error,dlc,data"
+
+CANBIN_MAGIC = b"CANBIN\x00\x00"
+CANBIN_VERSION = 1
+CANBIN_HEADER = struct.Struct("<8sHH4x")
+
+
+def frame_dtype(data_len=8):
+    """Return the numpy dtype of a batch of frames.
+
+    'timestamp' is integer microseconds, the same as GVRET. 'dlc' is the
+    payload length in bytes, 'data' is zero padded out to data_len (8 for
+    classic CAN or 64 for CAN FD).
+    """
+    return np.dtype(
+        [
+            ("timestamp", "<i8"),
+            ("can_id", "<u4"),
+            ("bus", "u1"),
+            ("flags", "u1"),
+            ("dlc", "u1"),
+            ("data", "u1", (data_len,)),
+        ]
+    )
+
+
+FRAME_DTYPE = frame_dtype(8)
+FD_FRAME_DTYPE = frame_dtype(64)
+
+
+class _Columns:
+    """Accumulates parsed frames column by column, then packs them into a batch."""
+
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.width = dtype["data"].shape[0]
+        self.clear()
+
+    def clear(self):
+        self.timestamp = []
+        self.can_id = []
+        self.bus = []
+        self.flags = []
+        self.dlc = []
+        self.data = []
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def append(self, timestamp, can_id, bus, flags, dlc, data):
+        self.timestamp.append(timestamp)
+        self.can_id.append(can_id)
+        self.bus.append(bus)
+        self.flags.append(flags)
+        self.dlc.append(dlc)
+        self.data.append(data)
+
+    def pack(self):
+        """Return the accumulated frames as a batch, and clear them."""
+        batch = np.empty(len(self.timestamp), self.dtype)
+        batch["timestamp"] = self.timestamp
+        batch["can_id"] = self.can_id
+        batch["bus"] = self.bus
+        batch["flags"] = self.flags
+        batch["dlc"] = self.dlc
+        width = self.width
+        raw = b"".join(d.ljust(width, b"\x00") for d in self.data)
+        if len(raw) != len(batch) * width:
+            raise ValueError(
+                f"Frame payload longer than {width} bytes (use CAN FD frame format)"
+            )
+        batch["data"] = np.frombuffer(raw, np.uint8).reshape(-1, width)
+        self.clear()
+        return batch
+
+
+def payload_lengths(batch):
+    """Return the number of valid payload bytes for each frame in a batch."""
+    n = np.minimum(batch["dlc"], batch.dtype["data"].shape[0])
+    n[(batch["flags"] & FLAG_REMOTE) != 0] = 0
+    return n
+
+
+def _iter_payloads(batch):
+    """Yield the payload of each frame in a batch as bytes."""
+    raw = batch["data"].tobytes()
+    width = batch.dtype["data"].shape[0]
+    for offs, n in zip(range(0, len(raw), width), payload_lengths(batch).tolist()):
+        yield raw[offs : offs + n]
+
+
+def _bus_number(channel):
+    """Extract a bus index from a channel name such as 'can1' or 'vcan0'."""
+    if isinstance(channel, int):
+        return channel
+    m = re.search(r"(\d+)$", str(channel or ""))
+    return int(m.group(1)) if m else 0
+
+
+#
+# Text format parsers. Each takes an iterable of lines and returns a batch, any
+# lines that don't parse (headers, comments, blank lines) are skipped.
+#
+
+_PYCAN_RE = re.compile(
+    r"Timestamp: *([\d\.]+) +ID: *([\da-fA-F]+) +([SX]) ?([RT]x)? *((?:[ERF]|BS|EI| )*?)"
+    r" *DLC?: *(\d+) *((?:[\da-fA-F]{2} ?)*) *(?:'.*')? *(?:Channel: *\D*(\d+))?"
+)
+
+
+def _parse_pycan_flags(idtype, direction, fl):
+    flags = 0
+    if idtype == "X":
+        flags |= FLAG_EXTENDED
+    if direction == "Tx":
+        flags |= FLAG_TX
+    for f in fl.split():
+        flags |= {"E": FLAG_ERROR, "R": FLAG_REMOTE, "F": FLAG_FD, "BS": FLAG_BRS}.get(f, 0)
+    return flags
+
+
+def _parse_pycan_regex(line):
+    m = _PYCAN_RE.match(line)
+    if m:
+        timestamp, canid, idtype, direction, fl, dlc, data, channel = m.groups()
+        try:
+            timestamp = float(timestamp)
+        except ValueError:
+            return None  # e.g. more than one '.'
+        return (
+            int(timestamp * 1e6),  # to microseconds
+            int(canid, 16),
+            int(channel or 0),
+            _parse_pycan_flags(idtype, direction, fl),
+            int(dlc),
+            bytes.fromhex(data),
+        )
+
+
+# Every field of str(can.Message) is fixed width except the timestamp (which is
+# 15 characters minimum), the payload (24 characters for classic CAN frames)
+# and the channel at the end. So once the end of the timestamp is known, the
+# offsets below (from the end of the timestamp) locate each field. Lines that
+# fit this layout are cut down to a fixed width and then parsed all at once
+# with numpy. Anything else falls back to the regex.
+_PYCAN_ID = 8
+_PYCAN_FLAGS = 20
+_PYCAN_DL = 36
+_PYCAN_DLC = 44
+_PYCAN_DATA = 50
+_PYCAN_CHANNEL = 74
+_PYCAN_CHANNEL_VALUE = 87
+
+# Value of each ASCII hex digit, space is 0 and 255 means invalid
+_HEX_VALUES = np.full(256, 255, np.uint8)
+_HEX_VALUES[ord(" ")] = 0
+for _i, _c in enumerate(b"0123456789abcdef"):
+    _HEX_VALUES[_c] = _i
+    _HEX_VALUES[bytes([_c]).upper()[0]] = _i
+
+# Class of each timestamp character: space, digit, '.' or invalid
+_TS_SPACE, _TS_DIGIT, _TS_DOT, _TS_INVALID = range(4)
+_TIMESTAMP_CHARS = np.full(256, _TS_INVALID, np.uint8)
+_TIMESTAMP_CHARS[ord(" ")] = _TS_SPACE
+_TIMESTAMP_CHARS[ord(".")] = _TS_DOT
+_TIMESTAMP_CHARS[np.frombuffer(b"0123456789", np.uint8)] = _TS_DIGIT
+
+
+def _parse_pycan_block(rows, buses, t, dtype):
+    """Parse lines cut down to the fixed width layout (with the timestamp ending at
+    offset t). Returns a batch and a boolean array of rows that failed to parse."""
+    m = np.frombuffer("".join(rows).encode(), np.uint8).reshape(len(rows), -1)
+    batch = np.zeros(len(rows), dtype)
+
+    # leading spaces then digits with at most one '.', anything else is left to
+    # the regex (so one corrupt timestamp doesn't fail the whole block)
+    ts = m[:, 11:t].copy()
+    chars = _TIMESTAMP_CHARS[ts]
+    leading = np.cumprod(chars == _TS_SPACE, axis=1).astype(bool)
+    bad = (
+        ((chars == _TS_INVALID) | ((chars == _TS_SPACE) & ~leading)).any(axis=1)
+        | ((chars == _TS_DOT).sum(axis=1) > 1)
+        | ~(chars == _TS_DIGIT).any(axis=1)
+    )
+    ts[bad] = ord("0")
+
+    # numpy's string to float conversion rounds the same as float(), so this
+    # gives identical results to the regex parser
+    timestamp = ts.view(f"S{t - 11}").ravel().astype(np.float64)
+    batch["timestamp"] = timestamp * 1e6
+
+    digits = _HEX_VALUES[m[:, t + _PYCAN_ID : t + _PYCAN_ID + 8]]
+    bad |= (digits == 255).any(axis=1)
+    batch["can_id"] = digits.astype(np.uint32) @ (16 ** np.arange(7, -1, -1, dtype=np.uint32))
+
+    dlc = _HEX_VALUES[m[:, t + _PYCAN_DLC : t + _PYCAN_DATA - 4]]
+    bad |= (dlc > 9).any(axis=1)
+    batch["dlc"] = dlc[:, 0] * 10 + dlc[:, 1]
+
+    data = _HEX_VALUES[m[:, t + _PYCAN_DATA : t + _PYCAN_CHANNEL]]
+    bad |= (data == 255).any(axis=1)
+    batch["data"][:, :8] = (data[:, 0:24:3] << 4) | data[:, 1:24:3]
+
+    fl = m[:, t + _PYCAN_FLAGS : t + _PYCAN_DL]
+    batch["flags"] = (
+        np.where(fl[:, 0] == ord("X"), FLAG_EXTENDED, 0)
+        | np.where(fl[:, 2] == ord("T"), FLAG_TX, 0)
+        | np.where(fl[:, 5] == ord("E"), FLAG_ERROR, 0)
+        | np.where(fl[:, 7] == ord("R"), FLAG_REMOTE, 0)
+        | np.where(fl[:, 9] == ord("F"), FLAG_FD, 0)
+        | np.where(fl[:, 11] == ord("B"), FLAG_BRS, 0)
+    )
+    batch["bus"] = buses
+    return batch, bad
+
+
+def parse_pycan_lines(lines, dtype=FRAME_DTYPE, fast=True):
+    lines = list(lines)
+    blocks = {}  # timestamp end offset -> (line indexes, rows, buses)
+    slow = []  # line indexes for the regex
+    bus_cache = {}
+    t = -1  # offset of end of timestamp, or -1 if layout unknown
+    for i, line in enumerate(lines):
+        if fast and (
+            line[t : t + _PYCAN_ID] != "    ID: "
+            or line[t + _PYCAN_DL : t + _PYCAN_DLC] != "    DL: "
+            or line[t + _PYCAN_CHANNEL : t + _PYCAN_CHANNEL_VALUE] != "    Channel: "
+        ):
+            # Layout unknown or timestamp width has changed
+            t = line.find("    ID: ", 11)
+            if (
+                t < 0
+                or line[t + _PYCAN_DL : t + _PYCAN_DLC] != "    DL: "
+                or line[t + _PYCAN_CHANNEL : t + _PYCAN_CHANNEL_VALUE] != "    Channel: "
+            ):
+                t = -1
+        if fast and t > 0:
+            channel = line[t + _PYCAN_CHANNEL_VALUE :]
+            bus = bus_cache.get(channel)
+            if bus is None:
+                m = re.match(r"\D*(\d+)", channel)
+                bus = bus_cache[channel] = int(m.group(1)) if m else 0
+            if t not in blocks:
+                blocks[t] = ([], [], [])
+            indexes, rows, buses = blocks[t]
+            indexes.append(i)
+            rows.append(line[: t + _PYCAN_CHANNEL])
+            buses.append(bus)
+        else:
+            slow.append(i)
+
+    parts = []
+    order = []
+    for t, (indexes, rows, buses) in blocks.items():
+        batch, bad = _parse_pycan_block(rows, buses, t, dtype)
+        indexes = np.array(indexes)
+        parts.append(batch[~bad])
+        order.append(indexes[~bad])
+        slow += indexes[bad].tolist()
+
+    if slow:
+        cols = _Columns(dtype)
+        parsed = []
+        for i in sorted(slow):
+            frame = _parse_pycan_regex(lines[i])
+            if frame:
+                cols.append(*frame)
+                parsed.append(i)
+        parts.append(cols.pack())
+        order.append(np.array(parsed, dtype=int))
+
+    if not parts:
+        return np.empty(0, dtype)
+    if len(parts) == 1:
+        return parts[0]
+    # put the frames back in the original line order
+    return np.concatenate(parts)[np.argsort(np.concatenate(order), kind="stable")]
+
+
+def parse_pycan_csv_lines(lines, dtype=FRAME_DTYPE):
+    cols = _Columns(dtype)
+    for line in lines:
+        fields = line.rstrip("\r\n").split(",")
+        if len(fields) != 7 or fields[0] == "timestamp":
+            continue
+        timestamp, canid, extended, remote, error, dlc, data = fields
+        flags = (
+            (FLAG_EXTENDED if extended == "1" else 0)
+            | (FLAG_REMOTE if remote == "1" else 0)
+            | (FLAG_ERROR if error == "1" else 0)
+        )
+        cols.append(
+            int(float(timestamp) * 1e6),
+            int(canid, 0),
+            0,  # this CSV format doesn't distinguish
+            flags,
+            int(dlc),
+            base64.b64decode(data),
+        )
+    return cols.pack()
+
+
+def parse_gvret_lines(lines, dtype=FRAME_DTYPE):
+    cols = _Columns(dtype)
+    for line in lines:
+        fields = line.rstrip("\r\n").split(",")
+        if not fields[0].isdigit():
+            continue  # header
+        flags = FLAG_EXTENDED if fields[2] == "true" else 0
+        if fields[3] in ("Rx", "Tx"):
+            # newer SavvyCAN versions add a 'Dir' column
+            if fields[3] == "Tx":
+                flags |= FLAG_TX
+            del fields[3]
+        cols.append(
+            int(fields[0]),
+            int(fields[1], 16),
+            int(fields[3]),
+            flags,
+            int(fields[4]),
+            bytes.fromhex("".join(fields[5:])),
+        )
+    return cols.pack()
+
+
+def parse_candump_lines(lines, dtype=FRAME_DTYPE):
+    cols = _Columns(dtype)
+    for line in lines:
+        parts = line.split()
+        if len(parts) < 3 or not parts[0].startswith("("):
+            continue
+        timestamp, channel, frame = parts[:3]
+        canid, _, data = frame.partition("#")
+        flags = FLAG_EXTENDED if len(canid) > 3 else 0
+        if data.startswith("#"):
+            # CAN FD, first nibble is the FD flags
+            flags |= FLAG_FD | (FLAG_BRS if int(data[1], 16) & 1 else 0)
+            data = data[2:]
+        if data.startswith("R"):
+            flags |= FLAG_REMOTE
+            dlc = int(data[1:] or 0)
+            payload = b""
+        else:
+            payload = bytes.fromhex(data)
+            dlc = len(payload)
+        if int(canid, 16) & 0x20000000:
+            flags |= FLAG_ERROR
+        cols.append(
+            int(float(timestamp[1:-1]) * 1e6),
+            int(canid, 16) & 0x1FFFFFFF,
+            _bus_number(channel),
+            flags,
+            dlc,
+            payload,
+        )
+    return cols.pack()
+
+
+def _read_text(path, parse_lines, dtype, batch_size):
+    with open(path, "r") as f:
+        while True:
+            lines = list(itertools.islice(f, batch_size))
+            if not lines:
+                return
+            batch = parse_lines(lines, dtype)
+            if len(batch):
+                yield batch
+
+
+def _text_reader(parse_lines):
+    def reader(path, dtype=FRAME_DTYPE, batch_size=BATCH_SIZE):
+        return _read_text(path, parse_lines, dtype, batch_size)
+
+    reader.parse_lines = parse_lines
+    return reader
+
+
+read_pycan = _text_reader(parse_pycan_lines)
+read_pycan_csv = _text_reader(parse_pycan_csv_lines)
+read_gvret = _text_reader(parse_gvret_lines)
+read_candump = _text_reader(parse_candump_lines)
+
+
+def _read_python_can(log_reader, dtype, batch_size):
+    cols = _Columns(dtype)
+    for msg in log_reader:
+        flags = (
+            (FLAG_EXTENDED if msg.is_extended_id else 0)
+            | (FLAG_REMOTE if msg.is_remote_frame else 0)
+            | (FLAG_ERROR if msg.is_error_frame else 0)
+            | (FLAG_FD if msg.is_fd else 0)
+            | (FLAG_BRS if msg.bitrate_switch else 0)
+            | (0 if msg.is_rx else FLAG_TX)
+        )
+        cols.append(
+            int(msg.timestamp * 1e6),
+            msg.arbitration_id,
+            _bus_number(msg.channel),
+            flags,
+            msg.dlc,
+            bytes(msg.data),
+        )
+        if len(cols) >= batch_size:
+            yield cols.pack()
+    if len(cols):
+        yield cols.pack()
+
+
+def read_asc(path, dtype=FRAME_DTYPE, batch_size=BATCH_SIZE):
+    import can
+
+    return _read_python_can(can.ASCReader(path, relative_timestamp=False), dtype, batch_size)
+
+
+def read_blf(path, dtype=FRAME_DTYPE, batch_size=BATCH_SIZE):
+    import can
+
+    return _read_python_can(can.BLFReader(path), dtype, batch_size)
+
+
+def read_canbin_header(f):
+    """Read and check the canbin header from an open file, return the frame dtype."""
+    magic, version, data_len = CANBIN_HEADER.unpack(f.read(CANBIN_HEADER.size))
+    if magic != CANBIN_MAGIC or version != CANBIN_VERSION:
+        raise ValueError(f"Not a canbin v{CANBIN_VERSION} file: {f.name}")
+    return frame_dtype(data_len)
+
+
+def read_canbin(path, dtype=None, batch_size=BATCH_SIZE):
+    with open(path, "rb") as f:
+        file_dtype = read_canbin_header(f)
+        if dtype is not None and dtype != file_dtype:
+            raise ValueError(f"{path} has frame type {file_dtype}, not {dtype}")
+        while True:
+            batch = np.fromfile(f, file_dtype, batch_size)
+            if not len(batch):
+                return
+            yield batch
+
+
+#
+# Writers. Each is a context manager with a write(batch) method.
+#
+
+
+class _TextWriter:
+    header = None
+    newline = "\n"
+
+    def __init__(self, path):
+        self.f = open(path, "w", newline="")
+        if self.header:
+            self.f.write(self.header + self.newline)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def write(self, batch):
+        self.f.writelines(self.format_lines(batch))
+
+    def write_text(self, text):
+        """Write text that's already been formatted by format_lines()."""
+        self.f.write(text)
+
+
+class GvretWriter(_TextWriter):
+    header = GVRET_HEADER
+    newline = "\r\n"  # same as csv.writer, which the old converters used
+
+    @classmethod
+    def format_lines(cls, batch):
+        nl = cls.newline
+        for ts, canid, bus, flags, dlc, payload in zip(
+            batch["timestamp"].tolist(),
+            batch["can_id"].tolist(),
+            batch["bus"].tolist(),
+            batch["flags"].tolist(),
+            batch["dlc"].tolist(),
+            _iter_payloads(batch),
+        ):
+            extended = "true" if flags & FLAG_EXTENDED else "false"
+            line = f"{ts},{canid:08X},{extended},{bus},{dlc}"
+            if payload:
+                line += "," + payload.hex(",").upper()
+            yield line + nl
+
+
+class PycanCsvWriter(_TextWriter):
+    header = PYCAN_CSV_HEADER
+
+    @classmethod
+    def format_lines(cls, batch):
+        for ts, canid, flags, dlc, payload in zip(
+            batch["timestamp"].tolist(),
+            batch["can_id"].tolist(),
+            batch["flags"].tolist(),
+            batch["dlc"].tolist(),
+            _iter_payloads(batch),
+        ):
+            yield (
+                f"{ts / 1e6!r},{canid:#x},"
+                f"{1 if flags & FLAG_EXTENDED else 0},"
+                f"{1 if flags & FLAG_REMOTE else 0},"
+                f"{1 if flags & FLAG_ERROR else 0},"
+                f"{dlc},{base64.b64encode(payload).decode()}\n"
+            )
+
+
+class PycanWriter(_TextWriter):
+    """Writes the same format as str(can.Message), i.e. can.logger output."""
+
+    @classmethod
+    def format_lines(cls, batch):
+        for ts, canid, bus, flags, dlc, payload in zip(
+            batch["timestamp"].tolist(),
+            batch["can_id"].tolist(),
+            batch["bus"].tolist(),
+            batch["flags"].tolist(),
+            batch["dlc"].tolist(),
+            _iter_payloads(batch),
+        ):
+            if flags & FLAG_EXTENDED:
+                canid = f"{canid:08x}"
+            else:
+                canid = f"{canid:03x}"
+            flag_string = " ".join(
+                [
+                    "X" if flags & FLAG_EXTENDED else "S",
+                    "Tx" if flags & FLAG_TX else "Rx",
+                    "E" if flags & FLAG_ERROR else " ",
+                    "R" if flags & FLAG_REMOTE else " ",
+                    "F" if flags & FLAG_FD else " ",
+                    "BS" if flags & FLAG_BRS else "  ",
+                    "  ",
+                ]
+            )
+            yield (
+                f"Timestamp: {ts / 1e6:>15.6f}    ID: {canid:>8}    {flag_string}    "
+                f"DL: {dlc:2d}    {payload.hex(' '):<24}    Channel: can{bus}\n"
+            )
+
+
+class CandumpWriter(_TextWriter):
+    @classmethod
+    def format_lines(cls, batch):
+        for ts, canid, bus, flags, dlc, payload in zip(
+            batch["timestamp"].tolist(),
+            batch["can_id"].tolist(),
+            batch["bus"].tolist(),
+            batch["flags"].tolist(),
+            batch["dlc"].tolist(),
+            _iter_payloads(batch),
+        ):
+            if flags & FLAG_ERROR:
+                canid = f"{canid | 0x20000000:08X}"
+            elif flags & FLAG_EXTENDED:
+                canid = f"{canid:08X}"
+            else:
+                canid = f"{canid:03X}"
+            if flags & FLAG_REMOTE:
+                data = f"R{dlc or ''}"
+            elif flags & FLAG_FD:
+                data = f"#{1 if flags & FLAG_BRS else 0}{payload.hex().upper()}"
+            else:
+                data = payload.hex().upper()
+            yield f"({ts // 1000000}.{ts % 1000000:06d}) can{bus} {canid}#{data}\n"
+
+
+class _PythonCanWriter:
+    def __init__(self, log_writer):
+        self.log_writer = log_writer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def close(self):
+        self.log_writer.stop()
+
+    def write(self, batch):
+        import can
+
+        for ts, canid, bus, flags, payload in zip(
+            batch["timestamp"].tolist(),
+            batch["can_id"].tolist(),
+            batch["bus"].tolist(),
+            batch["flags"].tolist(),
+            _iter_payloads(batch),
+        ):
+            self.log_writer.on_message_received(
+                can.Message(
+                    timestamp=ts / 1e6,
+                    arbitration_id=canid,
+                    is_extended_id=bool(flags & FLAG_EXTENDED),
+                    is_remote_frame=bool(flags & FLAG_REMOTE),
+                    is_error_frame=bool(flags & FLAG_ERROR),
+                    is_fd=bool(flags & FLAG_FD),
+                    bitrate_switch=bool(flags & FLAG_BRS),
+                    is_rx=not flags & FLAG_TX,
+                    channel=bus,
+                    data=payload,
+                )
+            )
+
+
+def AscWriter(path):
+    import can
+
+    return _PythonCanWriter(can.ASCWriter(path))
+
+
+def BlfWriter(path):
+    import can
+
+    return _PythonCanWriter(can.BLFWriter(path))
+
+
+class CanbinWriter:
+    def __init__(self, path, dtype=FRAME_DTYPE):
+        self.dtype = dtype
+        self.f = open(path, "wb")
+        self.f.write(
+            CANBIN_HEADER.pack(CANBIN_MAGIC, CANBIN_VERSION, dtype["data"].shape[0])
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def write(self, batch):
+        batch.astype(self.dtype, copy=False).tofile(self.f)
+
+
+READERS = {
+    "pycan": read_pycan,
+    "pycan_csv": read_pycan_csv,
+    "gvret": read_gvret,
+    "candump": read_candump,
+    "asc": read_asc,
+    "blf": read_blf,
+    "canbin": read_canbin,
+}
+
+WRITERS = {
+    "pycan": PycanWriter,
+    "pycan_csv": PycanCsvWriter,
+    "gvret": GvretWriter,
+    "candump": CandumpWriter,
+    "asc": AscWriter,
+    "blf": BlfWriter,
+    "canbin": CanbinWriter,
+}
+
+_EXTENSIONS = {
+    ".asc": "asc",
+    ".blf": "blf",
+    ".canbin": "canbin",
+    ".candump": "candump",
+}
+
+
+def guess_format(path, reading=True):
+    """Guess the log format of 'path' from its extension and (if reading) first line."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in _EXTENSIONS:
+        return _EXTENSIONS[ext]
+    if ext not in (".csv", ".log", ".txt"):
+        raise ValueError(f"Can't guess log format of {path}")
+    if not reading:
+        return "gvret" if ext == ".csv" else "pycan"
+    with open(path, "r") as f:
+        first = f.readline()
+    if first.startswith("Timestamp:"):
+        return "pycan"
+    if first.startswith("("):
+        return "candump"
+    if first.startswith(PYCAN_CSV_HEADER):
+        return "pycan_csv"
+    if first.startswith("Time Stamp,") or first[:1].isdigit():
+        return "gvret"
+    raise ValueError(f"Can't guess log format of {path}")
+
+
+def read_log(path, fmt=None, dtype=FRAME_DTYPE, batch_size=BATCH_SIZE):
+    """Return an iterator over batches of frames read from the log at 'path'."""
+    if fmt is None:
+        fmt = guess_format(path)
+    if fmt == "canbin":
+        return read_canbin(path, None, batch_size)
+    return READERS[fmt](path, dtype, batch_size)
+
+
+def open_writer(path, fmt=None, dtype=FRAME_DTYPE):
+    """Return a writer for a new log at 'path'. Use as a context manager."""
+    if fmt is None:
+        fmt = guess_format(path, reading=False)
+    if fmt == "canbin":
+        return CanbinWriter(path, dtype)
+    return WRITERS[fmt](path)
+
+
+def convert(
+    from_path,
+    to_path,
+    from_fmt=None,
+    to_fmt=None,
+    dtype=FRAME_DTYPE,
+    jobs=1,
+    chunk_size=CHUNK_SIZE,
+):
+    """Convert a log file from one format to another in a single pass. Returns number
+    of frames converted.
+
+    If jobs > 1 and the input is a text format, it's split into chunks which are
+    parsed (and formatted, for text outputs) in a pool of 'jobs' processes.
+    """
+    if os.path.exists(to_path) and os.path.samefile(from_path, to_path):
+        raise RuntimeError(f"from and to are the same file: {from_path}")
+    if from_fmt is None:
+        from_fmt = guess_format(from_path)
+    if to_fmt is None:
+        to_fmt = guess_format(to_path, reading=False)
+    parse_lines = getattr(READERS[from_fmt], "parse_lines", None)
+    count = 0
+    with open_writer(to_path, to_fmt, dtype) as writer:
+        if jobs > 1 and parse_lines:
+            chunks = _convert_chunks(
+                from_path, parse_lines, WRITERS[to_fmt], dtype, jobs, chunk_size
+            )
+            for n, chunk in chunks:
+                if isinstance(chunk, str):
+                    writer.write_text(chunk)
+                else:
+                    writer.write(chunk)
+                count += n
+        else:
+            for batch in read_log(from_path, from_fmt, dtype):
+                writer.write(batch)
+                count += len(batch)
+    return count
+
+
+#
+# Parallel conversion. The input is split on line boundaries into chunks of
+# around chunk_size bytes, each worker process parses a chunk (and formats it
+# as text, if the output is a text format) and the results are written in the
+# same order as the input. This means the output is identical to a sequential
+# conversion.
+#
+
+def chunk_ranges(path, chunk_size=CHUNK_SIZE):
+    """Yield (start, end) byte offsets that split the file at 'path' into chunks
+    of at least chunk_size, ending on line boundaries."""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()  # finish the current line
+            end = f.tell()
+            yield start, end
+            start = end
+
+
+def read_chunk(path, start, end, parse_lines, dtype=FRAME_DTYPE):
+    """Parse the lines between byte offsets start and end of a text log into a batch."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode()
+    return parse_lines(text.splitlines(), dtype)
+
+
+def _convert_chunk(path, start, end, parse_lines, writer_cls, dtype):
+    batch = read_chunk(path, start, end, parse_lines, dtype)
+    if hasattr(writer_cls, "format_lines"):
+        return len(batch), "".join(writer_cls.format_lines(batch))
+    return len(batch), batch
+
+
+def _convert_chunks(path, parse_lines, writer_cls, dtype, jobs, chunk_size):
+    """Yield (frame count, text or batch) for each converted chunk, in input order."""
+    with ProcessPoolExecutor(jobs) as pool:
+        pending = deque()
+        for start, end in chunk_ranges(path, chunk_size):
+            pending.append(
+                pool.submit(_convert_chunk, path, start, end, parse_lines, writer_cls, dtype)
+            )
+            # limit the number of chunks in flight, to bound memory use
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+#
+# Merging several logs (i.e. one per bus, captured separately) into a single
+# log in timestamp order. Each input is read a batch at a time and the merge
+# only emits frames up to the lowest 'last timestamp read so far' among the
+# inputs, so memory use is bounded to around one batch per input.
+#
+
+
+def merge_logs(paths, offsets=None, buses=None, dtype=FRAME_DTYPE, batch_size=BATCH_SIZE):
+    """Yield batches of frames from the logs in 'paths', merged in timestamp order.
+
+    offsets is an optional list of clock corrections (in seconds) to add to the
+    timestamps of each input. buses is an optional list of bus numbers to tag
+    the frames from each input with (None to keep the bus in the log).
+
+    Each input is expected to be in timestamp order already (each batch is
+    sorted, but frames out of order across batches can't be fixed).
+    Frames with equal timestamps are output in input order.
+    """
+    offsets = [int(round(o * 1e6)) for o in (offsets or [0] * len(paths))]
+    buses = buses or [None] * len(paths)
+    readers = [iter(read_log(p, dtype=dtype, batch_size=batch_size)) for p in paths]
+    pending = [np.empty(0, dtype) for _ in paths]
+    done = [False] * len(paths)
+
+    while True:
+        for i, reader in enumerate(readers):
+            while not done[i] and not len(pending[i]):
+                batch = next(reader, None)
+                if batch is None:
+                    done[i] = True
+                    break
+                batch = np.array(batch, dtype)  # copy, as we modify it
+                batch["timestamp"] += offsets[i]
+                if buses[i] is not None:
+                    batch["bus"] = buses[i]
+                pending[i] = np.sort(batch, order="timestamp", kind="stable")
+
+        # Everything up to this timestamp has been read from every input
+        waiting = [p["timestamp"][-1] for p, d in zip(pending, done) if not d]
+        if not waiting and not any(len(p) for p in pending):
+            return
+        watermark = min(waiting) if waiting else None
+
+        out = []
+        for i, p in enumerate(pending):
+            n = len(p) if watermark is None else np.searchsorted(p["timestamp"], watermark, "right")
+            out.append(p[:n])
+            pending[i] = p[n:]
+        out = np.concatenate(out)
+        yield out[np.argsort(out["timestamp"], kind="stable")]
+
+
+def merge(paths, to_path, to_fmt=None, offsets=None, buses=None, dtype=FRAME_DTYPE):
+    """Merge the logs in 'paths' into a single log at 'to_path'. By default the bus
+    of each frame is set to the index of its input. Returns number of frames written."""
+    if buses is None:
+        buses = list(range(len(paths)))
+    count = 0
+    with open_writer(to_path, to_fmt, dtype) as writer:
+        for batch in merge_logs(paths, offsets, buses, dtype):
+            writer.write(batch)
+            count += len(batch)
+    return count
+
+
+#
+# Memory mapped access to canbin logs, with a sidecar index file (same path
+# plus ".idx") that maps each CAN ID to the offsets of its records and divides
+# the log into coarse time buckets. The index is built the first time a log is
+# opened with BinLog, and rebuilt if the log is newer than the index.
+#
+# Index file layout: header, then the arrays ids (u4), id_starts (u8, start of
+# each ID's run in 'offsets' plus a final end value), offsets (u8), bucket_lo
+# and bucket_hi (u8, range of records with a timestamp in each bucket).
+#
+
+CANIDX_MAGIC = b"CANIDX\x00\x00"
+CANIDX_VERSION = 1
+CANIDX_HEADER = struct.Struct("<8sHHIQQqQ?7x")
+BUCKET_US = 1_000_000  # one second
+
+
+class BinLog:
+    """A canbin log memory mapped as a numpy array of frames.
+
+    Opening a log doesn't read the frames, so takes the same time regardless of
+    size. frames, time_slice() and id_offsets() are views onto the file, by_id()
+    has to gather the records for an ID so returns a copy.
+    """
+
+    def __init__(self, path, build_index=True):
+        self.path = path
+        with open(path, "rb") as f:
+            dtype = read_canbin_header(f)
+        if os.path.getsize(path) > CANBIN_HEADER.size:
+            self.frames = np.memmap(path, dtype, "r", CANBIN_HEADER.size)
+        else:
+            self.frames = np.empty(0, dtype)
+        self.index_path = path + ".idx"
+        if build_index and not self._index_is_current():
+            write_index(path, self.frames)
+        self._load_index()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def _index_is_current(self):
+        try:
+            return os.path.getmtime(self.index_path) >= os.path.getmtime(self.path)
+        except OSError:
+            return False
+
+    def _load_index(self):
+        self.ids = None
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as f:
+            header = CANIDX_HEADER.unpack(f.read(CANIDX_HEADER.size))
+        (magic, version, _, n_ids, n_frames, n_buckets, t0, bucket_us, ordered) = header
+        if magic != CANIDX_MAGIC or version != CANIDX_VERSION or n_frames != len(self):
+            return  # treat as no index
+
+        offs = CANIDX_HEADER.size
+
+        def array(dtype, count):
+            nonlocal offs
+            if not count:
+                return np.empty(0, dtype)
+            a = np.memmap(self.index_path, dtype, "r", offs, (count,))
+            offs += a.nbytes
+            return a
+
+        self.ids = array("<u4", n_ids)
+        offs += (-offs) % 8  # align
+        self.id_starts = array("<u8", n_ids + 1)
+        self.offsets = array("<u8", n_frames)
+        self.bucket_lo = array("<u8", n_buckets)
+        self.bucket_hi = array("<u8", n_buckets)
+        self.t0 = t0
+        self.bucket_us = bucket_us
+        self.ordered = ordered
+
+    def _require_index(self):
+        if self.ids is None:
+            raise RuntimeError(f"{self.path} has no index")
+
+    def id_offsets(self, can_id):
+        """Return the record offsets of all frames with arbitration ID can_id."""
+        self._require_index()
+        i = np.searchsorted(self.ids, can_id)
+        if i == len(self.ids) or self.ids[i] != can_id:
+            return self.offsets[:0]
+        return self.offsets[self.id_starts[i] : self.id_starts[i + 1]]
+
+    def by_id(self, can_id):
+        """Return all frames with arbitration ID can_id, in log order."""
+        return self.frames[self.id_offsets(can_id)]
+
+    def record_range(self, start=None, end=None):
+        """Return (lo, hi) record offsets covering all frames with start <= timestamp < end
+        (in microseconds). If the log isn't in timestamp order, the range may
+        also include frames outside the time range."""
+        self._require_index()
+        n_buckets = len(self.bucket_lo)
+        if not n_buckets:
+            return 0, 0
+        first = 0 if start is None else max(0, (start - self.t0) // self.bucket_us)
+        last = n_buckets if end is None else min(n_buckets, (end - 1 - self.t0) // self.bucket_us + 1)
+        if first >= last:
+            return 0, 0
+        lo = int(self.bucket_lo[first:last].min())
+        hi = int(self.bucket_hi[first:last].max())
+        if self.ordered and lo < hi:
+            ts = self.frames["timestamp"][lo:hi]
+            if start is not None:
+                lo += int(np.searchsorted(ts, start))
+            if end is not None:
+                hi = lo + int(np.searchsorted(self.frames["timestamp"][lo:hi], end))
+        return lo, max(lo, hi)
+
+    def time_slice(self, start=None, end=None):
+        """Return frames with start <= timestamp < end (in microseconds). This is a
+        view into the file for logs in timestamp order."""
+        lo, hi = self.record_range(start, end)
+        frames = self.frames[lo:hi]
+        if self.ordered:
+            return frames
+        ts = frames["timestamp"]
+        mask = np.ones(len(frames), bool)
+        if start is not None:
+            mask &= ts >= start
+        if end is not None:
+            mask &= ts < end
+        return frames[mask]
+
+
+def write_index(path, frames=None, bucket_us=BUCKET_US):
+    """Build the sidecar index for the canbin log at 'path'."""
+    if frames is None:
+        frames = BinLog(path, build_index=False).frames
+    can_id = np.asarray(frames["can_id"])
+    offsets = np.argsort(can_id, kind="stable").astype("<u8")
+    ids, counts = np.unique(can_id, return_counts=True)
+    id_starts = np.zeros(len(ids) + 1, "<u8")
+    np.cumsum(counts, out=id_starts[1:])
+
+    ts = np.asarray(frames["timestamp"])
+    if len(ts):
+        t0 = int(ts.min())
+        bucket = (ts - t0) // bucket_us
+        n_buckets = int(bucket.max()) + 1
+        records = np.arange(len(ts), dtype="<u8")
+        # empty buckets get an empty range at the end of the previous bucket
+        bucket_lo = np.full(n_buckets, len(ts), "<u8")
+        bucket_hi = np.zeros(n_buckets, "<u8")
+        np.minimum.at(bucket_lo, bucket, records)
+        np.maximum.at(bucket_hi, bucket, records + 1)
+        empty = bucket_lo > bucket_hi
+        bucket_lo[empty] = bucket_hi[empty] = 0
+        ordered = bool((np.diff(ts) >= 0).all())
+    else:
+        t0 = n_buckets = 0
+        bucket_lo = bucket_hi = np.empty(0, "<u8")
+        ordered = True
+
+    with open(path + ".idx", "wb") as f:
+        f.write(
+            CANIDX_HEADER.pack(
+                CANIDX_MAGIC,
+                CANIDX_VERSION,
+                0,
+                len(ids),
+                len(ts),
+                n_buckets,
+                t0,
+                bucket_us,
+                ordered,
+            )
+        )
+        f.write(ids.astype("<u4").tobytes())
+        f.write(b"\x00" * ((-f.tell()) % 8))
+        for a in (id_starts, offsets, bucket_lo, bucket_hi):
+            f.write(a.tobytes())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CAN log conversion tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("convert", help="Convert a log from one format to another")
+    p.add_argument("--from", dest="from_fmt", choices=sorted(READERS))
+    p.add_argument("--to", dest="to_fmt", choices=sorted(WRITERS))
+    p.add_argument("--fd", action="store_true", help="Allow CAN FD (64 byte) payloads")
+    p.add_argument(
+        "--jobs", type=int, default=1, help="Number of processes (0 for one per CPU)"
+    )
+    p.add_argument("input")
+    p.add_argument("output")
+
+    p = sub.add_parser("merge", help="Merge logs in timestamp order")
+    p.add_argument("--to", dest="to_fmt", choices=sorted(WRITERS))
+    p.add_argument("--fd", action="store_true", help="Allow CAN FD (64 byte) payloads")
+    p.add_argument(
+        "--offset",
+        type=float,
+        action="append",
+        help="Clock correction in seconds to add to each input, in input order",
+    )
+    p.add_argument(
+        "--keep-bus",
+        action="store_true",
+        help="Keep the bus numbers in the logs, instead of numbering inputs from 0",
+    )
+    p.add_argument("-o", "--output", required=True)
+    p.add_argument("input", nargs="+")
+
+    p = sub.add_parser("index", help="(Re)build the index of a canbin log")
+    p.add_argument("input", nargs="+")
+
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        dtype = FD_FRAME_DTYPE if args.fd else FRAME_DTYPE
+        jobs = args.jobs or os.cpu_count()
+        count = convert(args.input, args.output, args.from_fmt, args.to_fmt, dtype, jobs)
+        print(f"Converted {count} frames", file=sys.stderr)
+    elif args.command == "merge":
+        dtype = FD_FRAME_DTYPE if args.fd else FRAME_DTYPE
+        if args.offset and len(args.offset) != len(args.input):
+            parser.error("Need one --offset per input")
+        buses = [None] * len(args.input) if args.keep_bus else None
+        count = merge(args.input, args.output, args.to_fmt, args.offset, buses, dtype)
+        print(f"Merged {count} frames", file=sys.stderr)
+    elif args.command == "index":
+        for path in args.input:
+            write_index(path)
+
+
+if __name__ == "__main__":
+    main()
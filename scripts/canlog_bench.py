@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# Benchmark for the python-can stdout log parser in canlog.py, comparing the
+# fixed-layout fast parser with the regex fallback (which used to be the only
+# parser, in log2gvret.py).
+#
+# Synthetic log lines are generated in memory (nothing is written to disk), so
+# the numbers are parsing throughput only.
+#
+# Usage:
+#
+#   canlog_bench.py [--lines N]
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import argparse
+import random
+import time
+
+import canlog
+
+BLOCK_LINES = 1_000_000
+
+
+def synthetic_lines(count, seed=0):
+    """Return 'count' lines in can.logger format, similar to a bench_kona capture."""
+    rnd = random.Random(seed)
+    ids = [rnd.randrange(0x800) for _ in range(100)]
+    ts = 1700000000.0
+    lines = []
+    for _ in range(count):
+        ts += rnd.random() * 0.0005
+        dlc = rnd.choice((8, 8, 8, 8, 6, 4, 3))
+        data = bytes(rnd.randrange(256) for _ in range(dlc)).hex(" ")
+        direction = "Tx" if rnd.random() < 0.1 else "Rx"
+        lines.append(
+            f"Timestamp: {ts:>15.6f}    ID: {rnd.choice(ids):>8x}    S {direction}                "
+            f"DL: {dlc:2d}    {data:<24}    Channel: can{rnd.randrange(2)}\n"
+        )
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=10_000_000)
+    args = parser.parse_args()
+
+    # Generating 10M random lines takes a while, so generate one block and reuse it
+    block = synthetic_lines(min(args.lines, BLOCK_LINES))
+    results = {}
+    for name, fast in (("regex", False), ("fast", True)):
+        remaining = args.lines
+        elapsed = 0
+        while remaining > 0:
+            lines = block[:remaining]
+            t0 = time.perf_counter()
+            for i in range(0, len(lines), canlog.BATCH_SIZE):
+                canlog.parse_pycan_lines(lines[i : i + canlog.BATCH_SIZE], fast=fast)
+            elapsed += time.perf_counter() - t0
+            remaining -= len(lines)
+        results[name] = elapsed
+        print(
+            f"{name:>6}: {args.lines} lines in {elapsed:.2f}s "
+            f"({args.lines / elapsed / 1e6:.2f}M lines/sec)"
+        )
+    print(f"Speedup {results['regex'] / results['fast']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
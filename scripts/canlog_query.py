@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Query tool for CAN logs. Replaces pipelines like:
+#
+#   grep 000010C,false,0 *.csv | sed s/:/,/ | cut -d, -f7- | sort | uniq
+#
+# with:
+#
+#   canlog_query.py --id 0x10c --bus 0 --output unique *.csv
+#
+# Inputs can be in any format supported by canlog.py, but canbin logs are
+# much faster as the index is used to read only the records for the requested
+# IDs and time window (see canlog.BinLog). Other formats are streamed and
+# filtered a batch at a time. Either way results are streamed (or accumulated
+# per ID for 'unique' and 'stats'), so memory use doesn't depend on log size.
+#
+# Filters (all optional, combined with AND):
+#
+# --id ID[,ID...]       Arbitration IDs (hex, can be repeated)
+# --start/--end SECS    Time window, as absolute timestamps in seconds (same as
+#                       the timestamps in the log)
+# --bus N               Bus number
+# --payload VALUE[/MASK]  Hex payload bytes that must match, i.e. data & MASK ==
+#                       VALUE & MASK. MASK defaults to FF for each byte of VALUE.
+#
+# Output (--output):
+#
+# gvret   Matching frames as GVRET CSV (default)
+# unique  Each unique ID and payload with a count, like 'sort | uniq -c'
+# stats   Per ID count, first/last timestamp and mean period
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import argparse
+import sys
+
+import numpy as np
+
+import canlog
+
+OFFSET_CHUNK = 1 << 20  # records read from a canbin log at once
+
+
+class Query:
+    def __init__(self, ids=None, start=None, end=None, bus=None, value=None, mask=None):
+        self.ids = None if ids is None else np.unique(np.array(ids, dtype=np.uint32))
+        # timestamps are integer microseconds
+        self.start = None if start is None else int(round(start * 1e6))
+        self.end = None if end is None else int(round(end * 1e6))
+        self.bus = bus
+        self.value = None
+        if value is not None:
+            if mask is None:
+                mask = b"\xff" * len(value)
+            if len(mask) != len(value):
+                raise ValueError("Payload value and mask must be the same length")
+            self.value = np.frombuffer(value, np.uint8) & np.frombuffer(mask, np.uint8)
+            self.mask = np.frombuffer(mask, np.uint8)
+
+    def match(self, batch):
+        """Return a boolean array of the frames in 'batch' that match."""
+        m = np.ones(len(batch), bool)
+        if self.ids is not None:
+            m &= np.isin(batch["can_id"], self.ids)
+        if self.start is not None:
+            m &= batch["timestamp"] >= self.start
+        if self.end is not None:
+            m &= batch["timestamp"] < self.end
+        if self.bus is not None:
+            m &= batch["bus"] == self.bus
+        if self.value is not None:
+            n = len(self.value)
+            m &= ((batch["data"][:, :n] & self.mask) == self.value).all(axis=1)
+            m &= canlog.payload_lengths(batch) >= n
+        return m
+
+    def run(self, path):
+        """Yield batches of matching frames from the log at 'path'."""
+        if canlog.guess_format(path) == "canbin":
+            batches = self._canbin_candidates(canlog.BinLog(path))
+        else:
+            batches = canlog.read_log(path)
+        for batch in batches:
+            batch = batch[self.match(batch)]
+            if len(batch):
+                yield batch
+
+    def _canbin_candidates(self, log):
+        """Yield batches of frames from an indexed log, reading only the records that
+        could match the ID and time filters."""
+        lo, hi = log.record_range(self.start, self.end)
+        if self.ids is None:
+            for i in range(lo, hi, OFFSET_CHUNK):
+                yield log.frames[i : min(hi, i + OFFSET_CHUNK)]
+            return
+        # Combine the offsets of each ID inside the time window, in log order
+        offsets = [o[(o >= lo) & (o < hi)] for o in (log.id_offsets(i) for i in self.ids)]
+        offsets = np.sort(np.concatenate(offsets)) if offsets else []
+        for i in range(0, len(offsets), OFFSET_CHUNK):
+            yield log.frames[offsets[i : i + OFFSET_CHUNK]]
+
+
+def output_gvret(batches, out):
+    out.write(canlog.GVRET_HEADER + "\n")
+    for batch in batches:
+        for line in canlog.GvretWriter.format_lines(batch):
+            out.write(line.rstrip("\r\n") + "\n")
+
+
+def output_unique(batches, out):
+    counts = {}
+    for batch in batches:
+        # count unique (id, length, payload) rows in numpy, then merge
+        width = batch.dtype["data"].shape[0]
+        key = np.zeros(len(batch), [("can_id", "<u4"), ("len", "u1"), ("data", f"V{width}")])
+        key["can_id"] = batch["can_id"]
+        key["len"] = canlog.payload_lengths(batch)
+        key["data"] = np.ascontiguousarray(batch["data"]).view(key.dtype["data"]).ravel()
+        values, n = np.unique(key, return_counts=True)
+        for (can_id, length, data), count in zip(values.tolist(), n.tolist()):
+            k = (can_id, bytes(data)[:length])
+            counts[k] = counts.get(k, 0) + count
+    for (can_id, data), count in sorted(counts.items()):
+        out.write(f"{can_id:08X},{data.hex().upper()},{count}\n")
+
+
+def output_stats(batches, out):
+    stats = {}  # id -> [count, first, last]
+    for batch in batches:
+        ids, inverse, n = np.unique(batch["can_id"], return_inverse=True, return_counts=True)
+        first = np.full(len(ids), np.iinfo(np.int64).max)
+        last = np.full(len(ids), np.iinfo(np.int64).min)
+        np.minimum.at(first, inverse, batch["timestamp"])
+        np.maximum.at(last, inverse, batch["timestamp"])
+        for can_id, count, f, l in zip(ids.tolist(), n.tolist(), first.tolist(), last.tolist()):
+            s = stats.setdefault(can_id, [0, f, l])
+            s[0] += count
+            s[1] = min(s[1], f)
+            s[2] = max(s[2], l)
+    out.write("ID,Count,First,Last,Mean period (ms)\n")
+    for can_id, (count, first, last) in sorted(stats.items()):
+        period = f"{(last - first) / (count - 1) / 1000:.3f}" if count > 1 else ""
+        out.write(f"{can_id:08X},{count},{first / 1e6:.6f},{last / 1e6:.6f},{period}\n")
+
+
+OUTPUTS = {
+    "gvret": output_gvret,
+    "unique": output_unique,
+    "stats": output_stats,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter and summarise CAN logs")
+    parser.add_argument("--id", action="append", help="Arbitration ID(s), hex")
+    parser.add_argument("--start", type=float, help="Start time (seconds)")
+    parser.add_argument("--end", type=float, help="End time (seconds)")
+    parser.add_argument("--bus", type=int)
+    parser.add_argument("--payload", help="Payload value (hex), with optional /MASK")
+    parser.add_argument("--output", choices=sorted(OUTPUTS), default="gvret")
+    parser.add_argument("logs", nargs="+")
+    args = parser.parse_args()
+
+    ids = None
+    if args.id:
+        ids = [int(i, 16) for arg in args.id for i in arg.split(",")]
+    value = mask = None
+    if args.payload:
+        value, _, mask = args.payload.partition("/")
+        value = bytes.fromhex(value)
+        mask = bytes.fromhex(mask) if mask else None
+
+    query = Query(ids, args.start, args.end, args.bus, value, mask)
+    batches = (b for path in args.logs for b in query.run(path))
+    try:
+        OUTPUTS[args.output](batches, sys.stdout)
+    except BrokenPipeError:
+        pass  # output piped to 'head' or similar
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+#
+# Check the checksum and counter fields of CAN messages, in a log or live on a
+# bus, and report every frame that breaks the rules for its ID: wrong
+# checksum, counter value repeated or counter value skipped, or payload too
+# short to hold the field.
+#
+# Rules are given as options, which can also be put in a file (one option per
+# line) and passed as @FILE:
+#
+# --checksum ID,BYTE,ALGORITHM[,MASK[,START[,END]]]
+#     Field BYTE (bits MASK, default FF) of ID holds the can_checksum.py
+#     ALGORITHM calculated over bytes START (default 0) to END-1 (default the
+#     end of the payload). The field is zeroed first if it's in that range.
+#
+# --counter ID,BYTE,MASK[,DELTA[,SKIP]]
+#     Field BYTE (bits MASK) of ID is a counter stepping by DELTA (default -1,
+#     as per bench_kona's CounterField) and skipping the value SKIP.
+#
+# All numbers are hex except DELTA, START and END. For example, for the Kona
+# IEB 0x153 message:
+#
+#   canvalidate.py --checksum 153,7,SUM8,FF,0,7 --counter 153,6,F0,-1,F LOG
+#
+# Logs (any format supported by canlog.py) are checked a batch at a time with
+# numpy. With --live, frames are read from the default python-can bus and
+# checked one at a time with table lookups (constant cost per frame), until
+# Ctrl-C. Either way each violation is printed (unless --summary) followed by
+# per-ID error counts and rates.
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import argparse
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+import can_checksum
+import canlog
+
+Violation = namedtuple("Violation", ["timestamp", "can_id", "kind", "data"])
+
+KINDS = ("checksum", "repeated", "skipped", "short")
+
+
+def _shift(mask):
+    return (mask & -mask).bit_length() - 1
+
+
+class ChecksumRule:
+    def __init__(self, can_id, byte, algorithm, mask=0xFF, start=0, end=None):
+        self.can_id = can_id
+        self.byte = byte
+        self.algorithm = algorithm
+        self.mask = mask
+        self.shift = _shift(mask)
+        self.start = start
+        self.end = end
+
+    def _covers_field(self, length):
+        end = length if self.end is None else self.end
+        return self.start <= self.byte < end
+
+    def check(self, data):
+        """Return a list of violation kinds for one payload."""
+        if len(data) <= self.byte:
+            return ["short"]
+        covered = bytearray(data[self.start : self.end])
+        if self._covers_field(len(data)):
+            covered[self.byte - self.start] &= ~self.mask
+        expected = (self.algorithm.calc(covered) << self.shift) & self.mask
+        return [] if data[self.byte] & self.mask == expected else ["checksum"]
+
+    def check_batch(self, data, lengths):
+        """Return a dict of violation kind -> boolean array, for payloads with the
+        given lengths (each length is checked separately, as check() would)."""
+        bad = np.zeros(len(data), bool)
+        for length in np.unique(lengths).tolist():
+            rows = lengths == length
+            end = length if self.end is None else min(self.end, length)
+            covered = data[rows, self.start : end].copy()
+            if self._covers_field(length):
+                covered[:, self.byte - self.start] &= 0xFF ^ self.mask
+            expected = (self.algorithm.calc_batch(covered) << self.shift) & self.mask
+            bad[rows] = (data[rows, self.byte] & self.mask) != expected
+        return {"checksum": bad}
+
+
+class CounterRule:
+    def __init__(self, can_id, byte, mask, delta=-1, skip=None):
+        self.can_id = can_id
+        self.byte = byte
+        self.mask = mask
+        self.shift = _shift(mask)
+        size = (mask >> self.shift) + 1
+        # expected next value after each value
+        nxt = [(v + delta) % size for v in range(size)]
+        nxt = [(n + delta) % size if n == skip else n for n in nxt]
+        self.next = np.array(nxt, np.uint8)
+        self._next = bytes(nxt)
+        self.prev = None  # last value seen
+
+    def check(self, data):
+        if len(data) <= self.byte:
+            return ["short"]
+        value = (data[self.byte] & self.mask) >> self.shift
+        prev, self.prev = self.prev, value
+        if prev is None or value == self._next[prev]:
+            return []
+        return ["repeated" if value == prev else "skipped"]
+
+    def check_batch(self, data, lengths):
+        values = (data[:, self.byte] & self.mask) >> self.shift
+        if not len(values):
+            return {"repeated": values != 0, "skipped": values != 0}
+        first = self.prev is None
+        prev = np.empty_like(values)
+        prev[1:] = values[:-1]
+        prev[0] = values[0] if first else self.prev
+        self.prev = values[-1]
+        bad = values != self.next[prev]
+        if first:
+            bad[0] = False  # nothing to compare the first frame with
+        repeated = values == prev
+        return {"repeated": bad & repeated, "skipped": bad & ~repeated}
+
+
+class Validator:
+    """Checks frames against a list of rules, counting frames and violations per ID."""
+
+    def __init__(self, rules):
+        self.rules = {}
+        for r in rules:
+            self.rules.setdefault(r.can_id, []).append(r)
+        self.ids = np.array(sorted(self.rules), np.uint32)
+        # shortest payload which holds every field of the ID's rules
+        self.min_length = {i: max(r.byte for r in rs) + 1 for i, rs in self.rules.items()}
+        self.frames = {i: 0 for i in self.rules}
+        self.errors = {i: dict.fromkeys(KINDS, 0) for i in self.rules}
+
+    def check_message(self, msg):
+        """Check a can.Message, returning a list of violation kinds."""
+        rules = self.rules.get(msg.arbitration_id)
+        if rules is None:
+            return []
+        self.frames[msg.arbitration_id] += 1
+        if len(msg.data) < self.min_length[msg.arbitration_id]:
+            kinds = ["short"]
+        else:
+            kinds = [k for r in rules for k in r.check(msg.data)]
+        for k in kinds:
+            self.errors[msg.arbitration_id][k] += 1
+        return kinds
+
+    def check_batch(self, batch):
+        """Check a batch of frames (in log order), returning a list of Violation."""
+        batch = batch[np.isin(batch["can_id"], self.ids)]
+        order = np.argsort(batch["can_id"], kind="stable")
+        batch = batch[order]
+        batch_ids, starts = np.unique(batch["can_id"], return_index=True)
+        ends = np.append(starts[1:], len(batch))
+        violations = []
+        for can_id, s, e in zip(batch_ids.tolist(), starts.tolist(), ends.tolist()):
+            frames = batch[s:e]
+            self.frames[can_id] += len(frames)
+            lengths = canlog.payload_lengths(frames)
+            # frames too short for the rules' fields are one violation each, and
+            # aren't checked (so they don't break the counter sequence)
+            short = lengths < self.min_length[can_id]
+            results = [{"short": short}]
+            for rule in self.rules[can_id]:
+                found = rule.check_batch(frames["data"][~short], lengths[~short])
+                for kind, bad in found.items():
+                    full = np.zeros(len(frames), bool)
+                    full[~short] = bad
+                    results.append({kind: full})
+            for result in results:
+                for kind, bad in result.items():
+                    self.errors[can_id][kind] += int(bad.sum())
+                    for f, n in zip(frames[bad], lengths[bad].tolist()):
+                        data = bytes(f["data"][:n])
+                        violations.append(Violation(int(f["timestamp"]), can_id, kind, data))
+        violations.sort(key=lambda v: v.timestamp)
+        return violations
+
+    def summary(self, out=sys.stdout):
+        out.write(f"{'ID':>8} {'Frames':>9} " + " ".join(f"{k:>9}" for k in KINDS))
+        out.write(f" {'Rate':>8}\n")
+        for can_id in sorted(self.rules):
+            frames = self.frames[can_id]
+            errors = self.errors[can_id]
+            rate = sum(errors.values()) / frames if frames else 0
+            counts = " ".join(f"{errors[k]:>9}" for k in KINDS)
+            out.write(f"{can_id:>8X} {frames:>9} {counts} {rate:>8.3%}\n")
+
+
+def parse_checksum(arg):
+    fields = arg.split(",")
+    can_id, byte, algorithm = int(fields[0], 16), int(fields[1]), fields[2]
+    if algorithm not in can_checksum.ALGORITHMS:
+        raise argparse.ArgumentTypeError(
+            f"Unknown algorithm {algorithm}, known: {', '.join(can_checksum.ALGORITHMS)}"
+        )
+    mask = int(fields[3], 16) if len(fields) > 3 else 0xFF
+    start = int(fields[4]) if len(fields) > 4 else 0
+    end = int(fields[5]) if len(fields) > 5 else None
+    return ChecksumRule(can_id, byte, can_checksum.ALGORITHMS[algorithm], mask, start, end)
+
+
+def parse_counter(arg):
+    fields = arg.split(",")
+    can_id, byte, mask = int(fields[0], 16), int(fields[1]), int(fields[2], 16)
+    delta = int(fields[3]) if len(fields) > 3 else -1
+    skip = int(fields[4], 16) if len(fields) > 4 else None
+    return CounterRule(can_id, byte, mask, delta, skip)
+
+
+def print_violation(v):
+    print(f"{v.timestamp / 1e6:.6f} {v.can_id:X} {v.kind} {v.data.hex().upper()}")
+
+
+def validate_logs(validator, paths, quiet=False):
+    for path in paths:
+        for batch in canlog.read_log(path):
+            for v in validator.check_batch(batch):
+                if not quiet:
+                    print_violation(v)
+
+
+def validate_live(validator, quiet=False):
+    import can
+
+    with can.Bus() as bus:
+        bus.set_filters([{"can_id": int(i), "can_mask": 0x1FFFFFFF} for i in validator.ids])
+        try:
+            while True:
+                msg = bus.recv(1.0)
+                if msg is None:
+                    continue
+                for kind in validator.check_message(msg):
+                    if not quiet:
+                        v = Violation(int(msg.timestamp * 1e6), msg.arbitration_id, kind, msg.data)
+                        print_violation(v)
+        except KeyboardInterrupt:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check CAN message checksums and counters", fromfile_prefix_chars="@"
+    )
+    parser.add_argument("--checksum", type=parse_checksum, action="append", default=[])
+    parser.add_argument("--counter", type=parse_counter, action="append", default=[])
+    parser.add_argument("--live", action="store_true", help="Check the default python-can bus")
+    parser.add_argument("--summary", action="store_true", help="Only print the summary")
+    parser.add_argument("logs", nargs="*")
+    args = parser.parse_args()
+
+    if not args.checksum and not args.counter:
+        parser.error("No rules given")
+    if args.live == bool(args.logs):
+        parser.error("Need either --live or one or more logs")
+
+    validator = Validator(args.checksum + args.counter)
+    if args.live:
+        validate_live(validator, args.summary)
+    else:
+        validate_logs(validator, args.logs, args.summary)
+    validator.summary()
+
+
+if __name__ == "__main__":
+    main()
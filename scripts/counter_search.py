@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# Find the counter fields of each ID in CAN logs, and print them as
+# CounterField parameters (see hyundai_kona_ev/bench_kona/message.py) with a
+# confidence score. Finds offline what bmw_gws.find_counter_fields() has to
+# find by trial with a live ECU.
+#
+# Every contiguous bit range within each byte is tested. For each one a
+# histogram is kept of the step (modulo the field size) between consecutive
+# frames of the ID, along with which values were seen. A counter has one
+# dominant step, sometimes twice that step where it passes over a skipped
+# value, and visits every value in its cycle except the skipped value.
+#
+# Fields where at least --threshold of the steps match are reported. Confidence
+# is the fraction of steps that match, reduced if fewer than MIN_CYCLES full
+# cycles of the counter were seen.
+#
+# Input is either logs (any format supported by canlog.py, processed a batch
+# at a time) or a table of unique payloads and transitions saved by
+# payload_table.py (--table), which is much faster to load.
+#
+# Usage:
+#
+#   counter_search.py [--id ID[,ID...]] [--bus N] [--threshold F] LOG [...]
+#   counter_search.py [--id ID[,ID...]] [--threshold F] --table TABLE.npz
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import argparse
+import math
+from collections import namedtuple
+
+import numpy as np
+
+import canlog
+
+ROW_CHUNK = 4096  # rows processed at once, bounds temporary arrays
+MIN_CYCLES = 4
+
+
+def _counter_fields():
+    fields = [
+        (byte, shift, width)
+        for byte in range(8)
+        for shift in range(8)
+        for width in range(1, 9 - shift)
+    ]
+    return tuple(np.array(c) for c in zip(*fields))
+
+
+# Candidate counter fields: every contiguous bit field within each byte
+CF_BYTE, CF_SHIFT, CF_WIDTH = _counter_fields()
+CF_MASK = ((1 << CF_WIDTH) - 1).astype(np.uint8)  # after shifting
+N_CF = len(CF_BYTE)
+
+Counter = namedtuple(
+    "Counter", ["byte", "mask", "delta", "skip", "cycle", "steps", "confidence"]
+)
+
+
+def _field_values(rows):
+    return (rows[:, CF_BYTE] >> CF_SHIFT.astype(np.uint8)) & CF_MASK
+
+
+class CounterStats:
+    """Step histograms and seen values for every candidate counter field of one ID."""
+
+    def __init__(self):
+        self.steps = np.zeros((N_CF, 256), np.int64)
+        self.seen = np.zeros((N_CF, 256), bool)
+        self._base = np.arange(N_CF) * 256
+
+    def update(self, rows):
+        """Add consecutive payloads, as an (n, 8) uint8 array."""
+        for i in range(0, max(len(rows) - 1, 1), ROW_CHUNK):
+            chunk = rows[i : i + ROW_CHUNK + 1]
+            self.add_values(chunk)
+            self.add_transitions(chunk[:-1], chunk[1:])
+
+    def add_values(self, rows):
+        self.seen.ravel()[(self._base + _field_values(rows)).ravel()] = True
+
+    def add_transitions(self, src, dst, counts=None):
+        """Add steps from each payload in 'src' to the next payload in 'dst', each
+        seen 'counts' times (default once)."""
+        step = (_field_values(dst) - _field_values(src)) & CF_MASK
+        weights = None if counts is None else np.repeat(counts, N_CF)
+        self.steps += np.bincount(
+            (self._base + step).ravel(), weights, N_CF * 256
+        ).astype(np.int64).reshape(N_CF, 256)
+
+    def counters(self, min_steps=16, threshold=0.99):
+        """Return a list of Counter for the counter fields found, where at least
+        'threshold' of the steps match the counter.
+
+        A counter field only contains bits which vary, steps by the same amount
+        every frame (or twice that amount, when it passes a skipped value) and
+        visits every value in its cycle except at most one skipped value. Where
+        fields overlap the widest is returned.
+
+        A sum checksum over a counter (e.g. in the other nibble of the
+        counter's byte) also steps like a counter, but takes irregular steps
+        whenever other data changes. So where fields in the same byte have the
+        same step and cycle, only those with the fewest irregular steps are
+        returned (if there's no other data that changes it's not possible to
+        tell them apart, and all are returned). Fields in different bytes are
+        all returned, as a message can have more than one counter."""
+        found = []
+        taken = np.zeros(8, np.int64)  # bits of each byte in a counter already
+        # single bit fields are first for each bit, so this is each bit's values
+        bits_seen = self.seen[CF_WIDTH == 1, :2].reshape(8, 8, 2)
+        varying = bits_seen.all(axis=2)
+        for cf in np.argsort(-CF_WIDTH, kind="stable").tolist():
+            steps = self.steps[cf]
+            total = int(steps.sum())
+            if total < min_steps:
+                continue
+            byte, shift, width = int(CF_BYTE[cf]), int(CF_SHIFT[cf]), int(CF_WIDTH[cf])
+            mask = ((1 << width) - 1) << shift
+            if taken[byte] & mask or not varying[byte, shift : shift + width].all():
+                continue
+            size = 1 << width
+            step = int(np.argmax(steps[1:size])) + 1
+            double = (step * 2) % size
+            skips = int(steps[double]) if double not in (0, step) else 0
+            regular = int(steps[step]) + skips
+            if steps[step] < total / 2 or regular < total * threshold:
+                continue
+            seen = self.seen[cf]
+            start = int(np.argmax(seen))
+            cycle = (start + step * np.arange(size // math.gcd(step, size))) % size
+            unseen = cycle[~seen[cycle]]
+            if len(unseen) > 1 or (len(unseen) == 1 and not skips):
+                continue
+            confidence = regular / total * min(1.0, total / (MIN_CYCLES * len(cycle)))
+            skip = int(unseen[0]) if len(unseen) else None
+            delta = step if step <= size // 2 else step - size
+            found.append(Counter(byte, mask, delta, skip, len(cycle), total, confidence))
+            taken[byte] |= mask
+        best = {}
+        for c in found:
+            k = (c.byte, c.delta, c.cycle)
+            best[k] = max(best.get(k, 0), c.confidence)
+        return sorted(c for c in found if c.confidence == best[c.byte, c.delta, c.cycle])
+
+
+def stats_from_logs(paths, ids=None, bus=None):
+    """Return a dict of can_id -> CounterStats for the frames in the logs."""
+    stats = {}
+    for path in paths:
+        last = {}  # can_id -> last payload, within this log
+        for batch in canlog.read_log(path):
+            if ids is not None:
+                batch = batch[np.isin(batch["can_id"], ids)]
+            if bus is not None:
+                batch = batch[batch["bus"] == bus]
+            order = np.argsort(batch["can_id"], kind="stable")
+            batch = batch[order]
+            batch_ids, starts = np.unique(batch["can_id"], return_index=True)
+            ends = np.append(starts[1:], len(batch))
+            for can_id, s, e in zip(batch_ids.tolist(), starts.tolist(), ends.tolist()):
+                rows = np.ascontiguousarray(batch["data"][s:e, :8])
+                if can_id in last:
+                    rows = np.concatenate((last[can_id][None], rows))
+                last[can_id] = rows[-1]
+                stats.setdefault(can_id, CounterStats()).update(rows)
+    return stats
+
+
+def stats_from_table(table, ids=None):
+    """Return a dict of can_id -> CounterStats from a payload_table.PayloadTable."""
+    stats = {}
+    for can_id in table.ids():
+        if ids is not None and can_id not in ids:
+            continue
+        payloads, counts = table.unique(can_id)
+        if not len(payloads):
+            continue
+        length = payloads.shape[1]
+        rows = np.zeros((len(payloads), 8), np.uint8)
+        rows[:, :length] = payloads[:, :8]
+        s = CounterStats()
+        s.add_values(rows)
+        index = {bytes(p): i for i, p in enumerate(payloads.tolist())}
+        transitions = [
+            (index[src], index[dst], n)
+            for (i, src, dst), n in table.transitions.items()
+            if i == can_id and src in index and dst in index
+        ]
+        if transitions:
+            src, dst, n = (np.array(x) for x in zip(*transitions))
+            s.add_transitions(rows[src], rows[dst], n)
+            # frames which repeated the previous payload
+            s.steps[:, 0] += max(int(counts.sum()) - 1 - int(n.sum()), 0)
+        stats[can_id] = s
+    return stats
+
+
+def format_counter(c):
+    args = f"self.data, {c.byte}, 0x{c.mask:02X}"
+    if c.delta != -1:
+        args += f", delta={c.delta}"
+    if c.skip is not None:
+        args += f", skip=0x{c.skip:X}"
+    return f"CounterField({args})"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find counter fields in CAN logs")
+    parser.add_argument("--id", action="append", help="Only these arbitration ID(s), hex")
+    parser.add_argument("--bus", type=int)
+    parser.add_argument(
+        "--threshold", type=float, default=0.9, help="Minimum fraction of steps which match"
+    )
+    parser.add_argument("--table", help="Payload table from payload_table.py")
+    parser.add_argument("logs", nargs="*")
+    args = parser.parse_args()
+
+    ids = None
+    if args.id:
+        ids = [int(i, 16) for arg in args.id for i in arg.split(",")]
+    if args.table:
+        from payload_table import PayloadTable
+
+        stats = stats_from_table(PayloadTable.load(args.table), ids)
+    elif args.logs:
+        stats = stats_from_logs(args.logs, ids, args.bus)
+    else:
+        parser.error("Need --table or one or more logs")
+
+    print(
+        f"{'ID':>8} {'Byte':>4} {'Mask':>4} {'Delta':>5} {'Skip':>4} {'Cycle':>5} "
+        f"{'Steps':>8} {'Conf':>5}  CounterField"
+    )
+    for can_id, s in sorted(stats.items()):
+        for c in s.counters(threshold=args.threshold):
+            skip = "-" if c.skip is None else f"{c.skip:X}"
+            print(
+                f"{can_id:>8X} {c.byte:>4} {c.mask:>4X} {c.delta:>5} {skip:>4} {c.cycle:>5} "
+                f"{c.steps:>8} {c.confidence:>5.3f}  {format_counter(c)}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+#
+# Search for the checksum algorithm of a CAN message, given logged samples.
+# Generalises the one-off hypothesis scripts in hyundai_kona_ev/checksums/.
+#
+# Takes all the unique payloads of one ID and tries every checksum field (each
+# byte, and each nibble, of the payload) against these algorithms:
+#
+# - sum, nibble sum, XOR or nibble XOR of a contiguous range of bytes, with
+#   the result added to a constant, subtracted from a constant (i.e. negated or
+#   complemented, plus an offset) or XORed with a constant.
+# - CRC-8 (for byte fields) or CRC-4 (for nibble fields) of a contiguous range
+#   of bytes, for every polynomial, reflected input and/or output, and any
+#   init and xorout.
+#
+# The checksum field itself is zeroed when it's inside the range of covered
+# bytes. All matching algorithms are printed.
+#
+# Every algorithm is a function of the covered bytes combined with an unknown
+# constant, so each one is tested by calculating it (with offset/init/xorout
+# zero) for all samples at once with numpy and checking that the difference
+# from the checksum field is the same for every sample. This also gives the
+# constant, so init and xorout don't need to be searched. CRCs are stepped a
+# byte at a time across all polynomials at once (with a table per polynomial),
+# extending the covered range, on a screening subset of samples chosen to be as
+# different from each other as possible. Survivors are checked against the rest
+# of the samples in growing chunks, rejecting at the first mismatch.
+#
+# Fields are searched in parallel with --jobs (default: one per CPU) and the
+# results for each field are printed as soon as it's done, with progress on
+# stderr.
+#
+# Sums only report byte ranges that start and end with a byte that varies,
+# as constant bytes on either end only change the offset. Likewise CRCs only
+# report ranges that start with a byte that varies, as constant leading bytes
+# only change the init.
+#
+# Usage:
+#
+#   csum_search.py [--jobs N] --id ID [--bus N] LOG [...]
+#   csum_search.py [--jobs N] --payloads FILE
+#   csum_search.py [--jobs N] --payloads TABLE.npz --id ID
+#
+# --payloads reads one payload per line in hex, either alone or as the second
+# field of a CSV line (as in the output of 'canlog_query.py --output unique'),
+# or the payloads of an ID from a table saved by payload_table.py.
+#
+# With few samples many algorithms will match by chance, at least a few dozen
+# unique payloads with varying data are needed for a useful result.
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import argparse
+import os
+import sys
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import canlog
+from payload_table import PayloadTable
+
+SCREEN_SAMPLES = 64
+
+Match = namedtuple("Match", ["byte", "mask", "algorithm", "start", "end", "description"])
+
+FIELDS = [(0xFF, 0, ""), (0x0F, 0, " low nibble"), (0xF0, 4, " high nibble")]
+
+# Bit reversal of each byte value
+REV8 = np.array([int(f"{i:08b}"[::-1], 2) for i in range(256)], np.uint8)
+REV4 = np.array([int(f"{i:04b}"[::-1], 2) for i in range(16)], np.uint8)
+
+
+def _crc_tables(width):
+    """Return a (2**width, 2**width) table of register values after shifting in
+    'width' zero bits, for each (non-reflected) polynomial and register value."""
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    poly = np.arange(1 << width)[:, None]
+    reg = np.tile(np.arange(1 << width), (1 << width, 1))
+    for _ in range(width):
+        reg = np.where(reg & top, ((reg << 1) & mask) ^ poly, (reg << 1) & mask)
+    return reg.astype(np.uint8)
+
+
+CRC8_TABLES = _crc_tables(8)
+CRC4_TABLES = _crc_tables(4)
+
+
+def _crc_units(data, width, reflect):
+    """Return the (n, units) array of values shifted into the CRC register:
+    bytes for CRC-8 or nibbles (high first) for CRC-4."""
+    if reflect:
+        data = REV8[data]
+    if width == 8:
+        return data
+    return np.stack((data >> 4, data & 0x0F), axis=2).reshape(len(data), -1)
+
+
+def _crc_step(table, reg, units):
+    """Shift one unit per sample into 'reg' (polys, n), for every polynomial."""
+    return table[np.arange(len(table))[:, None], reg ^ units[None, :]]
+
+
+def _zero_crc(table, poly, init, units):
+    """Return the register after shifting 'units' zero units into 'init'."""
+    reg = init
+    for _ in range(units):
+        reg = int(table[poly, reg])
+    return reg
+
+
+def unique_payloads(batches, can_id, bus=None):
+    """Return a (n, length) array of the unique payloads of 'can_id', for the most
+    common payload length."""
+    rows = {}
+    for batch in batches:
+        batch = batch[batch["can_id"] == can_id]
+        if bus is not None:
+            batch = batch[batch["bus"] == bus]
+        for length in np.unique(canlog.payload_lengths(batch)).tolist():
+            b = batch[canlog.payload_lengths(batch) == length]
+            u = np.unique(b["data"][:, :length], axis=0)
+            rows.setdefault(length, []).append(u)
+    if not rows:
+        return np.zeros((0, 0), np.uint8)
+    length = max(rows, key=lambda k: sum(len(u) for u in rows[k]))
+    return np.unique(np.concatenate(rows[length]), axis=0)
+
+
+def _varying(data):
+    return (data != data[:1]).any(axis=0)
+
+
+def _constant(values):
+    """Return a boolean array of which columns of 'values' are all equal."""
+    return (values == values[:1]).all(axis=0)
+
+
+def search_sums(payloads, byte, mask, shift):
+    """Yield a Match for each sum/XOR algorithm for the field (byte, mask)."""
+    cs = ((payloads[:, byte, None] & mask) >> shift).astype(np.int64)
+    modulus = (mask >> shift) + 1
+    data = payloads.astype(np.int64)
+    data[:, byte] &= 0xFF ^ mask
+    varying = _varying(data)
+    n, length = data.shape
+
+    pairs = [(a, b) for a in range(length) for b in range(a + 1, length + 1)]
+    pairs = [(a, b) for a, b in pairs if varying[a] and varying[b - 1]]
+    if not pairs:
+        return
+    start, end = (np.array(x) for x in zip(*pairs))
+
+    nibble_sums = (data & 0x0F) + (data >> 4)
+    nibble_xors = (data & 0x0F) ^ (data >> 4)
+    zero = np.zeros((n, 1), np.int64)
+    for name, values in (
+        ("sum", data),
+        ("nibble sum", nibble_sums),
+        ("XOR", data),
+        ("nibble XOR", nibble_xors),
+    ):
+        if "XOR" in name:
+            prefix = np.concatenate((zero, np.bitwise_xor.accumulate(values, axis=1)), axis=1)
+            s = prefix[:, end] ^ prefix[:, start]
+        else:
+            prefix = np.concatenate((zero, np.cumsum(values, axis=1)), axis=1)
+            s = prefix[:, end] - prefix[:, start]
+        for fmt, k in (
+            ("{name} + 0x{k:X}", (cs - s) % modulus),
+            ("0x{k:X} - {name}", (cs + s) % modulus),
+            ("{name} ^ 0x{k:X}", (cs ^ s) % modulus),
+        ):
+            for i in np.nonzero(_constant(k))[0].tolist():
+                a, b = int(start[i]), int(end[i])
+                desc = fmt.format(name=f"{name} of bytes {a}-{b - 1}", k=int(k[0, i]))
+                if modulus < 256:
+                    desc = f"({desc}) & 0xF"
+                yield Match(byte, mask, name, a, b, desc)
+
+
+def search_crcs(payloads, byte, mask, shift):
+    """Yield a Match for each CRC-8 (or CRC-4, for nibble fields) algorithm for the
+    field (byte, mask)."""
+    width = 8 if mask == 0xFF else 4
+    table = CRC8_TABLES if width == 8 else CRC4_TABLES
+    rev = REV8 if width == 8 else REV4
+    cs = ((payloads[:, byte] & mask) >> shift).astype(np.uint8)
+    data = payloads.copy()
+    data[:, byte] &= 0xFF ^ mask
+    varying = _varying(data)
+    n, length = data.shape
+    per_byte = 8 // width  # register units per byte
+    screen = slice(0, SCREEN_SAMPLES)
+
+    for refin in (False, True):
+        units = _crc_units(data, width, refin)
+        for refout in (False, True):
+            # the register is calculated in normal bit order, so compare with
+            # the reflected checksum if the output is reflected
+            target = rev[cs] if refout else cs
+            for a in range(length):
+                if not varying[a]:
+                    continue
+                reg = np.zeros((len(table), min(n, SCREEN_SAMPLES)), np.uint8)
+                for b in range(a, length):
+                    for u in range(b * per_byte, (b + 1) * per_byte):
+                        reg = _crc_step(table, reg, units[screen, u])
+                    k = reg ^ target[None, screen]
+                    for poly in np.nonzero(_constant(k.T))[0].tolist():
+                        if poly == 0:
+                            continue
+                        k = _verify_crc(table, poly, units, target, a, b + 1, per_byte)
+                        if k is None:
+                            continue
+                        units_covered = (b + 1 - a) * per_byte
+                        desc = _describe_crc(table, poly, width, refin, refout, k, units_covered)
+                        yield Match(
+                            byte, mask, f"CRC-{width}", a, b + 1, f"{desc} of bytes {a}-{b}"
+                        )
+
+
+def _verify_crc(table, poly, units, target, start, end, per_byte):
+    """Return the constant (normal bit order) if the CRC matches for all samples.
+
+    Samples are checked in chunks of increasing size, stopping at the first
+    chunk with a mismatch."""
+    k0 = None
+    lo, size = 0, SCREEN_SAMPLES
+    while lo < len(units):
+        rows = slice(lo, lo + size)
+        reg = np.zeros(len(units[rows]), np.uint8)
+        for u in range(start * per_byte, end * per_byte):
+            reg = table[poly, reg ^ units[rows, u]]
+        k = reg ^ target[rows]
+        if k0 is None:
+            k0 = k[0]
+        if (k != k0).any():
+            return None
+        lo, size = lo + size, size * 4
+    return int(k0)
+
+
+def _describe_crc(table, poly, width, refin, refout, k, units):
+    """Describe a CRC with the xorout needed for an init of zero and all ones."""
+    rev = REV8 if width == 8 else REV4
+    ones = (1 << width) - 1
+    params = []
+    for init in (0, ones):
+        # contribution of init to the register, then xorout to get the checksum
+        xorout = k ^ _zero_crc(table, poly, init, units)
+        if refout:
+            xorout = int(rev[xorout])
+        params.append(f"init 0x{init:X} xorout 0x{xorout:X}")
+    name = f"CRC-{width} poly 0x{poly:X}"
+    if refin and refout:
+        name += " reflected"
+    elif refin or refout:
+        name += f" refin={refin} refout={refout}"
+    return f"{name} ({' or '.join(params)})"
+
+
+def order_samples(payloads, count=SCREEN_SAMPLES):
+    """Return 'payloads' reordered so the first 'count' samples are as different
+    from each other as possible (by Hamming distance), so they reject the most
+    wrong algorithms when used for screening."""
+    bits = np.unpackbits(payloads, axis=1)
+    chosen = [0]
+    distance = (bits != bits[0]).sum(axis=1)
+    for _ in range(min(count, len(payloads)) - 1):
+        i = int(np.argmax(distance))
+        if distance[i] == 0:
+            break
+        chosen.append(i)
+        distance = np.minimum(distance, (bits != bits[i]).sum(axis=1))
+    rest = np.ones(len(payloads), bool)
+    rest[chosen] = False
+    return np.concatenate((payloads[chosen], payloads[rest]))
+
+
+def _search_field(payloads, byte, mask, shift):
+    return list(search_sums(payloads, byte, mask, shift)) + list(
+        search_crcs(payloads, byte, mask, shift)
+    )
+
+
+def search(payloads, jobs=1, progress=None):
+    """Yield a list of Match for every algorithm found for each field of the payload
+    which has more than one value, as each field is searched.
+
+    If 'jobs' > 1 fields are searched in parallel processes. 'progress' is
+    called with (fields searched, total fields) after each one."""
+    payloads = order_samples(payloads)
+    fields = [
+        (byte, mask, shift)
+        for byte in range(payloads.shape[1])
+        for mask, shift, _ in FIELDS
+        if not _constant(payloads[:, byte] & mask)
+    ]
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs) as executor:
+            futures = [executor.submit(_search_field, payloads, *f) for f in fields]
+            results = (f.result() for f in as_completed(futures))
+            for done, matches in enumerate(results, 1):
+                if progress:
+                    progress(done, len(fields))
+                yield matches
+    else:
+        for done, f in enumerate(fields, 1):
+            matches = _search_field(payloads, *f)
+            if progress:
+                progress(done, len(fields))
+            yield matches
+
+
+def read_payloads(path):
+    rows = []
+    with open(path) as f:
+        for line in f:
+            fields = line.strip().split(",")
+            if fields[0]:
+                rows.append(bytes.fromhex(fields[1] if len(fields) > 1 else fields[0]))
+    lengths = Counter(len(r) for r in rows)
+    length = lengths.most_common(1)[0][0]
+    rows = [list(r) for r in rows if len(r) == length]
+    return np.unique(np.array(rows, np.uint8), axis=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search for CAN message checksum algorithms")
+    parser.add_argument("--id", type=lambda x: int(x, 16))
+    parser.add_argument("--bus", type=int)
+    parser.add_argument("--payloads", help="File of hex payloads")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Parallel processes")
+    parser.add_argument("logs", nargs="*")
+    args = parser.parse_args()
+
+    if args.payloads and args.payloads.endswith(".npz"):
+        if args.id is None:
+            parser.error("Need --id ID to read payloads from a table")
+        payloads, _ = PayloadTable.load(args.payloads).unique(args.id)
+    elif args.payloads:
+        payloads = read_payloads(args.payloads)
+    elif args.id is not None and args.logs:
+        batches = (b for path in args.logs for b in canlog.read_log(path))
+        payloads = unique_payloads(batches, args.id, args.bus)
+    else:
+        parser.error("Need --payloads FILE or --id ID and one or more logs")
+
+    print(f"{len(payloads)} unique payloads of length {payloads.shape[1]}")
+    if len(payloads) < 2:
+        return
+    names = {mask: name for mask, _, name in FIELDS}
+
+    def progress(done, total):
+        print(f"Searched {done}/{total} fields", file=sys.stderr)
+
+    for matches in search(payloads, args.jobs, progress):
+        for m in matches:
+            print(f"byte {m.byte}{names[m.mask]} = {m.description}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+# Concurrent diagnostic ID scanning with asyncio, for finding which CAN IDs have
+# a diagnostic (ISO-TP, KWP2000 or UDS) interface.
+#
+# scan_tester_present(bus, txids) sends a single frame Tester Present request
+# to many TXIDs at once, keeping up to 'window' requests in flight. One task
+# reads every frame from the bus and matches responses to requests by RXID
+# (TXID + rx_offset), so responses are handled as they arrive. Only positive
+# or negative responses to Tester Present count, unless any_response is set,
+# when any ISO-TP single or first frame from the RXID counts.
+#
+# The timeout for each request starts at 'timeout' and then adapts to the
+# response times seen so far (RESPONSE_TIME_FACTOR times the slowest), freeing
+# up the window sooner on a fast bus. A response that arrives after its
+# request timed out is still counted, and the scan waits 'timeout' after the
+# last request for any stragglers, so nothing that would respond within
+# 'timeout' to a lone request is missed.
+#
+# scan_responders() is for ECUs whose response ID isn't known in advance (see
+# outlander_dtc.scan_ecus()). It sends a probe frame to each TXID at a fixed
+# rate ('interval' apart), and records every matching reply on any ID. Each
+# reply is then attributed to one of the probes sent in the 'timeout' before it,
+# trying first the TXIDs at the same offset from the reply ID as ECUs already
+# found, then those within NEAR_ID of it, then the rest (each group in order of
+# how typical the response time would be), and confirming each with a lone
+# probe ('verify'). Replies
+# already explained by a confirmed TXID aren't verified again, so only a few
+# lone probes are needed per ECU.
+#
+# Usage (see also kona.scan_tester_present()):
+#
+#   import can, diag_scan
+#   found = diag_scan.scan_tester_present(can.Bus(), range(0x700, 0x7F7))
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import asyncio
+
+import can
+
+TESTER_PRESENT = b"\x3E\x00"  # UDS style, with the sub-function byte
+
+RESPONSE_TIME_FACTOR = 4  # timeout is this many times the slowest response seen
+MIN_RESPONSES = 3  # before adapting the timeout
+
+NEAR_ID = 0x10  # reply IDs this close to a TXID are most likely its reply
+
+
+def single_frame(request, padding=0):
+    """Return the 8 byte ISO-TP single frame holding 'request'."""
+    assert len(request) <= 7
+    return bytes([len(request)]) + request + bytes([padding] * (7 - len(request)))
+
+
+def is_response(data, service_id=None):
+    """Return True if 'data' is an ISO-TP single or first frame holding a positive
+    or negative response to 'service_id' (or any payload, if None)."""
+    if len(data) < 2:
+        return False
+    pci = data[0] >> 4
+    if pci == 0:
+        payload = data[1:]
+    elif pci == 1 and len(data) >= 3:
+        payload = data[2:]
+    else:
+        return False
+    if service_id is None:
+        return True
+    if payload[0] == service_id + 0x40:
+        return True
+    return payload[0] == 0x7F and len(payload) > 1 and payload[1] == service_id
+
+
+def covering_filter(can_ids):
+    """Return a single python-can filter which passes all of 'can_ids' (and maybe
+    some others)."""
+    can_ids = list(can_ids)
+    same = 0x7FF
+    for i in can_ids:
+        same &= ~(i ^ can_ids[0])
+    return {"can_id": can_ids[0] & same, "can_mask": same, "extended": False}
+
+
+class AdaptiveTimeout:
+    """Response timeout which shrinks to fit the response times seen."""
+
+    def __init__(self, timeout, min_timeout):
+        self.timeout = timeout
+        self.min_timeout = min_timeout
+        self.responses = 0
+        self.slowest = 0.0
+
+    def add(self, response_time):
+        self.responses += 1
+        self.slowest = max(self.slowest, response_time)
+
+    def __float__(self):
+        if self.responses < MIN_RESPONSES:
+            return self.timeout
+        t = self.slowest * RESPONSE_TIME_FACTOR
+        return min(self.timeout, max(self.min_timeout, t))
+
+
+async def sweep(
+    bus,
+    txids,
+    request=TESTER_PRESENT,
+    rx_offset=8,
+    window=64,
+    timeout=0.2,
+    min_timeout=0.02,
+    any_response=False,
+):
+    """Send 'request' to each of 'txids' and return a dict of txid -> (response
+    data, response time in seconds) for each one which responded. With
+    'any_response', any ISO-TP frame from the RXID counts as a response, not
+    only responses to the request's service."""
+    loop = asyncio.get_running_loop()
+    txids = list(txids)
+    if not txids:
+        return {}
+    by_rxid = {txid + rx_offset: txid for txid in txids}
+    frame = single_frame(request)
+    service_id = None if any_response else request[0]
+    sent = {}  # txid -> time sent
+    waiting = {}  # txid -> future, while waiting for the response
+    found = {}
+    adaptive = AdaptiveTimeout(timeout, min_timeout)
+
+    old_filters = bus.filters
+    bus.filters = [covering_filter(by_rxid)]
+    reader = can.AsyncBufferedReader()
+    notifier = can.Notifier(bus, [reader], loop=loop)
+
+    async def receive():
+        async for msg in reader:
+            now = loop.time()
+            txid = by_rxid.get(msg.arbitration_id)
+            if txid not in sent or txid in found or not is_response(msg.data, service_id):
+                continue
+            found[txid] = (bytes(msg.data), now - sent[txid])
+            adaptive.add(now - sent[txid])
+            f = waiting.pop(txid, None)
+            if f is not None and not f.done():
+                f.set_result(None)
+
+    async def probe(txid, slots):
+        async with slots:
+            f = loop.create_future()
+            waiting[txid] = f
+            sent[txid] = loop.time()
+            bus.send(can.Message(arbitration_id=txid, data=frame, is_extended_id=False))
+            try:
+                await asyncio.wait_for(f, float(adaptive))
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                waiting.pop(txid, None)
+
+    receiver = asyncio.create_task(receive())
+    try:
+        slots = asyncio.Semaphore(window)
+        await asyncio.gather(*(probe(txid, slots) for txid in txids))
+        # late responses, to the requests sent last
+        last = max(sent.values(), default=loop.time())
+        await asyncio.sleep(max(0, last + timeout - loop.time()))
+    finally:
+        receiver.cancel()
+        notifier.stop()
+        bus.filters = old_filters
+    return found
+
+
+def scan_tester_present(bus, txids, **kwargs):
+    """Blocking wrapper for sweep() with a Tester Present request, returns a dict of
+    txid -> (response data, response time in seconds)."""
+    return asyncio.run(sweep(bus, txids, TESTER_PRESENT, **kwargs))
+
+
+async def probe_all(bus, txids, data, is_reply, interval=0.002, timeout=0.1):
+    """Send a frame of 'data' to each of 'txids', 'interval' seconds apart, and
+    collect replies until 'timeout' after the last one. Returns (sent, replies),
+    a dict of txid -> time sent and a list of (rxid, time received)."""
+    loop = asyncio.get_running_loop()
+    reader = can.AsyncBufferedReader()
+    notifier = can.Notifier(bus, [reader], loop=loop)
+    sent = {}
+    replies = []
+
+    async def receive():
+        async for msg in reader:
+            if is_reply(msg.data):
+                replies.append((msg.arbitration_id, loop.time()))
+
+    receiver = asyncio.create_task(receive())
+    try:
+        start = loop.time()
+        for n, txid in enumerate(txids):
+            # paced from the start time, so the rate doesn't drift
+            await asyncio.sleep(max(0, start + n * interval - loop.time()))
+            sent[txid] = loop.time()
+            bus.send(can.Message(arbitration_id=txid, data=data, is_extended_id=False))
+        await asyncio.sleep(timeout)
+    finally:
+        receiver.cancel()
+        notifier.stop()
+    return sent, replies
+
+
+def attribute(sent, replies, timeout, verify):
+    """Return a sorted list of (txid, rxid) for the probes which caused 'replies'
+    (see probe_all()). verify(txid) sends a lone probe and returns the reply ID,
+    or None."""
+    verified = {}  # txid -> rxid or None
+    explained = set()  # txids whose probe has been matched to a reply
+    latencies = []  # sorted response times of the replies attributed so far
+    offsets = set()  # rxid - txid of the ECUs found so far
+    for rxid, t in sorted(replies, key=lambda r: r[1]):
+        candidates = [txid for txid, ts in sent.items() if t - timeout <= ts <= t]
+        for txid in candidates:
+            if verified.get(txid) == rxid and txid not in explained:
+                explained.add(txid)
+                break
+        else:
+            typical = latencies[len(latencies) // 2] if latencies else 0
+
+            def likely(txid):
+                offset = rxid - txid
+                group = 0 if offset in offsets else 1 if abs(offset) <= NEAR_ID else 2
+                return group, abs(t - sent[txid] - typical)
+
+            candidates.sort(key=likely)
+            for txid in candidates:
+                if txid in verified:
+                    continue
+                verified[txid] = verify(txid)
+                if verified[txid] is not None:
+                    offsets.add(verified[txid] - txid)
+                if verified[txid] == rxid:
+                    explained.add(txid)
+                    latencies.append(t - sent[txid])
+                    latencies.sort()
+                    break
+    return sorted((txid, rxid) for txid, rxid in verified.items() if rxid is not None)
+
+
+def scan_responders(bus, txids, data, is_reply, verify, interval=0.002, timeout=0.1):
+    """Pipelined scan for ECUs which reply to a frame of 'data' on any ID. Returns a
+    sorted list of (txid, rxid). See probe_all() and attribute()."""
+    sent, replies = asyncio.run(probe_all(bus, txids, data, is_reply, interval, timeout))
+    return attribute(sent, replies, timeout, verify)
@@ -1,82 +1,355 @@
-# A thin client session wrapper around an ISO-TP session using the isotp module.
-# Call session.request(bytes) to submit a request and get any response within the specific
-# timeout
+# A thin client session wrapper around an ISO-TP session, shared by the Kona,
+# Outlander and BMW diagnostic code. Call session.request(bytes) to submit a
+# request and get any response within the specific timeout.
+#
+# There are two backends:
+#
+# - The Linux kernel CAN_ISOTP socket (the can-isotp module, in mainline since
+#   5.10), which does segmentation and flow control in the kernel. Used when the
+#   bus is a python-can socketcan bus and the kernel supports it, unless
+#   USE_KERNEL_ISOTP is False.
+#
+# - The python-can-isotp (v2 or newer) transport layer, which runs in its own
+#   threads: one blocks reading the bus with a short timeout, and the other runs
+#   the ISO-TP state machine, woken whenever a frame arrives or a send is queued.
+#
+# Either way request() and recv() block until the response is complete, and
+# nothing polls while the session is idle.
+#
+# Addressing is normal 11-bit (txid/rxid) by default, or pass an 'address' such
+# as extended_address() for BMW style extended addressing (tester 0xF1 sends on
+# 0x6F1 with the target ECU address in the first byte).
+#
+# Sessions are reference counted: the bus filter and transport are set up by
+# the outermost 'with session:' and torn down when it exits, so wrapping a
+# whole scan in 'with session:' (or 'with KWP2000Client(session):') makes each
+# request inside it cost only the round trip.
+#
+# To use several sessions on one bus at once, get them from a SessionPool. The
+# pool's sessions share one can.Notifier reading the bus, and the bus filters
+# are set to the receive IDs of all of the open sessions:
+#
+#   with SessionPool(bus) as pool:
+#       with pool.session(0x7E2, 0x7EA) as vcu, pool.session(0x7E4, 0x7EC) as bmu:
+#           ...
+#
+# AsyncSession wraps a Session for use from asyncio (see
+# kwp2000.AsyncKWP2000Client).
+import asyncio
+import can
 import isotp
 import logging
-import time
+import socket
 import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Use the kernel CAN_ISOTP socket when possible
+USE_KERNEL_ISOTP = True
+
+# Bus read timeout of the isotp reading thread. Only limits how quickly the
+# session stops, frames are handled as soon as they arrive.
+READ_TIMEOUT = 0.05
+
+# Longest single wait of AsyncSession.recv(), bounds how long its thread keeps
+# waiting after the recv() is cancelled
+ASYNC_RECV_SLICE = 0.05
+
+RX_MASK = 0xFFFFFFF
+
+_kernel_isotp = None  # whether the kernel supports CAN_ISOTP, once checked
+
+
+def kernel_isotp_available(bus):
+    """Return True if sessions on 'bus' can use a kernel CAN_ISOTP socket."""
+    global _kernel_isotp
+    if not USE_KERNEL_ISOTP or type(bus).__name__ != "SocketcanBus":
+        return False
+    if _kernel_isotp is None:
+        try:
+            isotp.socket().close()
+            _kernel_isotp = True
+        except (OSError, AttributeError):
+            _kernel_isotp = False  # no can-isotp module, or not Linux
+    return _kernel_isotp
+
+
+def extended_address(target_address, source_address, base=0x600):
+    """Return the isotp.Address for extended addressing between 'source_address'
+    (the tester, which sends on base | source_address) and 'target_address'
+    (the ECU, which replies on base | target_address)."""
+    return isotp.Address(
+        isotp.AddressingMode.Extended_11bits,
+        rxid=base | target_address,
+        txid=base | source_address,
+        target_address=target_address,
+        source_address=source_address,
+    )
+
+
+class CanStackBackend:
+    """python-can-isotp transport layer threads, on the bus or a pool's notifier."""
+
+    def __init__(self, bus, address, params, error_handler, notifier=None):
+        kwargs = dict(
+            address=address,
+            error_handler=error_handler,
+            params=params,
+            read_timeout=READ_TIMEOUT,
+        )
+        if notifier is None:
+            self.stack = isotp.CanStack(bus, **kwargs)
+        else:
+            self.stack = isotp.NotifierBasedCanStack(bus, notifier, **kwargs)
+
+    def start(self):
+        self.stack.start()
+
+    def stop(self):
+        if self.stack.started:
+            self.stack.stop()
+
+    def send(self, data):
+        self.stack.send(data)
+
+    def recv(self, timeout):
+        return self.stack.recv(block=True, timeout=timeout)
+
+
+class KernelBackend:
+    """Linux kernel CAN_ISOTP socket, bound while the session is open."""
+
+    def __init__(self, interface, address, params, error_handler):
+        self.interface = interface
+        self.address = address
+        self.params = params
+        self.error_handler = error_handler
+        self.sock = None
+
+    def start(self):
+        sock = isotp.socket()
+        params = self.params
+        if params.get("tx_padding") is not None:
+            sock.set_opts(optflag=isotp.socket.flags.TX_PADDING, txpad=params["tx_padding"])
+        sock.set_fc_opts(
+            bs=params.get("blocksize", 0),
+            stmin=params.get("stmin", 0),
+            wftmax=params.get("wftmax", 0),
+        )
+        sock.set_ll_opts(
+            mtu=isotp.socket.LinkLayerProtocol.CAN, tx_dl=params.get("tx_data_length", 8)
+        )
+        sock.bind(self.interface, self.address)
+        self.sock = sock
+
+    def stop(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, data):
+        self.sock.send(data)
+
+    def recv(self, timeout):
+        self.sock.settimeout(timeout)
+        try:
+            return bytearray(self.sock.recv())
+        except (socket.timeout, BlockingIOError):
+            return None  # nothing received, BlockingIOError if the timeout was 0
+        except OSError as e:
+            # e.g. no flow control or an incomplete message, the kernel reports
+            # ISO-TP errors on the next recv()
+            self.error_handler(e)
+            return None
 
 
 class Session:
-    def __init__(self, bus, txid, rxid, default_timeout=0.25):
-        self.exit_requested = False
+    def __init__(
+        self, bus, txid, rxid, default_timeout=0.25, pool=None, address=None, params=None
+    ):
         self.bus = bus
+        self.txid = txid
         self.rxid = rxid
         self.default_timeout = default_timeout
-        addr = isotp.Address(isotp.AddressingMode.Normal_11bits, rxid=rxid, txid=txid)
-        self.stack = isotp.CanStack(
-            self.bus,
-            address=addr,
-            error_handler=self.my_error_handler,
-            params=isotp_params,
-        )
+        self.pool = pool
+        self.users = 0  # number of 'with' blocks the session is open for
+        self.lock = threading.Lock()
+        if address is None:
+            address = isotp.Address(isotp.AddressingMode.Normal_11bits, rxid=rxid, txid=txid)
+        if params is None:
+            params = isotp_params
+        self.kernel = kernel_isotp_available(bus)
+        if self.kernel:
+            self.backend = KernelBackend(bus.channel, address, params, self.my_error_handler)
+        else:
+            notifier = None if pool is None else pool.notifier
+            self.backend = CanStackBackend(bus, address, params, self.my_error_handler, notifier)
 
     def __enter__(self):
-        self.old_filters = self.bus.filters
-        self.bus.filters = [{"can_id": self.rxid, "can_mask": 0xFFFFFFF}]
-        self.start()
+        with self.lock:
+            if not self.users:
+                self.open()
+            self.users += 1
         return self
 
     def __exit__(self, type, value, tb):
+        with self.lock:
+            self.users -= 1
+            if not self.users:
+                self.close()
+
+    def open(self):
+        if self.kernel:
+            pass  # the socket only receives its own rxid
+        elif self.pool is None:
+            self.old_filters = self.bus.filters
+            self.bus.filters = [{"can_id": self.rxid, "can_mask": RX_MASK}]
+        else:
+            self.pool.add_rxid(self.rxid)
+        self.start()
+
+    def close(self):
         self.stop()
-        self.bus.filters = self.old_filters
+        if self.kernel:
+            pass
+        elif self.pool is None:
+            self.bus.filters = self.old_filters
+        else:
+            self.pool.remove_rxid(self.rxid)
 
     def start(self):
-        self.exit_requested = False
-        self.thread = threading.Thread(target=self.thread_task)
-        self.thread.start()
+        self.backend.start()
 
     def stop(self):
-        self.exit_requested = True
-        if self.thread.is_alive():
-            self.thread.join()
+        self.backend.stop()
 
     def my_error_handler(self, error):
         logging.warning(
             "IsoTp error happened : %s - %s" % (error.__class__.__name__, str(error))
         )
 
-    def thread_task_disabled(self):
-        import cProfile
-
-        cProfile.runctx(
-            "self.thread_task_()", globals=globals(), locals=locals(), sort="cumtime"
-        )
-
-    def thread_task(self):
-        while not self.exit_requested:
-            self.stack.process()  # Non-blocking
-            # (sleeping here seems to cause the diagnostic session to time out
-            # time.sleep(0.001)
-            # time.sleep(self.stack.sleep_time()) # Variable sleep time based on state machine state
-
     def shutdown(self):
         self.stop()
         self.bus.shutdown()
 
+    def send(self, send_bytes):
+        self.backend.send(bytes(send_bytes))
+
     def request(self, send_bytes, timeout=None):
-        self.stack.send(send_bytes)
+        self.send(send_bytes)
         return self.recv(timeout)
 
     def recv(self, timeout):
         if timeout is None:
             timeout = self.default_timeout
-        t0 = time.time()
-        while time.time() - t0 < timeout:
-            if self.stack.available():
-                return self.stack.recv()
-            time.sleep(0.1)
-        return None
+        return self.backend.recv(timeout)
+
+
+class AsyncSession:
+    """asyncio wrapper for a Session. Waiting for a response blocks a thread of
+    the session's own executor, not the event loop, so many sessions can wait at
+    once. The executor is shut down when the outermost 'async with' exits.
+
+    recv() waits in slices of at most ASYNC_RECV_SLICE, so if it's cancelled
+    (e.g. by asyncio.wait_for) the thread stops waiting within that time. A
+    response arriving during that last slice is dropped, rather than being
+    returned to the next request."""
+
+    def __init__(self, session):
+        self.session = session
+        self.default_timeout = session.default_timeout
+        self.users = 0
+        self.executor = None
+
+    async def __aenter__(self):
+        if not self.users:
+            self.executor = ThreadPoolExecutor(1)
+        self.users += 1
+        self.session.__enter__()
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        self.session.__exit__(type, value, tb)
+        self.users -= 1
+        if not self.users:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def send(self, send_bytes):
+        self.session.send(send_bytes)
+
+    async def request(self, send_bytes, timeout=None):
+        self.send(send_bytes)
+        return await self.recv(timeout)
+
+    async def recv(self, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            wait = max(0, min(ASYNC_RECV_SLICE, deadline - loop.time()))
+            resp = await loop.run_in_executor(self.executor, self.session.recv, wait)
+            if resp is not None or loop.time() >= deadline:
+                return resp
+
+
+class SessionPool:
+    """Long-lived Sessions sharing one bus, one per (txid, rxid)."""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.notifier = None
+        if not kernel_isotp_available(bus):
+            self.notifier = can.Notifier(bus, [], timeout=READ_TIMEOUT)
+        self.sessions = {}
+        self.rxids = {}  # rxid -> number of open sessions receiving on it
+        self.lock = threading.Lock()
+        self.old_filters = bus.filters
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.shutdown()
+
+    def session(self, txid, rxid, default_timeout=0.25, address=None, params=None):
+        """Return the Session for 'txid' and 'rxid', creating it the first time.
+        The other arguments only apply when it's created."""
+        with self.lock:
+            s = self.sessions.get((txid, rxid))
+            if s is None:
+                s = Session(self.bus, txid, rxid, default_timeout, self, address, params)
+                self.sessions[txid, rxid] = s
+            return s
+
+    def add_rxid(self, rxid):
+        with self.lock:
+            self.rxids[rxid] = self.rxids.get(rxid, 0) + 1
+            self._set_filters()
+
+    def remove_rxid(self, rxid):
+        with self.lock:
+            self.rxids[rxid] -= 1
+            if not self.rxids[rxid]:
+                del self.rxids[rxid]
+            self._set_filters()
+
+    def _set_filters(self):
+        if self.rxids:
+            self.bus.filters = [{"can_id": r, "can_mask": RX_MASK} for r in sorted(self.rxids)]
+        else:
+            self.bus.filters = self.old_filters
+
+    def shutdown(self):
+        """Close all of the sessions and stop reading the bus (the bus stays open)."""
+        for s in list(self.sessions.values()):
+            with s.lock:
+                if s.users:
+                    s.users = 0
+                    s.close()
+        if self.notifier is not None:
+            self.notifier.stop()
+        self.bus.filters = self.old_filters
 
 
 isotp_params = {
@@ -87,13 +360,13 @@ isotp_params = {
     # Number of wait frame allowed before triggering an error
     "wftmax": 0,
     # Link layer (CAN layer) works with 8 byte payload (CAN 2.0)
-    "ll_data_length": 8,
+    "tx_data_length": 8,
     # Will pad all transmitted CAN messages with byte 0x00. None means no padding
     "tx_padding": 0,
     # Triggers a timeout if a flow control is awaited for more than 1000 milliseconds
     "rx_flowcontrol_timeout": 500,
     # Triggers a timeout if a consecutive frame is awaited for more than 1000 millisecondsa
     "rx_consecutive_frame_timeout": 1000,
-    # When sending, respect the stmin requirement of the receiver. If set to True, go as fast as possible.
-    "squash_stmin_requirement": False,
+    # When sending, respect the stmin requirement of the receiver. If set to 0, go as fast as possible.
+    "override_receiver_stmin": None,
 }
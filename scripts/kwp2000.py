@@ -3,12 +3,14 @@
 # KWP2000 script adapted from https://github.com/pd0wm/pq-flasher/blob/master/kwp2000.py
 # Original Copyright (c) 2021 Willem Melching
 # SPDX-License-Identifier: MIT
+import asyncio
 import struct
 import sys
+import time
 from enum import IntEnum
 
 import can
-from iso_session import Session
+from iso_session import AsyncSession, Session, SessionPool
 
 
 class NegativeResponseError(Exception):
@@ -101,6 +103,15 @@ class ENCRYPTION_TYPE(IntEnum):
     UNENCRYPTED = 0x0
 
 
+BUSY_REPEAT_REQUEST = 0x21
+RSP_PENDING = 0x78
+
+# After a reqCorrectlyRcvd-RspPending response, the final response (or another
+# RspPending) is waited for this long (P2*max) instead of the session timeout
+RSP_PENDING_TIMEOUT = 5.0
+# Give up on a request after this long in total of RspPending responses
+RSP_PENDING_LIMIT = 60.0
+
 _negative_response_codes = {
     0x10: "generalReject",
     0x11: "serviceNotSupported",
@@ -132,80 +143,151 @@ _negative_response_codes = {
 }
 
 
-class KWP2000Client:
-    def __init__(self, transport: Session, debug: bool = False):
-        self.transport = transport
-        self.debug = debug
+class Backoff:
+    """Delays before repeating a request after a busy-RepeatRequest response, for
+    one ECU. The delay doubles for each repeat of the same request (up to
+    'maximum'), and the first delay adapts to how long the ECU has needed to
+    stop being busy."""
 
-    def _kwp(
-        self, service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None
-    ) -> bytes:
-        req = bytes([service_type])
+    def __init__(self, initial=0.1, maximum=1.0):
+        self.minimum = initial
+        self.maximum = maximum
+        self.start = initial
 
-        if subfunction is not None:
-            req += bytes([subfunction])
-        if data is not None:
-            req += data
+    def delay(self, repeat):
+        """Return the delay before repeat number 'repeat' (from 1) of a request."""
+        return min(self.start * 2 ** (repeat - 1), self.maximum)
 
-        if self.debug:
-            print(f"KWP TX: {req.hex()}")
+    def wait(self, repeat):
+        time.sleep(self.delay(repeat))
 
-        with self.transport as t:
-            resp = t.request(req)
+    def done(self, repeats):
+        """Call when a request is finished, after 'repeats' busy responses."""
+        if repeats:
+            self.start = self.delay(repeats)  # the delay that was enough (or the most)
+        else:
+            self.start = max(self.minimum, self.start / 2)
 
-        if resp is None:
-            raise TimeoutError(f"No response to request {req.hex()}")
 
+def build_request(
+    service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None
+) -> bytes:
+    req = bytes([service_type])
+
+    if subfunction is not None:
+        req += bytes([subfunction])
+    if data is not None:
+        req += data
+    return req
+
+
+def is_response_to(service_type: SERVICE_TYPE, resp: bytes):
+    """Return True if 'resp' is a positive or negative response to 'service_type',
+    and not (for instance) a late response to an earlier request."""
+    if not resp:
+        return False
+    if resp[0] == 0x7F:
+        return len(resp) > 1 and resp[1] == service_type
+    return resp[0] == service_type + 0x40
+
+
+class ResponseWait:
+    """Deadlines while waiting for the response to one request: the session
+    timeout, extended to RSP_PENDING_TIMEOUT after each RspPending response (up
+    to RSP_PENDING_LIMIT in total). Responses which aren't to this request's
+    service are stale and discarded, without extending the deadline."""
+
+    def __init__(self, service_type: SERVICE_TYPE, timeout: float, debug: bool = False):
+        self.service_type = service_type
+        self.debug = debug
+        now = time.monotonic()
+        self.deadline = now + timeout
+        self.limit = now + RSP_PENDING_LIMIT
+
+    def remaining(self):
+        """Return the timeout for the next recv(), or None once the wait is over."""
+        remaining = self.deadline - time.monotonic()
+        return remaining if remaining > 0 else None
+
+    def final(self, resp: bytes):
+        """Return True if 'resp' (None for no response) ends the wait."""
+        if resp is None:
+            return True
+        if not is_response_to(self.service_type, resp):
+            if self.debug:
+                print(f"KWP RX: {resp.hex()} (stale, discarded)")
+            return False
+        if negative_response_code(self.service_type, resp) != RSP_PENDING:
+            return True
         if self.debug:
-            print(f"KWP RX: {resp.hex() if resp else None}")
+            print(f"KWP RX: {resp.hex()} (response pending)")
+        self.deadline = min(time.monotonic() + RSP_PENDING_TIMEOUT, self.limit)
+        return False
 
-        resp_sid = resp[0] if resp else None
 
-        # negative response
-        if resp_sid == 0x7F:
-            service_id = resp[1] if len(resp) > 1 else -1
+def negative_response_code(service_type: SERVICE_TYPE, resp: bytes):
+    """Return the error code if 'resp' is a negative response to 'service_type',
+    otherwise None."""
+    if resp and len(resp) > 2 and resp[0] == 0x7F and resp[1] == service_type:
+        return resp[2]
+    return None
 
-            if service_id != service_type:
-                raise InvalidServiceIdError(f"invalid negative response service id: {service_id:#x} - expected {service_type:#x}")
 
-            try:
-                service_desc = SERVICE_TYPE(service_id).name
-            except BaseException:
-                service_desc = "NON_STANDARD_SERVICE"
+def parse_response(service_type: SERVICE_TYPE, subfunction: int, resp: bytes) -> bytes:
+    """Check 'resp' is a positive response to the request, and return the data
+    from it. Raises an exception otherwise."""
+    resp_sid = resp[0] if resp else None
 
-            error_code = resp[2] if len(resp) > 2 else -1
+    # negative response
+    if resp_sid == 0x7F:
+        service_id = resp[1] if len(resp) > 1 else -1
 
-            try:
-                error_desc = _negative_response_codes[error_code]
-            except BaseException:
-                error_desc = resp[2:].hex()
+        if service_id != service_type:
+            raise InvalidServiceIdError(f"invalid negative response service id: {service_id:#x} - expected {service_type:#x}")
 
-            raise NegativeResponseError(
-                "{} - {}".format(service_desc, error_desc), service_id, error_code
-            )
+        try:
+            service_desc = SERVICE_TYPE(service_id).name
+        except BaseException:
+            service_desc = "NON_STANDARD_SERVICE"
+
+        error_code = resp[2] if len(resp) > 2 else -1
+
+        try:
+            error_desc = _negative_response_codes[error_code]
+        except BaseException:
+            error_desc = resp[2:].hex()
 
-        # positive response
-        if service_type + 0x40 != resp_sid:
-            resp_sid_hex = hex(resp_sid) if resp_sid is not None else None
-            raise InvalidServiceIdError(
-                "invalid response service id: {}".format(resp_sid_hex)
+        raise NegativeResponseError(
+            "{} - {}".format(service_desc, error_desc), service_id, error_code
+        )
+
+    # positive response
+    if service_type + 0x40 != resp_sid:
+        resp_sid_hex = hex(resp_sid) if resp_sid is not None else None
+        raise InvalidServiceIdError(
+            "invalid response service id: {}".format(resp_sid_hex)
+        )
+
+    # check subfunction
+    if subfunction is not None:
+        resp_sfn = resp[1] if len(resp) > 1 else None
+
+        if subfunction != resp_sfn:
+            resp_sfn_hex = hex(resp_sfn) if resp_sfn is not None else None
+            raise InvalidSubFunctionError(
+                f"invalid response subfunction: {resp_sfn_hex}"
             )
 
-        # check subfunction
-        if subfunction is not None:
-            resp_sfn = resp[1] if len(resp) > 1 else None
+    # return data (exclude service id and sub-function id)
+    return resp[(1 if subfunction is None else 2):]
 
-            if subfunction != resp_sfn:
-                resp_sfn_hex = hex(resp_sfn) if resp_sfn is not None else None
-                raise InvalidSubFunctionError(
-                    f"invalid response subfunction: {resp_sfn_hex:x}"
-                )
 
-        # return data (exclude service id and sub-function id)
-        return resp[(1 if subfunction is None else 2):]
+class KWP2000Services:
+    """Service helpers, shared by KWP2000Client and AsyncKWP2000Client. Subclasses
+    implement _kwp(), and _then() to apply a function to its result."""
 
     def diagnostic_session_control(self, session_type: SESSION_TYPE):
-        self._kwp(SERVICE_TYPE.DIAGNOSTIC_SESSION_CONTROL, subfunction=session_type)
+        return self._kwp(SERVICE_TYPE.DIAGNOSTIC_SESSION_CONTROL, subfunction=session_type)
 
     def read_diagnostic_trouble_codes(self):
         # There is an optional groupOfDTC parameter, but not bothering to pass it
@@ -258,12 +340,7 @@ class KWP2000Client:
         size = struct.pack(">L", uncompressed_size)[1:]
         data = addr + bytes([(compression_type << 4) | encryption_type]) + size
         ret = self._kwp(SERVICE_TYPE.REQUEST_DOWNLOAD, subfunction=None, data=data)
-        if len(ret) == 1:
-            return struct.unpack(">B", ret)[0]
-        elif len(ret) == 2:
-            return struct.unpack(">H", ret)[0]
-        else:
-            raise ValueError(f"Invalid response {ret.hex()}")
+        return self._then(ret, _max_block_length)
 
     def start_routine_by_local_identifier(
         self, routine_control: ROUTINE_CONTROL_TYPE, data: bytes
@@ -318,52 +395,162 @@ class KWP2000Client:
         return self._kwp(SERVICE_TYPE.STOP_COMMUNICATION)
 
 
+def _max_block_length(ret):
+    if len(ret) == 1:
+        return struct.unpack(">B", ret)[0]
+    elif len(ret) == 2:
+        return struct.unpack(">H", ret)[0]
+    else:
+        raise ValueError(f"Invalid response {ret.hex()}")
+
+
+class KWP2000Client(KWP2000Services):
+    def __init__(self, transport: Session, debug: bool = False):
+        self.transport = transport
+        self.debug = debug
+
+    def __enter__(self):
+        # keep the transport open across requests, instead of opening it for each one
+        self.transport.__enter__()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.transport.__exit__(type, value, tb)
+
+    def _then(self, result, fn):
+        return fn(result)
+
+    def _kwp(
+        self, service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None
+    ) -> bytes:
+        req = build_request(service_type, subfunction, data)
+
+        if self.debug:
+            print(f"KWP TX: {req.hex()}")
+
+        with self.transport as t:
+            t.send(req)
+            wait = ResponseWait(service_type, t.default_timeout, self.debug)
+            resp = None
+            while (timeout := wait.remaining()) is not None:
+                resp = t.recv(timeout)
+                if wait.final(resp):
+                    break
+                resp = None
+
+        if resp is None:
+            raise TimeoutError(f"No response to request {req.hex()}")
+
+        if self.debug:
+            print(f"KWP RX: {resp.hex() if resp else None}")
+
+        return parse_response(service_type, subfunction, resp)
+
+
+class AsyncKWP2000Client(KWP2000Services):
+    """asyncio KWP2000 client, on an iso_session.AsyncSession. Use with 'async with'
+    to keep the session open, and await the service helpers:
+
+      async with AsyncKWP2000Client(AsyncSession(session)) as kwp:
+          await kwp.diagnostic_session_control(0x81)
+
+    Negative responses are handled while waiting: the request is repeated after a
+    busy-RepeatRequest response (up to BUSY_RETRIES times, with a Backoff), and
+    RspPending responses and stale responses are waited past as in
+    KWP2000Client (see ResponseWait)."""
+
+    BUSY_RETRIES = 3
+
+    def __init__(self, transport: AsyncSession, debug: bool = False):
+        self.transport = transport
+        self.debug = debug
+        self.backoff = Backoff()
+
+    async def __aenter__(self):
+        await self.transport.__aenter__()
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        await self.transport.__aexit__(type, value, tb)
+
+    def _then(self, result, fn):
+        async def then():
+            return fn(await result)
+
+        return then()
+
+    async def _kwp(
+        self, service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None
+    ) -> bytes:
+        req = build_request(service_type, subfunction, data)
+
+        async with self.transport as t:
+            for busy in range(self.BUSY_RETRIES + 1):
+                if busy:
+                    await asyncio.sleep(self.backoff.delay(busy))
+                if self.debug:
+                    print(f"KWP TX: {req.hex()}")
+                t.send(req)
+                wait = ResponseWait(service_type, t.default_timeout, self.debug)
+                resp = None
+                while (timeout := wait.remaining()) is not None:
+                    resp = await t.recv(timeout)
+                    if wait.final(resp):
+                        break
+                    resp = None
+                if negative_response_code(service_type, resp) != BUSY_REPEAT_REQUEST:
+                    break
+                if self.debug:
+                    print(f"KWP RX: {resp.hex()} (busy)")
+            self.backoff.done(busy)
+
+        if resp is None:
+            raise TimeoutError(f"No response to request {req.hex()}")
+
+        if self.debug:
+            print(f"KWP RX: {resp.hex() if resp else None}")
+
+        return parse_response(service_type, subfunction, resp)
+
+
 def main(bus, txid, debug=True):
     rxid = txid + 8
     if debug:
         print("TXID {:#x} RXID {:#x}".format(txid, rxid))
     tp = Session(bus, txid, rxid)
 
-    kwp_client = KWP2000Client(tp, debug=debug)
+    with KWP2000Client(tp, debug=debug) as kwp_client:
+        kwp_client._kwp(SERVICE_TYPE.ECU_RESET, 0x02)
 
-    kwp_client._kwp(SERVICE_TYPE.ECU_RESET, 0x02)
+        # seems happy with 0x81 ("Default Session" and 0x90 ("ECU Passive Session")
+        kwp_client.diagnostic_session_control(0x81)
 
-    # seems happy with 0x81 ("Default Session" and 0x90 ("ECU Passive Session")
-    kwp_client.diagnostic_session_control(0x81)
+        # ident = kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+        # print(f"Part Number {ident[:10]}")
 
-    # ident = kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
-    # print(f"Part Number {ident[:10]}")
+        # to sweep service 0x17 identifiers (or other services and ranges), with resume:
+        #   kwp_sweep.py --session 0x81 --little-endian --checkpoint 17.json TXID 0x17 0 0xffff
 
-    for d in range(0xFFFF + 1):
-        kwp_client.diagnostic_session_control(0x81)
         try:
-            resp = kwp_client._kwp(0x17, data=struct.pack("<H", d))
-            print(f"OK! d={d:#x}, {resp.hex()}")
+            resp = kwp_client.read_diagnostic_trouble_codes_by_status(0x80)
+            print(resp.hex())
         except Exception as e:
-            if "invalidFormat" not in str(e):
-                print(e)
-    print("Done?")
-
-    try:
-        resp = kwp_client.read_diagnostic_trouble_codes_by_status(0x80)
-        print(resp.hex())
-    except Exception as e:
-        print(e)
-
-    try:
-        resp = kwp_client.read_diagnostic_trouble_codes()
-        print(resp.hex())
-    except Exception as e:
-        print(e)
-
-    try:
-        resp = kwp_client.read_status_of_diagnostic_trouble_codes()
-        print(resp.hex())
-    except Exception as e:
-        print(e)
-
-    # status = kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.STATUS_FLASH)
-    # print("Flash status", status)
+            print(e)
+
+        try:
+            resp = kwp_client.read_diagnostic_trouble_codes()
+            print(resp.hex())
+        except Exception as e:
+            print(e)
+
+        try:
+            resp = kwp_client.read_status_of_diagnostic_trouble_codes()
+            print(resp.hex())
+        except Exception as e:
+            print(e)
+
+        # status = kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.STATUS_FLASH)
+        # print("Flash status", status)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# Sweep a range of identifiers for one KWP2000 service on one ECU (for
+# instance 0x21 readDataByLocalIdentifier, 0x22 readDataByCommonIdentifier or
+# 0x17 readStatusOfDiagnosticTroubleCodes), to find which ones the ECU
+# supports.
+#
+# The session is opened once and requests are sent back to back on it. The
+# diagnostic session (--session) is only entered at the start, and again if the
+# ECU says it left it. Tester Present is only sent when the sweep has been idle
+# for TESTER_PRESENT_INTERVAL, as the requests themselves keep the session
+# alive. busy-RepeatRequest responses are repeated with a kwp2000.Backoff.
+#
+# Positive responses (hits) are printed as they're found. At the end a
+# histogram of the negative response codes (and timeouts) is printed.
+#
+# With --checkpoint, progress, hits and the histogram are saved to a JSON file
+# every CHECKPOINT_EVERY identifiers and when the sweep stops (including on
+# Ctrl-C). Running the same command again resumes from where it stopped.
+#
+# Uses the default python-can bus configuration.
+#
+# Usage:
+#
+#   kwp_sweep.py [--rxid RXID] [--session 0x81] [--width N] [--little-endian]
+#                [--checkpoint FILE] [--debug] TXID SERVICE START END
+#
+# e.g. kwp_sweep.py --session 0x81 --width 1 --checkpoint 7e0_21.json 0x7e0 0x21 0 0xff
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import argparse
+import json
+import os
+import time
+
+import can
+
+import kwp2000
+from iso_session import Session
+
+TESTER_PRESENT_INTERVAL = 2.0  # seconds idle, well inside the usual 5 s S3 timeout
+CHECKPOINT_EVERY = 256  # identifiers
+BUSY_RETRIES = 3
+
+# serviceNotSupportedInActiveDiagnosticMode, the ECU has left the session
+NOT_IN_SESSION = 0x80
+
+
+class SweepState:
+    """Progress and results of a sweep, saved as the checkpoint."""
+
+    def __init__(self, txid, service, start, end):
+        self.txid = txid
+        self.service = service
+        self.start = start
+        self.end = end  # inclusive
+        self.next = start
+        self.hits = {}  # identifier -> response data
+        self.counts = {}  # NRC as "0x31" (or "timeout", "invalid") -> number of responses
+
+    def same_sweep(self, other):
+        return (self.txid, self.service, self.start, self.end) == (
+            other.txid,
+            other.service,
+            other.start,
+            other.end,
+        )
+
+    def count(self, key):
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def save(self, path):
+        state = {
+            "txid": self.txid,
+            "service": self.service,
+            "start": self.start,
+            "end": self.end,
+            "next": self.next,
+            "hits": {f"{i:#x}": data.hex() for i, data in sorted(self.hits.items())},
+            "counts": self.counts,
+        }
+        # write then rename, so an interrupted save doesn't lose the last checkpoint
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            state = json.load(f)
+        s = cls(state["txid"], state["service"], state["start"], state["end"])
+        s.next = state["next"]
+        s.hits = {int(i, 16): bytes.fromhex(data) for i, data in state["hits"].items()}
+        s.counts = state["counts"]
+        return s
+
+
+def _nrc_desc(key):
+    if key.startswith("0x"):
+        return kwp2000._negative_response_codes.get(int(key, 16), "")
+    return ""
+
+
+def print_summary(state):
+    print(
+        f"{state.txid:#x} service {state.service:#x}: swept {state.start:#x}..{state.next - 1:#x}"
+        f" of {state.start:#x}..{state.end:#x}, {len(state.hits)} hits"
+    )
+    for i, data in sorted(state.hits.items()):
+        print(f"  {i:#x}: {data.hex()}")
+    print("Responses:")
+    for key, n in sorted(state.counts.items(), key=lambda kv: -kv[1]):
+        print(f"  {key:>8} {n:>6}  {_nrc_desc(key)}")
+
+
+def sweep(kwp, state, width=2, byteorder="big", session_type=None, checkpoint=None):
+    """Request each identifier from state.next to state.end with 'kwp' (a
+    KWP2000Client, held open for the sweep), updating 'state'. Identifiers are
+    sent as 'width' bytes of request data."""
+    backoff = kwp2000.Backoff()
+    last_request = 0.0
+
+    def request(service, data=None):
+        nonlocal last_request
+        try:
+            return kwp._kwp(service, data=data)
+        finally:
+            last_request = time.monotonic()
+
+    def enter_session():
+        if session_type:
+            request(kwp2000.SERVICE_TYPE.DIAGNOSTIC_SESSION_CONTROL, bytes([session_type]))
+
+    with kwp:
+        enter_session()
+        try:
+            while state.next <= state.end:
+                ident = state.next
+                if time.monotonic() - last_request > TESTER_PRESENT_INTERVAL:
+                    try:
+                        request(kwp2000.SERVICE_TYPE.TESTER_PRESENT)
+                    except (kwp2000.NegativeResponseError, kwp2000.TimeoutError):
+                        pass  # any response keeps the session alive
+                data = ident.to_bytes(width, byteorder)
+                busy = 0
+                rejoined = False
+                while True:
+                    try:
+                        resp = request(state.service, data)
+                        state.hits[ident] = bytes(resp)
+                        print(f"{ident:#x}: {resp.hex()}")
+                    except kwp2000.NegativeResponseError as e:
+                        if e.error_code == kwp2000.BUSY_REPEAT_REQUEST and busy < BUSY_RETRIES:
+                            busy += 1
+                            backoff.wait(busy)
+                            continue
+                        if e.error_code == NOT_IN_SESSION and session_type and not rejoined:
+                            rejoined = True  # once per identifier
+                            enter_session()
+                            continue
+                        state.count(f"{e.error_code:#04x}")
+                    except kwp2000.TimeoutError:
+                        state.count("timeout")
+                    except (kwp2000.InvalidServiceIdError, kwp2000.InvalidSubFunctionError):
+                        state.count("invalid")
+                    break
+                backoff.done(busy)
+                state.next += 1
+                if checkpoint and state.next % CHECKPOINT_EVERY == 0:
+                    state.save(checkpoint)
+        finally:
+            if checkpoint:
+                state.save(checkpoint)
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep identifiers for a KWP2000 service")
+    parser.add_argument("--rxid", type=lambda x: int(x, 0), help="Default TXID + 8")
+    parser.add_argument(
+        "--session", type=lambda x: int(x, 0), help="Diagnostic session to enter, e.g. 0x81"
+    )
+    parser.add_argument("--width", type=int, default=2, help="Identifier size in bytes")
+    parser.add_argument("--little-endian", action="store_true")
+    parser.add_argument("--checkpoint", help="JSON file to save progress to and resume from")
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument("txid", type=lambda x: int(x, 0))
+    parser.add_argument("service", type=lambda x: int(x, 0))
+    parser.add_argument("start", type=lambda x: int(x, 0))
+    parser.add_argument("end", type=lambda x: int(x, 0))
+    args = parser.parse_args()
+
+    state = SweepState(args.txid, args.service, args.start, args.end)
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        saved = SweepState.load(args.checkpoint)
+        if not saved.same_sweep(state):
+            parser.error(f"{args.checkpoint} is a checkpoint of a different sweep")
+        state = saved
+        print(f"Resuming from {state.next:#x}")
+
+    rxid = args.txid + 8 if args.rxid is None else args.rxid
+    bus = can.Bus()
+    kwp = kwp2000.KWP2000Client(Session(bus, args.txid, rxid), debug=args.debug)
+    try:
+        sweep(
+            kwp,
+            state,
+            args.width,
+            "little" if args.little_endian else "big",
+            args.session,
+            args.checkpoint,
+        )
+    except KeyboardInterrupt:
+        print("Interrupted")
+    finally:
+        print_summary(state)
+        bus.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+#
+# Infer a profile of each periodic message in a CAN capture, and print it as a
+# bench message table (in the style of the MSGS lists and PeriodicMessage
+# subclasses in hyundai_kona_ev/bench_kona/).
+#
+# For each ID this finds:
+#
+# - Period, and jitter (standard deviation of the intervals near the period).
+# - Default payload (the most common value of each byte) and which bits vary.
+# - Counter fields: bit fields within a byte that step by a constant amount
+#   each frame, including the step and any skipped value (as per
+#   message.CounterField).
+# - Likely checksum bytes or nibbles: fields with many values that change
+#   whenever any other part of the payload changes, and never on their own.
+#   Each is checked against the can_checksum.py algorithms over every range of
+#   bytes (as the whole byte, or either nibble of a byte), on a random sample of
+#   up to MAX_SAMPLES unique payloads from the whole capture. A suggestion is
+#   only made if applying it as a ChecksumField gives back every sampled
+#   payload unchanged.
+#
+# IDs with no counter or checksum are printed as MSGS tuples, others as a
+# PeriodicMessage subclass with CounterField and ChecksumField members. A
+# checksum which doesn't match any known algorithm is left as a comment (try
+# csum_search.py on it).
+#
+# The capture is processed a batch at a time and only fixed-size counts (and
+# the bounded set of sample payloads) are kept per ID (intervals go in a
+# log-spaced histogram), so memory use doesn't depend on the length of the
+# capture.
+#
+# Usage:
+#
+#   msgprofile.py [--id ID[,ID...]] [--bus N] [--min-frames N] LOG
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import argparse
+import math
+
+import numpy as np
+
+import can_checksum
+import canlog
+from counter_search import CounterStats
+
+ROW_CHUNK = 4096  # rows processed at once, bounds temporary arrays
+MAX_SAMPLES = 1024  # unique payloads kept per ID, for checksum algorithms
+
+# Log spaced histogram bins for intervals between frames, 1us to 100s
+INTERVAL_BINS_PER_DECADE = 50
+INTERVAL_BINS = 8 * INTERVAL_BINS_PER_DECADE + 1
+
+
+# Candidate checksum fields: each byte then each nibble, as masks of the
+# payload read as a little endian 64-bit integer
+CS_NAMES = [f"byte {b}" for b in range(8)] + [
+    f"byte {b} {'high' if n else 'low'} nibble" for b in range(8) for n in range(2)
+]
+CS_BYTE = np.array(list(range(8)) + [b for b in range(8) for _ in range(2)])
+CS_MASK = np.array([0xFF] * 8 + [0x0F, 0xF0] * 8, np.uint8)  # within the byte
+CS_MASK64 = (CS_MASK.astype(np.uint64) << (CS_BYTE * 8).astype(np.uint64))
+CS_SHIFT = np.array([0] * 8 + [0, 4] * 8, np.uint8)
+N_CS = len(CS_BYTE)
+
+
+class MessageProfile:
+    """Fixed-size accumulated statistics for one CAN ID."""
+
+    def __init__(self, can_id):
+        self.can_id = can_id
+        self.frames = 0
+        self.prev_t = None
+        self.prev = None  # payload of the last frame seen
+        self.lengths = np.zeros(65, np.int64)
+        self.changed = np.uint64(0)  # bits which have changed
+        self.interval_n = np.zeros(INTERVAL_BINS, np.int64)
+        self.interval_sum = np.zeros(INTERVAL_BINS)
+        self.interval_sq = np.zeros(INTERVAL_BINS)
+        self.byte_values = np.zeros((8, 256), np.int64)
+        self.counter_stats = CounterStats()
+        # checksum candidates: frames where only the rest of the payload changed,
+        # both changed, or only the field changed
+        self.cs_values = np.zeros((N_CS, 256), bool)
+        self.cs_others = np.zeros(N_CS, np.int64)
+        self.cs_both = np.zeros(N_CS, np.int64)
+        self.cs_alone = np.zeros(N_CS, np.int64)
+        # random sample of the unique payloads, as little endian 64-bit integers
+        self.samples = []
+        self._sampled = set()  # the values in self.samples
+        self._unique_seen = 0  # unique payloads offered to the sample (roughly)
+        self._rng = np.random.default_rng(can_id)
+
+    def update(self, timestamp, data, lengths):
+        """Add frames for this ID, with timestamp (n,), data (n, 8) and payload lengths (n,)"""
+        self.frames += len(timestamp)
+        self.lengths += np.bincount(lengths, minlength=65)
+
+        t = timestamp if self.prev_t is None else np.append(self.prev_t, timestamp)
+        self.prev_t = timestamp[-1]
+        intervals = np.diff(t)
+        if len(intervals):
+            b = np.log10(np.maximum(intervals, 1)) * INTERVAL_BINS_PER_DECADE
+            b = np.minimum(b.astype(np.int64), INTERVAL_BINS - 1)
+            self.interval_n += np.bincount(b, minlength=INTERVAL_BINS)
+            self.interval_sum += np.bincount(b, intervals, INTERVAL_BINS)
+            self.interval_sq += np.bincount(b, intervals.astype(float) ** 2, INTERVAL_BINS)
+
+        data = np.ascontiguousarray(data[:, :8])
+        self._update_samples(np.unique(data.view("<u8").ravel()))
+        for b in range(8):
+            self.byte_values[b] += np.bincount(data[:, b], minlength=256)
+        # each row chunk overlaps the previous one by a row, to see every transition
+        rows = data if self.prev is None else np.concatenate((self.prev[None], data))
+        self.prev = data[-1]
+        for i in range(0, len(rows) - 1, ROW_CHUNK):
+            self._update_fields(rows[i : i + ROW_CHUNK + 1])
+        if len(rows) == 1:
+            self._update_fields(rows)
+
+    def _update_samples(self, unique):
+        """Reservoir sample of the unique payloads, so the sample covers the whole
+        capture rather than just the start of it."""
+        for value in unique.tolist():
+            if value in self._sampled:
+                continue
+            self._unique_seen += 1
+            if len(self.samples) < MAX_SAMPLES:
+                self.samples.append(value)
+            else:
+                j = int(self._rng.integers(self._unique_seen))
+                if j >= MAX_SAMPLES:
+                    continue
+                self._sampled.discard(self.samples[j])
+                self.samples[j] = value
+            self._sampled.add(value)
+
+    def _update_fields(self, rows):
+        self.counter_stats.add_values(rows)
+        self.counter_stats.add_transitions(rows[:-1], rows[1:])
+
+        # checksum candidates
+        v = (rows[:, CS_BYTE] & CS_MASK) >> CS_SHIFT
+        self.cs_values[np.arange(N_CS), v] = True
+        u64 = rows.view("<u8").ravel()
+        xor = u64[1:] ^ u64[:-1]
+        self.changed |= np.bitwise_or.reduce(xor) if len(xor) else np.uint64(0)
+        this = (xor[:, None] & CS_MASK64) != 0
+        others = (xor[:, None] & ~CS_MASK64) != 0
+        self.cs_others += others.sum(axis=0)
+        self.cs_both += (this & others).sum(axis=0)
+        self.cs_alone += (this & ~others).sum(axis=0)
+
+    def period(self):
+        """Return (period, jitter) in microseconds, or (None, None) if unknown.
+
+        Period is the mean and jitter the standard deviation of the intervals
+        within 50% of the median interval, so that gaps in the log don't count."""
+        n = self.interval_n
+        total = n.sum()
+        if not total:
+            return None, None
+        median_bin = np.searchsorted(np.cumsum(n), total / 2)
+        median = self.interval_sum[median_bin] / n[median_bin]
+        edges = 10 ** (np.arange(INTERVAL_BINS + 1) / INTERVAL_BINS_PER_DECADE)
+        near = (edges[:-1] >= median * 0.5) & (edges[1:] <= median * 1.5)
+        near[median_bin] = True
+        count = n[near].sum()
+        mean = self.interval_sum[near].sum() / count
+        var = self.interval_sq[near].sum() / count - mean**2
+        return mean, math.sqrt(max(var, 0))
+
+    def length(self):
+        return int(np.argmax(self.lengths))
+
+    def default_payload(self):
+        return bytes(np.argmax(self.byte_values[: self.length()], axis=1).tolist())
+
+    def varying_bits(self):
+        """Return a list of (byte, bitmask) for each byte with bits which change."""
+        changed = int(self.changed)
+        masks = [(b, (changed >> (8 * b)) & 0xFF) for b in range(8)]
+        return [(b, m) for b, m in masks if m]
+
+    def counters(self, min_frames=16, threshold=0.99):
+        """Return a list of (byte, bitmask, delta, skip) for the counter fields found
+        (see counter_search.CounterStats.counters())."""
+        found = self.counter_stats.counters(min_frames, threshold)
+        return [(c.byte, c.mask, c.delta, c.skip) for c in found]
+
+    def checksums(self, counters=(), min_changes=16):
+        """Return a list of (byte, bitmask, name) for the likely checksum fields, not
+        overlapping any of 'counters'."""
+        found = []
+        taken = np.zeros(8, np.int64)
+        for byte, mask, _, _ in counters:
+            taken[byte] |= mask
+        length = self.length()
+        for cs in range(N_CS):
+            byte, mask = int(CS_BYTE[cs]), int(CS_MASK[cs])
+            others = self.cs_others[cs]
+            if byte >= length or taken[byte] & mask or others < min_changes:
+                continue
+            unchanged = self.frames - 1 - others  # frames where the rest didn't change
+            if (
+                self.cs_both[cs] >= others * 0.9
+                and self.cs_alone[cs] <= max(unchanged, 1) * 0.05
+                and self.cs_values[cs].sum() >= (8 if mask == 0xFF else 4)
+            ):
+                found.append((byte, mask, CS_NAMES[cs]))
+                taken[byte] |= mask
+        return found
+
+    def sample_payloads(self):
+        """Return the sample payloads as an (n, length) uint8 array."""
+        u64 = np.array(sorted(self.samples), "<u8")
+        return u64.view(np.uint8).reshape(-1, 8)[:, : self.length()]
+
+
+def _apply_checksum(payloads, byte, mask, algorithm, start, end):
+    """Return 'payloads' with the checksum field set as message.ChecksumField does."""
+    shift = (mask & -mask).bit_length() - 1
+    data = payloads.copy()
+    data[:, byte] &= 0xFF ^ mask
+    c = algorithm.calc_batch(data[:, start:end]).astype(np.int64)
+    data[:, byte] |= ((c << shift) & mask).astype(np.uint8)
+    return data
+
+
+def find_checksum_algorithm(payloads, byte, mask):
+    """Return (algorithm, mask, start, end) for a can_checksum algorithm which, set
+    as a ChecksumField over payloads[start:end], gives back all of 'payloads'
+    unchanged, or None. 'mask' is the field's mask (0xFF, 0x0F or 0xF0), a whole
+    byte field may turn out to be a checksum in one of its nibbles. The widest
+    range is preferred."""
+    masks = [mask] + ([0x0F, 0xF0] if mask == 0xFF else [])
+    field = payloads[:, byte]
+    # a constant nibble trivially matches some algorithm over constant bytes
+    masks = [m for m in masks if ((field & m) != (field[0] & m)).any()]
+    length = payloads.shape[1]
+    ranges = [(a, b) for a in range(length) for b in range(a + 1, length + 1)]
+    ranges.sort(key=lambda r: (r[0] - r[1], r[0]))
+    for m in masks:
+        for a, b in ranges:
+            for algorithm in can_checksum.ALGORITHMS.values():
+                applied = _apply_checksum(payloads, byte, m, algorithm, a, b)
+                if (applied == payloads).all():
+                    return algorithm, m, a, b
+    return None
+
+
+def profile(batches, ids=None, bus=None):
+    """Return a dict of can_id -> MessageProfile for the batches of a log."""
+    profiles = {}
+    for batch in batches:
+        if ids is not None:
+            batch = batch[np.isin(batch["can_id"], ids)]
+        if bus is not None:
+            batch = batch[batch["bus"] == bus]
+        if not len(batch):
+            continue
+        order = np.argsort(batch["can_id"], kind="stable")
+        batch = batch[order]
+        lengths = canlog.payload_lengths(batch)
+        batch_ids, starts = np.unique(batch["can_id"], return_index=True)
+        ends = np.append(starts[1:], len(batch))
+        for can_id, s, e in zip(batch_ids.tolist(), starts.tolist(), ends.tolist()):
+            if can_id not in profiles:
+                profiles[can_id] = MessageProfile(can_id)
+            profiles[can_id].update(batch["timestamp"][s:e], batch["data"][s:e], lengths[s:e])
+    return profiles
+
+
+def _frequency(period):
+    if period is None:
+        return 1
+    hz = 1e6 / period
+    return round(hz) if hz >= 1 else round(hz, 3)
+
+
+def format_profile(p):
+    """Return Python source for one message profile: a MSGS tuple if there are no
+    counters or checksums, otherwise a PeriodicMessage subclass."""
+    period, jitter = p.period()
+    hz = _frequency(period)
+    timing = "period unknown"
+    if period is not None:
+        timing = f"{period / 1000:.1f}ms +/-{jitter / 1000:.1f}ms"
+    varying = ", ".join(f"{b}:{m:02X}" for b, m in p.varying_bits()) or "none"
+    summary = f"{p.frames} frames, {timing}, varying bits {varying}"
+    payload = p.default_payload()
+    counters = p.counters()
+    checksums = p.checksums(counters)
+
+    if not counters and not checksums:
+        data = ",".join(f"{b:02X}" for b in payload)
+        return (
+            f"    (\n        0x{p.can_id:X},\n"
+            f'        "{data}",  # {summary}\n'
+            f"        {hz},\n    ),\n"
+        )
+
+    lines = [
+        f"class MSG_{p.can_id:X}(PeriodicMessage):",
+        f'    """Inferred from capture: {summary}."""',
+        "",
+        "    def __init__(self, car):",
+        f"        super().__init__(",
+        f'            car, 0x{p.can_id:X}, bytearray.fromhex("{payload.hex().upper()}"), {hz}',
+        "        )",
+    ]
+    for i, (byte, mask, delta, skip) in enumerate(counters):
+        args = f"self.data, {byte}, 0x{mask:02X}"
+        if delta != -1:
+            args += f", delta={delta}"
+        if skip is not None:
+            args += f", skip=0x{skip:X}"
+        lines.append(f"        self.counter{i} = CounterField({args})")
+    payloads = p.sample_payloads() if checksums else None
+    updates = [f"        self.counter{i}.update()" for i in range(len(counters))]
+    covered = set()  # bytes covered by the checksums found so far
+    # last byte first, as checksums usually follow the data they cover, and a
+    # nibble sum which sums to zero would match at any of its nibbles
+    for byte, mask, name in sorted(checksums, reverse=True):
+        if byte in covered:
+            continue  # the same checksum, seen from another field
+        found = find_checksum_algorithm(payloads, byte, mask)
+        if found is None:
+            lines.append(f"        # {name} ({byte}:{mask:02X}) looks like an unknown checksum")
+            continue
+        i = len(updates) - len(counters)
+        algorithm, mask, start, end = found
+        covered.update(range(start, end))
+        args = f"self.data, {byte}, can_checksum.{algorithm.name}"
+        if start:
+            args += f", start={start}"
+        if end != len(payload):
+            args += f", end={end}"
+        if mask != 0xFF:
+            args += f", bitmask=0x{mask:02X}"
+        lines.append(f"        self.checksum{i} = ChecksumField({args})")
+        updates.append(f"        self.checksum{i}.update()")
+    lines += ["", "    def update(self):"] + (updates or ["        pass"])
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Infer periodic message profiles from a CAN log")
+    parser.add_argument("--id", action="append", help="Only these arbitration ID(s), hex")
+    parser.add_argument("--bus", type=int)
+    parser.add_argument("--min-frames", type=int, default=2)
+    parser.add_argument("log")
+    args = parser.parse_args()
+
+    ids = None
+    if args.id:
+        ids = [int(i, 16) for arg in args.id for i in arg.split(",")]
+
+    profiles = profile(canlog.read_log(args.log), ids, args.bus)
+    profiles = [p for _, p in sorted(profiles.items()) if p.frames >= args.min_frames]
+    simple = []
+    classes = []
+    for p in profiles:
+        src = format_profile(p)
+        (classes if src.startswith("class") else simple).append(src)
+
+    print("import can_checksum")
+    print("from message import ChecksumField, CounterField, PeriodicMessage\n")
+    print("MSGS = [\n" + "".join(simple) + "]\n")
+    for src in classes:
+        print(f"\n{src}")
+    print(
+        """
+def get_messages(car):
+    return [
+        PeriodicMessage(car, can_id, bytes.fromhex(data.replace(",", "")), hz)
+        for (can_id, data, hz) in MSGS
+    ] + [
+        k(car)
+        for k in globals().values()
+        if type(k) == type and k != PeriodicMessage and issubclass(k, PeriodicMessage)
+    ]"""
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+#
+# Build a table of every unique payload of each ID in a set of CAN logs, with
+# the number of times it was seen, the first and last timestamps, and the
+# number of times each ID changed from one payload to another (transitions).
+#
+# Replaces the hand pasted lists of "all the discrete values of this message in
+# logs" in hyundai_kona_ev/checksums/, and is much faster for the checksum and
+# counter tools to load than re-reading the raw logs:
+#
+#   payload_table.py build -o kona.npz logs/*.csv
+#   csum_search.py --payloads kona.npz --id 10c
+#
+# Each log is read in a single pass, in parallel with --jobs (default: one per
+# CPU), and the tables for each log are merged. Transitions are only counted
+# between consecutive frames within the same log.
+#
+# The table is saved as a compressed numpy .npz file with two arrays:
+#
+# payloads     Sorted by ID then payload. Fields can_id, length, data (zero
+#              padded), count, first, last (timestamps in microseconds).
+# transitions  Fields src, dst (indexes into payloads, of the same ID) and count.
+#
+# 'show' prints a table as text, with --transitions to also list those.
+#
+# Usage:
+#
+#   payload_table.py build [--jobs N] [--id ID[,ID...]] [--bus N] -o TABLE LOG [...]
+#   payload_table.py show [--id ID[,ID...]] [--transitions] TABLE
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import canlog
+
+NO_TIME = np.iinfo(np.int64).max
+
+
+class PayloadTable:
+    """Unique payloads per ID, with counts, first/last timestamps and transitions."""
+
+    def __init__(self):
+        self.payloads = {}  # (can_id, payload) -> [count, first, last]
+        self.transitions = {}  # (can_id, from payload, to payload) -> count
+        self._last = {}  # can_id -> last payload, while adding batches
+
+    def add_batch(self, batch):
+        """Add a batch of frames, which follows on from any previous batch."""
+        if not len(batch):
+            return
+        width = batch.dtype["data"].shape[0]
+        key = np.zeros(len(batch), [("can_id", "<u4"), ("len", "u1"), ("data", f"V{width}")])
+        key["can_id"] = batch["can_id"]
+        key["len"] = canlog.payload_lengths(batch)
+        key["data"] = np.ascontiguousarray(batch["data"]).view(key.dtype["data"]).ravel()
+        unique, inverse, counts = np.unique(key, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        first = np.full(len(unique), NO_TIME)
+        last = np.full(len(unique), -NO_TIME)
+        np.minimum.at(first, inverse, batch["timestamp"])
+        np.maximum.at(last, inverse, batch["timestamp"])
+
+        names = [(can_id, bytes(data)[:n]) for can_id, n, data in unique.tolist()]
+        for name, c, f, l in zip(names, counts.tolist(), first.tolist(), last.tolist()):
+            entry = self.payloads.get(name)
+            if entry is None:
+                self.payloads[name] = [c, f, l]
+            else:
+                entry[0] += c
+                entry[1] = min(entry[1], f)
+                entry[2] = max(entry[2], l)
+
+        # transitions between consecutive frames of each ID, in log order
+        order = np.argsort(batch["can_id"], kind="stable")
+        ids, seq = batch["can_id"][order], inverse[order]
+        same = ids[1:] == ids[:-1]
+        changed = same & (seq[1:] != seq[:-1])
+        pairs, n = np.unique(
+            seq[:-1][changed].astype(np.int64) * len(unique) + seq[1:][changed],
+            return_counts=True,
+        )
+        for pair, count in zip(pairs.tolist(), n.tolist()):
+            src, dst = names[pair // len(unique)], names[pair % len(unique)]
+            self._add_transition(src[0], src[1], dst[1], count)
+        # and from the last payload of the previous batch
+        starts = np.nonzero(np.append(True, ~same))[0]
+        ends = np.append(starts[1:], len(ids)) - 1
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            can_id, payload = names[seq[start]]
+            prev = self._last.get(can_id)
+            if prev is not None and prev != payload:
+                self._add_transition(can_id, prev, payload, 1)
+            self._last[can_id] = names[seq[end]][1]
+
+    def _add_transition(self, can_id, src, dst, count):
+        k = (can_id, src, dst)
+        self.transitions[k] = self.transitions.get(k, 0) + count
+
+    def merge(self, other):
+        """Merge in the table from another log."""
+        for name, (c, f, l) in other.payloads.items():
+            entry = self.payloads.get(name)
+            if entry is None:
+                self.payloads[name] = [c, f, l]
+            else:
+                entry[0] += c
+                entry[1] = min(entry[1], f)
+                entry[2] = max(entry[2], l)
+        for k, count in other.transitions.items():
+            self.transitions[k] = self.transitions.get(k, 0) + count
+
+    def ids(self):
+        return sorted({can_id for can_id, _ in self.payloads})
+
+    def unique(self, can_id):
+        """Return (payloads, counts) for 'can_id' as an (n, length) uint8 array and an
+        array of counts, for the most common payload length."""
+        rows = [(p, v[0]) for (i, p), v in self.payloads.items() if i == can_id]
+        if not rows:
+            return np.zeros((0, 0), np.uint8), np.zeros(0, np.int64)
+        lengths = {}
+        for p, count in rows:
+            lengths[len(p)] = lengths.get(len(p), 0) + count
+        length = max(lengths, key=lengths.get)
+        rows = sorted((p, c) for p, c in rows if len(p) == length)
+        data = np.frombuffer(b"".join(p for p, _ in rows), np.uint8).reshape(len(rows), length)
+        return data, np.array([c for _, c in rows], np.int64)
+
+    def save(self, path):
+        names = sorted(self.payloads)
+        width = 64 if any(len(p) > 8 for _, p in names) else 8
+        payloads = np.zeros(
+            len(names),
+            [
+                ("can_id", "<u4"),
+                ("length", "u1"),
+                ("data", "u1", (width,)),
+                ("count", "<i8"),
+                ("first", "<i8"),
+                ("last", "<i8"),
+            ],
+        )
+        payloads["can_id"] = [i for i, _ in names]
+        payloads["length"] = [len(p) for _, p in names]
+        payloads["data"] = np.frombuffer(
+            b"".join(p.ljust(width, b"\x00") for _, p in names), np.uint8
+        ).reshape(-1, width)
+        values = np.array([self.payloads[n] for n in names], np.int64).reshape(-1, 3)
+        payloads["count"], payloads["first"], payloads["last"] = values.T
+
+        index = {n: i for i, n in enumerate(names)}
+        transitions = np.zeros(
+            len(self.transitions), [("src", "<i8"), ("dst", "<i8"), ("count", "<i8")]
+        )
+        items = sorted(self.transitions.items())
+        transitions["src"] = [index[can_id, src] for (can_id, src, _), _ in items]
+        transitions["dst"] = [index[can_id, dst] for (can_id, _, dst), _ in items]
+        transitions["count"] = [count for _, count in items]
+        np.savez_compressed(path, payloads=payloads, transitions=transitions)
+
+    @classmethod
+    def load(cls, path):
+        table = cls()
+        with np.load(path) as f:
+            payloads, transitions = f["payloads"], f["transitions"]
+        names = [
+            (can_id, bytes(data[:n]))
+            for can_id, n, data in zip(
+                payloads["can_id"].tolist(), payloads["length"].tolist(), payloads["data"]
+            )
+        ]
+        for name, c, f, l in zip(
+            names,
+            payloads["count"].tolist(),
+            payloads["first"].tolist(),
+            payloads["last"].tolist(),
+        ):
+            table.payloads[name] = [c, f, l]
+        for src, dst, count in transitions.tolist():
+            table.transitions[names[src][0], names[src][1], names[dst][1]] = count
+        return table
+
+
+def table_for_log(path, ids=None, bus=None):
+    """Return the PayloadTable for one log."""
+    table = PayloadTable()
+    for batch in canlog.read_log(path):
+        if ids is not None:
+            batch = batch[np.isin(batch["can_id"], ids)]
+        if bus is not None:
+            batch = batch[batch["bus"] == bus]
+        table.add_batch(batch)
+    table._last.clear()
+    return table
+
+
+def build(paths, ids=None, bus=None, jobs=1):
+    """Return the merged PayloadTable for all of the logs in 'paths'."""
+    table = PayloadTable()
+    if jobs > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            futures = [pool.submit(table_for_log, p, ids, bus) for p in paths]
+            for f in futures:
+                table.merge(f.result())
+    else:
+        for p in paths:
+            table.merge(table_for_log(p, ids, bus))
+    return table
+
+
+def show(table, ids=None, transitions=False):
+    print("ID,Payload,Count,First,Last")
+    for (can_id, payload), (count, first, last) in sorted(table.payloads.items()):
+        if ids is None or can_id in ids:
+            payload = payload.hex().upper()
+            print(f"{can_id:08X},{payload},{count},{first / 1e6:.6f},{last / 1e6:.6f}")
+    if transitions:
+        print("\nID,From,To,Count")
+        for (can_id, src, dst), count in sorted(table.transitions.items()):
+            if ids is None or can_id in ids:
+                print(f"{can_id:08X},{src.hex().upper()},{dst.hex().upper()},{count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Unique payload tables for CAN logs")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("build", help="Build a table from logs")
+    p.add_argument("--jobs", type=int, default=os.cpu_count())
+    p.add_argument("--id", action="append", help="Only these arbitration ID(s), hex")
+    p.add_argument("--bus", type=int)
+    p.add_argument("-o", "--output", required=True)
+    p.add_argument("logs", nargs="+")
+    p = sub.add_parser("show", help="Print a table")
+    p.add_argument("--id", action="append", help="Only these arbitration ID(s), hex")
+    p.add_argument("--transitions", action="store_true")
+    p.add_argument("table")
+    args = parser.parse_args()
+
+    ids = None
+    if args.id:
+        ids = [int(i, 16) for arg in args.id for i in arg.split(",")]
+
+    if args.command == "build":
+        table = build(args.logs, ids, args.bus, args.jobs)
+        table.save(args.output)
+        print(
+            f"{len(table.payloads)} unique payloads of {len(table.ids())} IDs, "
+            f"{len(table.transitions)} transitions"
+        )
+    else:
+        try:
+            show(PayloadTable.load(args.table), ids, args.transitions)
+        except BrokenPipeError:
+            pass  # output piped to 'head' or similar
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+# Local SQLite cache of diagnostic scan results, per vehicle (VIN, or any other
+# name for the car) and ECU, so that repeat scans of the same car only probe
+# what isn't known yet:
+#
+# - ID scans (kona.scan_tester_present, outlander_dtc.scan_ecus) skip IDs which
+#   didn't respond last time, and still probe the ones which did.
+# - Service enumeration (kona.enumerate_services) skips services which were
+#   known to be unsupported, and re-verifies the supported ones.
+#
+# Results older than the cache's max_age (default MAX_AGE) are probed again.
+#
+#   cache = scan_cache.ScanCache("kona.sqlite")
+#   kona.scan_tester_present(bus, cache, "KMHK381GFKU000000")
+#
+# Run as a script to print what's in a cache:
+#
+#   scan_cache.py [--vin VIN] CACHE
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import argparse
+import sqlite3
+import threading
+import time
+
+MAX_AGE = 30 * 24 * 3600  # seconds
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ids (
+    vin TEXT NOT NULL,
+    kind TEXT NOT NULL,  -- type of scan, e.g. "tester_present"
+    txid INTEGER NOT NULL,
+    rxid INTEGER,  -- NULL if no response
+    response BLOB,
+    scanned REAL NOT NULL,  -- unix time
+    PRIMARY KEY (vin, kind, txid)
+);
+CREATE TABLE IF NOT EXISTS services (
+    vin TEXT NOT NULL,
+    txid INTEGER NOT NULL,
+    service_id INTEGER NOT NULL,
+    supported INTEGER NOT NULL,
+    scanned REAL NOT NULL,
+    PRIMARY KEY (vin, txid, service_id)
+);
+"""
+
+
+class ScanCache:
+    def __init__(self, path, max_age=MAX_AGE):
+        # shared by the threads of concurrent scans, with a lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.max_age = max_age
+
+    def close(self):
+        self.db.close()
+
+    def _since(self):
+        return time.time() - self.max_age
+
+    @staticmethod
+    def _check_vin(vin):
+        # scans read the cache before they start, so this fails before scanning
+        if not vin:
+            raise ValueError("A vehicle name ('vin') is needed to use a scan cache")
+
+    def ids(self, vin, kind):
+        """Return a dict of txid -> rxid (None if no response) for the IDs scanned
+        recently."""
+        self._check_vin(vin)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT txid, rxid FROM ids WHERE vin = ? AND kind = ? AND scanned >= ?",
+                (vin, kind, self._since()),
+            )
+            return dict(rows)
+
+    def dead_ids(self, vin, kind):
+        """Return the set of txids which recently didn't respond."""
+        return {txid for txid, rxid in self.ids(vin, kind).items() if rxid is None}
+
+    def set_ids(self, vin, kind, results):
+        """Store scan results, a dict of txid -> rxid (None if no response) or
+        (rxid, response data)."""
+        self._check_vin(vin)
+        now = time.time()
+        rows = []
+        for txid, r in results.items():
+            rxid, response = r if isinstance(r, tuple) else (r, None)
+            rows.append((vin, kind, txid, rxid, response, now))
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO ids VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def services(self, vin, txid):
+        """Return a dict of service_id -> supported for the services scanned recently."""
+        self._check_vin(vin)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT service_id, supported FROM services "
+                "WHERE vin = ? AND txid = ? AND scanned >= ?",
+                (vin, txid, self._since()),
+            )
+            return {service_id: bool(supported) for service_id, supported in rows}
+
+    def set_services(self, vin, txid, results):
+        """Store service scan results, a dict of service_id -> supported."""
+        self._check_vin(vin)
+        now = time.time()
+        rows = [(vin, txid, s, int(supported), now) for s, supported in results.items()]
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO services VALUES (?, ?, ?, ?, ?)", rows)
+
+    def show(self, vin=None):
+        where, args = ("WHERE vin = ?", (vin,)) if vin else ("", ())
+        print("VIN,Kind,TXID,RXID,Response,Scanned")
+        for v, kind, txid, rxid, response, scanned in self.db.execute(
+            f"SELECT * FROM ids {where} ORDER BY vin, kind, txid", args
+        ):
+            if rxid is not None:
+                response = response.hex() if response else ""
+                when = time.strftime("%Y-%m-%d %H:%M", time.localtime(scanned))
+                print(f"{v},{kind},{txid:#x},{rxid:#x},{response},{when}")
+        print("\nVIN,TXID,Supported services")
+        services = {}
+        for v, txid, service_id in self.db.execute(
+            f"SELECT vin, txid, service_id FROM services {where} "
+            f"{'AND' if vin else 'WHERE'} supported ORDER BY vin, txid, service_id",
+            args,
+        ):
+            services.setdefault((v, txid), []).append(service_id)
+        for (v, txid), ids in services.items():
+            print(f"{v},{txid:#x},{' '.join(hex(s) for s in ids)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print a diagnostic scan cache")
+    parser.add_argument("--vin", help="Only this vehicle")
+    parser.add_argument("cache")
+    args = parser.parse_args()
+    cache = ScanCache(args.cache)
+    try:
+        cache.show(args.vin)
+    except BrokenPipeError:
+        pass  # output piped to 'head' or similar
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# Tests for canlog.py, run with pytest from scripts/
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import can
+import numpy as np
+
+import canlog
+
+
+def _lines():
+    return [
+        str(can.Message(timestamp=1000 + i * 0.001, arbitration_id=0x100 + i, data=bytes([i] * 8),
+                        channel=0))
+        for i in range(8)
+    ]
+
+
+def test_pycan_fast_matches_regex_on_malformed_timestamps():
+    lines = _lines()
+    good = lines[0]
+    t = good.find("    ID: ")
+    ts = good[11:t]
+
+    def with_timestamp(line, bad):
+        return line[:11] + bad.rjust(len(ts)) + line[t:]
+
+    lines[1] = with_timestamp(lines[1], "10x0.000000")  # invalid character
+    lines[2] = with_timestamp(lines[2], "1000.0.0001")  # two dots
+    lines[3] = with_timestamp(lines[3], "1000 .000200")  # space inside
+    lines[4] = with_timestamp(lines[4], "")  # no digits
+    lines[5] = with_timestamp(lines[5], ".")
+
+    fast = canlog.parse_pycan_lines(lines)
+    slow = canlog.parse_pycan_lines(lines, fast=False)
+    assert np.array_equal(fast, slow)
+    assert fast["can_id"].tolist() == [0x100, 0x106, 0x107]
+
+
+def test_pycan_fast_matches_regex_on_flags():
+    lines = [
+        str(can.Message(timestamp=1, arbitration_id=0x10, data=b"\x01", channel=0)),
+        str(can.Message(timestamp=2, arbitration_id=0x11, data=b"\x02", is_rx=False, channel=0)),
+        str(can.Message(timestamp=3, arbitration_id=0x12, is_remote_frame=True, is_rx=False,
+                        is_extended_id=False, channel=1)),
+        str(can.Message(timestamp=4, arbitration_id=0x13, data=b"\x03", is_fd=True,
+                        bitrate_switch=True, channel=1)),
+    ]
+    fast = canlog.parse_pycan_lines(lines)
+    slow = canlog.parse_pycan_lines(lines, fast=False)
+    assert np.array_equal(fast, slow)
+    assert fast["flags"][1] & canlog.FLAG_TX
+    assert not fast["flags"][0] & canlog.FLAG_TX
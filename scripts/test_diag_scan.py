@@ -0,0 +1,14 @@
+# Tests for diag_scan.py, run with pytest from scripts/
+#
+# SPDX-License-Identifier: MIT OR Apache-2.0
+import asyncio
+
+import can
+
+import diag_scan
+
+
+def test_sweep_no_txids():
+    with can.Bus(interface="virtual", channel="test_diag_scan") as bus:
+        assert asyncio.run(diag_scan.sweep(bus, [])) == {}
+        assert diag_scan.scan_tester_present(bus, []) == {}